@@ -13,7 +13,15 @@ from girder_jobs.models.job import Job
 from dive_utils import constants
 
 from .client_webroot import ClientWebroot
-from .crud_annotation import GroupItem, RevisionLogItem, TrackItem
+from .crud_annotation import (
+    FeatureChunkItem,
+    GroupItem,
+    LabelCountItem,
+    RevisionCounterItem,
+    RevisionLogItem,
+    TrackItem,
+    migrate_annotation_records,
+)
 from .event import DIVES3Imports, process_fs_import, process_s3_import, send_new_user_email
 from .views_annotation import AnnotationResource
 from .views_configuration import ConfigurationResource
@@ -26,7 +34,13 @@ class GirderPlugin(plugin.GirderPlugin):
     def load(self, info):
         ModelImporter.registerModel('trackItem', TrackItem, plugin='dive_server')
         ModelImporter.registerModel('groupItem', GroupItem, plugin='dive_server')
+        ModelImporter.registerModel('featureChunkItem', FeatureChunkItem, plugin='dive_server')
+        ModelImporter.registerModel('labelCountItem', LabelCountItem, plugin='dive_server')
         ModelImporter.registerModel('revisionLogItem', RevisionLogItem, plugin='dive_server')
+        ModelImporter.registerModel(
+            'revisionCounterItem', RevisionCounterItem, plugin='dive_server'
+        )
+        migrate_annotation_records()
 
         info["apiRoot"].dive_annotation = AnnotationResource("dive_annotation")
         info["apiRoot"].dive_configuration = ConfigurationResource("dive_configuration")
@@ -0,0 +1,110 @@
+"""
+In-process cache of serialized annotation listings.
+
+Entries are keyed by the revision they were read at, so a cached payload never
+goes stale: a save only makes new keys.  Saves still invalidate the dataset so
+that superseded payloads give their memory back before they age out.
+
+Configured per deployment with environment variables:
+
+* DIVE_ANNOTATION_CACHE_BYTES: memory cap for cached payloads, 0 disables the cache
+* DIVE_ANNOTATION_CACHE_POLICY: ``lru`` evicts the least recently used entry,
+  ``fifo`` evicts the oldest entry regardless of use
+"""
+
+from collections import OrderedDict
+import os
+import threading
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import cherrypy
+
+from dive_utils import types
+
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+POLICIES = ['lru', 'fifo']
+
+
+class AnnotationCache:
+    def __init__(self, max_bytes: int, policy: str = 'lru'):
+        if policy not in POLICIES:
+            raise ValueError(f'Annotation cache policy must be one of {POLICIES}, not {policy}')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries: 'OrderedDict[Tuple[Hashable, ...], bytes]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @classmethod
+    def from_environment(cls) -> 'AnnotationCache':
+        max_bytes = int(os.environ.get('DIVE_ANNOTATION_CACHE_BYTES', DEFAULT_MAX_BYTES))
+        policy = os.environ.get('DIVE_ANNOTATION_CACHE_POLICY', 'lru').lower()
+        return cls(max_bytes, policy)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Optional[bytes]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self._counters['misses'] += 1
+                return None
+            if self.policy == 'lru':
+                self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return payload
+
+    def put(self, key: Tuple[Hashable, ...], payload: bytes):
+        # A single payload may not take more than a quarter of the cache
+        if len(payload) * 4 > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = payload
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, datasetId):
+        """Drop every entry of a dataset, keys begin with the dataset id"""
+        datasetId = str(datasetId)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == datasetId]:
+                self._bytes -= len(self._entries.pop(key))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'maxBytes': self.max_bytes,
+                'policy': self.policy,
+            }
+
+
+annotations = AnnotationCache.from_environment()
+
+
+def annotation_key(dsFolder: types.GirderModel, revision: int, set: Optional[str], *parts) -> tuple:
+    """Cache key of a listing, parts must describe everything else the payload depends on"""
+    return (str(dsFolder['_id']), revision, set or None, *(_hashable(part) for part in parts))
+
+
+def _hashable(part):
+    if isinstance(part, (list, tuple)):
+        return tuple(_hashable(item) for item in part)
+    return part
+
+
+def respond(payload: bytes, mime: str) -> Callable:
+    """Stream a cached payload as the response body"""
+    cherrypy.response.headers['Content-Type'] = mime
+
+    def stream():
+        yield payload
+
+    return stream
@@ -1,11 +1,15 @@
 """General CRUD operations and utilities shared among views"""
 
+import base64
 from enum import Enum
 import functools
+import hashlib
+import json
 import os
 from pathlib import Path
-from typing import List, Type
+from typing import List, Optional, Type
 
+import cherrypy
 from girder.constants import AccessType
 from girder.exceptions import RestException, ValidationException
 from girder.models.folder import Folder
@@ -13,6 +17,7 @@ from girder.models.item import Item
 from girder.models.model_base import AccessControlledModel, Model
 import pydantic
 from pydantic.main import BaseModel
+import pymongo
 
 from dive_utils import asbool, constants, fromMeta, models, strNumericCompare
 from dive_utils.types import GirderModel, GirderUserModel
@@ -53,6 +58,69 @@ class PydanticAccessControlModel(PydanticModel, AccessControlledModel):
     pass
 
 
+def encode_continuation(key: str, value: int) -> str:
+    """Encode an opaque token that resumes a listing after the record with key=value"""
+    return base64.urlsafe_b64encode(json.dumps({'k': key, 'v': value}).encode()).decode()
+
+
+def decode_continuation(key: str, token: str) -> int:
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(token.encode()))
+        if decoded['k'] == key and isinstance(decoded['v'], int):
+            return decoded['v']
+    except (ValueError, TypeError, KeyError):
+        pass
+    raise RestException('Invalid continuation token')
+
+
+def keyset_query(sort: List[list], key: str, continuation: Optional[str]) -> dict:
+    """
+    Range query that resumes a listing sorted by key after a continuation token.
+
+    Unlike offset paging, which Mongo implements by skipping records,
+    this is an indexed range scan, so each page costs the same.
+    """
+    if not continuation:
+        return {}
+    if not sort or sort[0][0] != key:
+        raise RestException(f'Continuation tokens require sorting by {key}')
+    operator = '$lt' if sort[0][1] == pymongo.DESCENDING else '$gt'
+    return {key: {operator: decode_continuation(key, continuation)}}
+
+
+def set_continuation_header(records: List[dict], limit: int, sort: List[list], key: str):
+    """Send a continuation token for the next page when this page is full and sorted by key"""
+    if not sort or sort[0][0] != key:
+        return
+    if limit and len(records) == limit:
+        token = encode_continuation(key, records[-1][key])
+        cherrypy.response.headers[constants.ContinuationHeader] = token
+
+
+def conditional_response(key: list, immutable: bool = False):
+    """
+    Send a strong ETag derived from key, and answer 304 when the client already has it.
+
+    key must capture everything the response body depends on.  Immutable responses,
+    such as reads pinned to an explicit revision, may be cached without revalidation.
+    """
+    digest = hashlib.sha1(json.dumps(key, default=str).encode()).hexdigest()
+    etag = f'"{digest}"'
+    headers = cherrypy.response.headers
+    headers['ETag'] = etag
+    headers['Vary'] = 'Accept'
+    if immutable:
+        headers['Cache-Control'] = f'private, max-age={constants.ImmutableMaxAge}, immutable'
+    else:
+        headers['Cache-Control'] = 'private, no-cache'
+    match = cherrypy.request.headers.get('If-None-Match')
+    if match is not None:
+        # Weak comparison is allowed for If-None-Match
+        candidates = {tag.strip().replace('W/', '', 1) for tag in match.split(',')}
+        if etag in candidates or '*' in candidates:
+            raise cherrypy.HTTPRedirect([], 304)
+
+
 def get_static_pipelines_path() -> Path:
     pipeline_path = None
 
@@ -1,13 +1,26 @@
-from typing import Callable, Generator, Iterable, List, Optional, Tuple
+import bisect
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import json
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
 
+import bson
+from bson.objectid import ObjectId
 from girder.constants import AccessType
+from girder.exceptions import RestException
 from girder.models.folder import Folder
+from girder.models.setting import Setting
+from girder.models.user import User
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
 from pydantic import Field
 from pydantic.main import BaseModel
 import pymongo
 from pymongo.cursor import Cursor
+from pymongo.errors import DuplicateKeyError
 
-from dive_server import crud, crud_dataset
+from dive_server import cache, crud, crud_dataset
 from dive_utils import constants, fromMeta, models, types
 from dive_utils.serializers import viame
 
@@ -15,12 +28,160 @@ DATASET = 'dataset'
 SET = 'set'
 REVISION_DELETED = 'rev_deleted'
 REVISION_CREATED = 'rev_created'
+REVISION_HEAD = 'rev_head'
+# Revision of the save that copied a record in from the source of a clone
+REVISION_COPIED = 'rev_copied'
 REVISION = 'revision'
+HEAD = 'head'
+COMPACTED = 'compacted'
+SETS = 'sets'
+PENDING = 'pending'
+EXPIRES = 'expires'
+OVERWRITE = 'overwrite'
+EXCLUSIVE = 'exclusive'
+COMMITTED = 'committed'
 IDENTIFIER = 'id'
+TOMBSTONE = 'tombstone'
+BEGIN = 'begin'
+END = 'end'
+# Approximate number of characters buffered between writes of a streamed json export
+JSON_EXPORT_FLUSH_SIZE = 64 * 1024
+# Number of records restored per ordered insert during a rollback
+ROLLBACK_BATCH_SIZE = 1000
+# Rollbacks touching more track and group records than this run as a background job
+ROLLBACK_JOB_THRESHOLD = 10000
+# Number of upserted records held in memory before a save writes them
+SAVE_BATCH_SIZE = 1000
+# Seconds a save stays pending without renewing its lease before it is undone as abandoned
+SAVE_LEASE_TIMEOUT = 300
+FEATURES = 'features'
+FEATURE_CHUNKS = 'featureChunks'
+FRAME_BUCKETS = 'frameBuckets'
+# Windows spanning more buckets than this are found with the begin and end index instead
+FRAME_BUCKET_QUERY_LIMIT = 64
+# Tracks spanning more buckets than this store only LONG_TRACK_BUCKET, which every
+# bucket query also matches, and are then narrowed down by their begin and end
+TRACK_FRAME_BUCKET_LIMIT = 64
+LONG_TRACK_BUCKET = -1
+CHUNK = 'chunk'
+# Number of source records checked against a clone's own records at once
+OVERLAY_PAGE_SIZE = 1000
 
 DEFAULT_ANNOTATION_SORT = [[IDENTIFIER, 1]]
 DEFAULT_REVISION_SORT = [[REVISION, pymongo.DESCENDING]]
 
+# frameStart and frameEnd of a windowed read, either may be None
+FrameWindow = Tuple[Optional[int], Optional[int]]
+
+
+def annotation_source(dsFolder: types.GirderModel) -> Optional[Tuple[types.GirderModel, int]]:
+    """
+    Source dataset and pinned revision of a copy-on-write clone, or None.
+
+    A clone stores only the annotations edited since it was created, plus
+    tombstone records for source annotations it deleted.  Every other annotation
+    is read from the source dataset as it was at the pinned revision.
+    """
+    sourceId = dsFolder.get(constants.AnnotationSourceIdMarker)
+    if sourceId is None:
+        return None
+    # Reads only need the id, so clones keep working if the source folder is deleted
+    return {'_id': ObjectId(sourceId)}, dsFolder[constants.AnnotationSourceRevisionMarker]
+
+
+def revision_query(
+    dsFolder: types.GirderModel, revision: Optional[int], committed: Optional[int] = None
+) -> dict:
+    """
+    Query fragment selecting records visible at a revision, or at head if None.
+    Head reads are pinned to committed, or to the latest revision if that is None too.
+    """
+    if revision is None:
+        if committed is None:
+            committed = RevisionLogItem().latest(dsFolder)
+        return head_filter(committed)
+    verify_revision_available(dsFolder, revision)
+    return revision_filter(revision)
+
+
+def head_filter(committed: int) -> dict:
+    """
+    Query fragment for records visible at the committed head, using the head indexes.
+
+    A save in progress has already cleared the head flag of the records it expires
+    and flagged the records it inserts, so both are pinned to the committed revision.
+    """
+    return {
+        '$or': [
+            {REVISION_HEAD: True, REVISION_CREATED: {'$lte': committed}},
+            {REVISION_CREATED: {'$lte': committed}, REVISION_DELETED: {'$gt': committed}},
+        ]
+    }
+
+
+def revision_filter(revision: int) -> dict:
+    """Raw query fragment for records visible at a revision, without checking compaction"""
+    return {
+        REVISION_CREATED: {'$lte': revision},
+        '$or': [
+            {REVISION_DELETED: {'$gt': revision}},
+            {REVISION_DELETED: {'$exists': False}},
+        ],
+    }
+
+
+def overlaps(a: Optional[str], b: Optional[str]) -> bool:
+    """Whether saves to sets a and b can touch the same records, None standing for every set"""
+    return not a or not b or a == b
+
+
+def frame_buckets(frameStart: int, frameEnd: int) -> List[int]:
+    """Buckets of FrameBucketSize frames that overlap [frameStart, frameEnd]"""
+    size = constants.FrameBucketSize
+    return list(range(frameStart // size, frameEnd // size + 1))
+
+
+def track_frame_buckets(begin: int, end: int) -> List[int]:
+    """Buckets to index a track spanning [begin, end] by, bounded by TRACK_FRAME_BUCKET_LIMIT"""
+    buckets = frame_buckets(begin, end)
+    if len(buckets) > TRACK_FRAME_BUCKET_LIMIT:
+        return [LONG_TRACK_BUCKET]
+    return buckets
+
+
+def frame_bucket_query(frameStart: int, frameEnd: int) -> dict:
+    """Query for tracks that may be present in [frameStart, frameEnd], using the bucket index"""
+    buckets = frame_buckets(frameStart, frameEnd)
+    if len(buckets) > FRAME_BUCKET_QUERY_LIMIT:
+        return {}
+    return {FRAME_BUCKETS: {'$in': [LONG_TRACK_BUCKET, *buckets]}}
+
+
+def _pages(records: Iterable[dict], size: int) -> Iterable[List[dict]]:
+    page: List[dict] = []
+    for record in records:
+        page.append(record)
+        if len(page) >= size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def window_chunks(chunks: List[int], window: FrameWindow) -> List[int]:
+    """
+    Chunks of a track overlapping a frame window, plus the nearest chunk on either
+    side, which holds the keyframes that interpolate into the window.
+    """
+    frameStart, frameEnd = window
+    first = 0
+    last = len(chunks)
+    if frameStart is not None:
+        first = max(bisect.bisect_left(chunks, frameStart // constants.FeatureChunkSize) - 1, 0)
+    if frameEnd is not None:
+        last = bisect.bisect_right(chunks, frameEnd // constants.FeatureChunkSize) + 1
+    return chunks[first:last]
+
 
 class BaseItem(crud.PydanticModel):
     def list(
@@ -31,27 +192,221 @@ class BaseItem(crud.PydanticModel):
         sort=DEFAULT_ANNOTATION_SORT,
         revision: Optional[int] = None,
         set: Optional[int] = None,
-    ) -> Cursor:
-        head: int = RevisionLogItem().latest(dsFolder, set) if revision is None else revision
+        frameStart: Optional[int] = None,
+        frameEnd: Optional[int] = None,
+        continuation: Optional[str] = None,
+        fields: Optional[dict] = None,
+        filters: Optional[dict] = None,
+        committed: Optional[int] = None,
+    ) -> Iterable[dict]:
+        """
+        List annotations visible at a revision.
+
+        Reads of the latest revision use the head indexes and are pinned to the
+        committed head, while reads of an explicit revision walk the revision history.
+
+        :param frameStart: only include annotations whose [begin, end] overlaps the window.
+            Tracks stored in chunks only get the features of the chunks around the window.
+        :param frameEnd: inclusive end of the frame window
+        :param continuation: token from a previous page, used instead of offset
+        :param fields: projection to use instead of PROJECT_FIELDS, such as SUMMARY_FIELDS
+        :param filters: additional query, such as from threshold_query or type_query
+        :param committed: head revision to pin a head read to, such as the one its ETag
+            and cache key were made from, instead of looking the head up again
+        """
+        visible = revision_query(dsFolder, revision, committed)
+        own = {DATASET: dsFolder['_id'], **visible}
+        query: dict = {SET: set or None}
+        if frameEnd is not None:
+            query[BEGIN] = {'$lte': frameEnd}
+        if frameStart is not None:
+            query[END] = {'$gte': frameStart}
+        query.update(crud.keyset_query(sort, IDENTIFIER, continuation))
+        if filters:
+            query['$and'] = [filters]
+        fields = fields or self.PROJECT_FIELDS
+        window = (frameStart, frameEnd)
+        source = annotation_source(dsFolder)
+        if source is not None:
+            return self._overlay(
+                dsFolder, source, own, query, limit, offset, sort, visible, set, fields, window
+            )
+        cursor = self.find(
+            offset=offset,
+            limit=limit,
+            sort=sort,
+            query={**own, **query},
+            fields=fields,
+        )
+        return self.expand(dsFolder, cursor, visible, set, window)
+
+    def _overlay(
+        self,
+        dsFolder: types.GirderModel,
+        source: Tuple[types.GirderModel, int],
+        own: dict,
+        query: dict,
+        limit: int,
+        offset: int,
+        sort: List[list],
+        visible: dict,
+        set: Optional[str],
+        fields: dict,
+        window: FrameWindow,
+    ) -> Iterable[dict]:
+        """Merge a clone's own records over its source snapshot, both streamed in sort order"""
+        sourceFolder, pinned = source
+        sort = sort or DEFAULT_ANNOTATION_SORT
+        own_cursor = self.find(
+            query={**own, **query, TOMBSTONE: {'$ne': True}},
+            sort=sort,
+            fields=fields,
+        )
+        source_visible = revision_query(sourceFolder, pinned)
+        source_cursor = self.find(
+            query={DATASET: sourceFolder['_id'], **source_visible, **query},
+            sort=sort,
+            fields=fields,
+        )
+        unshadowed = self._unshadowed(source_cursor, {**own, SET: set or None})
+        field, direction = sort[0]
+        merged = heapq.merge(
+            self.expand(dsFolder, own_cursor, visible, set, window),
+            self.expand(sourceFolder, unshadowed, source_visible, set, window),
+            key=lambda record: record.get(field),
+            reverse=direction == pymongo.DESCENDING,
+        )
+        return itertools.islice(merged, offset, offset + limit if limit else None)
+
+    def _unshadowed(self, source_records: Iterable[dict], own: dict) -> Iterable[dict]:
+        """Source records without an edit or tombstone of the clone, checked page by page"""
+        for page in _pages(source_records, OVERLAY_PAGE_SIZE):
+            ids = [record[IDENTIFIER] for record in page]
+            shadowed = frozenset(distinct_ids(self, own, ids))
+            yield from (record for record in page if record[IDENTIFIER] not in shadowed)
+
+    def head_records(
+        self,
+        dsFolder: types.GirderModel,
+        ids: List[int],
+        set: Optional[str] = None,
+        committed: Optional[int] = None,
+    ) -> Dict[int, dict]:
+        """Latest committed version of the given annotations, keyed by id, see list"""
+        visible = revision_query(dsFolder, None, committed)
         query = {
             DATASET: dsFolder['_id'],
-            REVISION_CREATED: {'$lte': head},
-            '$or': [{REVISION_DELETED: {'$gt': head}}, {REVISION_DELETED: {'$exists': False}}],
+            SET: set or None,
+            IDENTIFIER: {'$in': ids},
+            **visible,
         }
-        if set:
-            query[SET] = set
-        else:
-            query[SET] = None
-        return self.find(
-            offset=offset, limit=limit, sort=sort, query=query, fields=self.PROJECT_FIELDS
+        cursor = self.find(query={**query, TOMBSTONE: {'$ne': True}}, fields=self.PROJECT_FIELDS)
+        records = {
+            record[IDENTIFIER]: record for record in self.expand(dsFolder, cursor, visible, set)
+        }
+        source = annotation_source(dsFolder)
+        if source is not None:
+            sourceFolder, pinned = source
+            shadowed = frozenset(self.collection.distinct(IDENTIFIER, query))
+            unshadowed = [id for id in ids if id not in shadowed]
+            if unshadowed:
+                source_visible = revision_query(sourceFolder, pinned)
+                cursor = self.find(
+                    query={
+                        DATASET: sourceFolder['_id'],
+                        SET: set or None,
+                        IDENTIFIER: {'$in': unshadowed},
+                        **source_visible,
+                    },
+                    fields=self.PROJECT_FIELDS,
+                )
+                for record in self.expand(sourceFolder, cursor, source_visible, set):
+                    records[record[IDENTIFIER]] = record
+        return records
+
+    def expand(
+        self,
+        dsFolder: types.GirderModel,
+        records: Iterable[dict],
+        visible: dict,
+        set: Optional[str] = None,
+        window: FrameWindow = (None, None),
+    ) -> Iterable[dict]:
+        """
+        Hook to complete records that are not stored as a single document.
+
+        :param visible: the revision_query fragment the records were read with
+        :param window: frameStart and frameEnd of a windowed read, either may be None
+        """
+        return records
+
+    def prepare(self, record: dict):
+        """Hook to add derived fields to a record before it is saved"""
+
+    def changes(
+        self,
+        dsFolder: types.GirderModel,
+        since: int,
+        head: int,
+        set: Optional[str] = None,
+    ) -> Tuple[List[dict], List[int]]:
+        """
+        Find annotations upserted or deleted in the revision range (since, head].
+
+        An id appears in at most one of the two lists: anything still alive
+        at head is an upsert, everything else that was touched is a delete.
+        """
+        base = {DATASET: dsFolder['_id'], SET: set or None}
+        visible = head_filter(head)
+        created = {**base, REVISION_CREATED: {'$gt': since}, **visible}
+        source = annotation_source(dsFolder)
+        cursor = self.find(
+            query={**created, TOMBSTONE: {'$ne': True}} if source else created,
+            sort=DEFAULT_ANNOTATION_SORT,
+            fields=self.PROJECT_FIELDS,
         )
+        upserted = list(self.expand(dsFolder, cursor, visible, set))
+        upserted_ids = {annotation[IDENTIFIER] for annotation in upserted}
+        expired_ids = self.collection.distinct(
+            IDENTIFIER, {**base, REVISION_DELETED: {'$gt': since, '$lte': head}}
+        )
+        if source is not None:
+            tombstoned = self.collection.distinct(IDENTIFIER, {**created, TOMBSTONE: True})
+            # A source annotation reappears when the clone's edit of it was removed
+            exposed = [id for id in expired_ids if id not in upserted_ids and id not in tombstoned]
+            if exposed:
+                restored = self.head_records(dsFolder, exposed, set)
+                upserted += [restored[id] for id in sorted(restored)]
+                upserted_ids.update(restored.keys())
+            expired_ids += tombstoned
+        deleted = sorted({id for id in expired_ids if id not in upserted_ids})
+        return upserted, deleted
 
     def initialize(self):
         self._indices = [
-            # Index for finding tracks in a dataset
-            [[(DATASET, 1), (IDENTIFIER, 1)], {}],
-            # Index for ensuring uniqueness and dataset consistency
+            # Index for ensuring uniqueness, also serves saves that touch every set
             [[(DATASET, 1), (IDENTIFIER, 1), (REVISION_CREATED, 1)], {'unique': True}],
+            # Reads always filter on set, so their indexes lead with it.
+            # Index for listing a set at a revision, in id order
+            [[(DATASET, 1), (SET, 1), (IDENTIFIER, 1), (REVISION_CREATED, 1)], {}],
+            # Index for frame window queries, revision predicate is applied within the index
+            [[(DATASET, 1), (SET, 1), (BEGIN, 1), (END, 1), (REVISION_CREATED, 1)], {}],
+            # Partial indexes covering only the head revision of each annotation
+            [
+                [(DATASET, 1), (SET, 1), (IDENTIFIER, 1)],
+                {'partialFilterExpression': {REVISION_HEAD: True}},
+            ],
+            [
+                [(DATASET, 1), (SET, 1), (BEGIN, 1), (END, 1)],
+                {'partialFilterExpression': {REVISION_HEAD: True}},
+            ],
+            # Indexes for revision range (delta) queries, per set and across sets
+            [[(DATASET, 1), (SET, 1), (REVISION_CREATED, 1)], {}],
+            [[(DATASET, 1), (REVISION_CREATED, 1)], {}],
+            [
+                [(DATASET, 1), (REVISION_DELETED, 1)],
+                {'partialFilterExpression': {REVISION_DELETED: {'$exists': True}}},
+            ],
         ]
         super().initialize(self.NAME, self.MODEL)
 
@@ -60,10 +415,98 @@ class TrackItem(BaseItem):
     PROJECT_FIELDS = {
         **{'_id': 0},
         **{key: 1 for key in models.Track.schema()['properties'].keys()},
+        FEATURE_CHUNKS: 1,
+    }
+    # Enough to list and filter tracks without loading their features
+    SUMMARY_FIELDS = {
+        '_id': 0,
+        IDENTIFIER: 1,
+        BEGIN: 1,
+        END: 1,
+        'maxConfidence': 1,
+        'topLabel': 1,
+        'featureCount': 1,
+        'hasGeometry': 1,
     }
     NAME = 'trackItem'
     MODEL = models.TrackItemSchema
 
+    def initialize(self):
+        super().initialize()
+        # Multikey index from frame buckets to the tracks present in them
+        self.ensureIndices([[[(DATASET, 1), (SET, 1), (FRAME_BUCKETS, 1)], {}]])
+
+    def prepare(self, record: dict):
+        """Store the summary fields, computed before features may be moved into chunks"""
+        features = record.get(FEATURES, [])
+        pairs = record.get('confidencePairs', [])
+        top = max(pairs, key=lambda pair: pair[1], default=None)
+        record['maxConfidence'] = top[1] if top else None
+        record['topLabel'] = top[0] if top else None
+        record['featureCount'] = len(features)
+        record['hasGeometry'] = any(feature.get('geometry') for feature in features)
+        record[FRAME_BUCKETS] = track_frame_buckets(record.get(BEGIN) or 0, record.get(END) or 0)
+
+    # Number of tracks whose chunks are fetched together
+    EXPAND_BATCH_SIZE = 100
+
+    def expand(
+        self,
+        dsFolder: types.GirderModel,
+        records: Iterable[dict],
+        visible: dict,
+        set: Optional[str] = None,
+        window: FrameWindow = (None, None),
+    ) -> Generator[dict, None, None]:
+        """Reassemble the features of chunked tracks, fetching chunks for batches of tracks"""
+        batch: List[dict] = []
+        for track in records:
+            batch.append(track)
+            if len(batch) >= self.EXPAND_BATCH_SIZE:
+                yield from self._fill_features(dsFolder, batch, visible, set, window)
+                batch = []
+        yield from self._fill_features(dsFolder, batch, visible, set, window)
+
+    def _fill_features(
+        self,
+        dsFolder: types.GirderModel,
+        batch: List[dict],
+        visible: dict,
+        set: Optional[str],
+        window: FrameWindow,
+    ) -> List[dict]:
+        chunked = [track for track in batch if track.get(FEATURE_CHUNKS)]
+        features: Dict[int, List[dict]] = {}
+        if chunked:
+            query = {
+                DATASET: dsFolder['_id'],
+                SET: set or None,
+                IDENTIFIER: {'$in': [track[IDENTIFIER] for track in chunked]},
+                **visible,
+            }
+            if window != (None, None):
+                query['$and'] = [
+                    {
+                        '$or': [
+                            {
+                                IDENTIFIER: track[IDENTIFIER],
+                                CHUNK: {'$in': window_chunks(track[FEATURE_CHUNKS], window)},
+                            }
+                            for track in chunked
+                        ]
+                    }
+                ]
+            for chunk in FeatureChunkItem().collection.find(
+                query,
+                {'_id': 0, IDENTIFIER: 1, FEATURES: 1},
+                sort=[(IDENTIFIER, 1), (CHUNK, 1)],
+            ):
+                features.setdefault(chunk[IDENTIFIER], []).extend(chunk[FEATURES])
+        for track in batch:
+            if track.pop(FEATURE_CHUNKS, None):
+                track[FEATURES] = features.get(track[IDENTIFIER], [])
+        return batch
+
 
 class GroupItem(BaseItem):
     PROJECT_FIELDS = {
@@ -74,17 +517,156 @@ class GroupItem(BaseItem):
     MODEL = models.GroupItemSchema
 
 
+class FeatureChunkItem(crud.PydanticModel):
+    """
+    Frame-range slices of the features of long tracks.
+
+    A track with more than FeatureChunkSize features is stored with an empty
+    features list and the indices of its chunks.  Chunks are versioned like
+    tracks, but a save only re-versions the chunks whose content changed.
+    """
+
+    PROJECT_FIELDS = {'_id': 0}
+
+    def initialize(self):
+        self._indices = [
+            [
+                [(DATASET, 1), (SET, 1), (IDENTIFIER, 1), (CHUNK, 1), (REVISION_CREATED, 1)],
+                {'unique': True},
+            ],
+            [
+                [(DATASET, 1), (SET, 1), (IDENTIFIER, 1), (CHUNK, 1)],
+                {'partialFilterExpression': {REVISION_HEAD: True}},
+            ],
+            [
+                [(DATASET, 1), (REVISION_DELETED, 1)],
+                {'partialFilterExpression': {REVISION_DELETED: {'$exists': True}}},
+            ],
+        ]
+        super().initialize("featureChunkItem", models.FeatureChunkItemSchema)
+
+
+class FeatureChunker:
+    """
+    Collect the feature chunk writes for the tracks in a single save.
+
+    Long tracks have their features moved out of the track document and split by
+    frame.  Chunks identical to the current head are left alone, so editing one
+    keyframe of a long track rewrites a single chunk.
+
+    A save in batches calls operations once per batch, each call covers the tracks
+    collected since the previous one.
+    """
+
+    # Maximum number of track ids per head chunk lookup
+    LOOKUP_BATCH_SIZE = 1000
+
+    def __init__(self, datasetId, set: Optional[str], revision: int, overwrite: bool):
+        self.base: dict = {DATASET: datasetId}
+        if set:
+            self.base[SET] = set
+        self.revision = revision
+        # An overwrite expires every head chunk before its first batch
+        self.overwrite = overwrite
+        self.touched: List[int] = []
+        self.pending: Dict[int, Dict[int, List[dict]]] = {}
+
+    def upsert(self, track: dict):
+        """Move the features of a long track into pending chunks"""
+        track.pop(FEATURE_CHUNKS, None)
+        self.touched.append(track[IDENTIFIER])
+        features = track.get(FEATURES, [])
+        if len(features) <= constants.FeatureChunkSize:
+            return
+        chunks: Dict[int, List[dict]] = {}
+        for feature in features:
+            chunks.setdefault(feature['frame'] // constants.FeatureChunkSize, []).append(feature)
+        self.pending[track[IDENTIFIER]] = chunks
+        track[FEATURES] = []
+        track[FEATURE_CHUNKS] = sorted(chunks.keys())
+
+    def delete(self, id: int):
+        self.touched.append(id)
+
+    def _head_chunks(self) -> Dict[Tuple[int, int], List[dict]]:
+        head: Dict[Tuple[int, int], List[dict]] = {}
+        for start in range(0, len(self.touched), self.LOOKUP_BATCH_SIZE):
+            ids = self.touched[start : start + self.LOOKUP_BATCH_SIZE]
+            for chunk in FeatureChunkItem().collection.find(
+                {**self.base, IDENTIFIER: {'$in': ids}, REVISION_HEAD: True},
+                {'_id': 0, IDENTIFIER: 1, CHUNK: 1, FEATURES: 1},
+            ):
+                head[(chunk[IDENTIFIER], chunk[CHUNK])] = chunk[FEATURES]
+        return head
+
+    def operations(self) -> list:
+        """Build the ordered chunk writes: expirations first, then inserts"""
+        expire_update = {
+            '$set': {REVISION_DELETED: self.revision},
+            '$unset': {REVISION_HEAD: ""},
+        }
+        expire_operations = []
+        insert_operations = []
+        head: Dict[Tuple[int, int], List[dict]] = {}
+        if self.touched and not self.overwrite:
+            head = self._head_chunks()
+
+        for (id, chunk), features in head.items():
+            new_features = self.pending.get(id, {}).get(chunk)
+            if new_features is None or not _same_features(new_features, features):
+                expire_operations.append(
+                    pymongo.UpdateMany(
+                        {**self.base, IDENTIFIER: id, CHUNK: chunk, REVISION_HEAD: True},
+                        expire_update,
+                    )
+                )
+        for id, chunks in self.pending.items():
+            for chunk, features in chunks.items():
+                old_features = head.get((id, chunk))
+                if old_features is not None and _same_features(features, old_features):
+                    continue
+                insert_operations.append(
+                    pymongo.InsertOne(
+                        {
+                            **self.base,
+                            IDENTIFIER: id,
+                            CHUNK: chunk,
+                            FEATURES: features,
+                            REVISION_CREATED: self.revision,
+                            REVISION_HEAD: True,
+                        }
+                    )
+                )
+        self.touched = []
+        self.pending = {}
+        return expire_operations + insert_operations
+
+
+def _same_features(a: List[dict], b: List[dict]) -> bool:
+    """Compare feature lists by their stored form, so tuples and lists compare equal"""
+    return bson.encode({FEATURES: a}) == bson.encode({FEATURES: b})
+
+
 class RevisionLogItem(crud.PydanticModel):
     PROJECT_FIELDS = {'_id': 0}
 
     def initialize(self):
         self._indices = [
             [[(DATASET, 1), (REVISION, 1)], {'unique': True}],
+            [[(DATASET, 1), (SET, 1), (REVISION, 1)], {}],
             [[('created', 1)], {}],
         ]
         super().initialize("revisionLogItem", models.RevisionLog)
 
     def latest(self, dsFolder: types.GirderModel, set: Optional[str] = None) -> int:
+        """Latest revision of the dataset, or the latest that could have changed set"""
+        head = RevisionCounterItem().head(dsFolder, set)
+        if head is not None:
+            return head
+        return self.latest_logged(dsFolder, set)
+
+    def latest_logged(self, dsFolder: types.GirderModel, set: Optional[str] = None) -> int:
+        """Find the latest revision by scanning the log rather than the counter"""
         query = {DATASET: dsFolder['_id']}
         if set:
             query[SET] = set
@@ -99,12 +681,18 @@ class RevisionLogItem(crud.PydanticModel):
         sort=DEFAULT_REVISION_SORT,
         before: Optional[int] = None,
         set: Optional[str] = None,
-    ) -> Tuple[Cursor, int]:
+        continuation: Optional[str] = None,
+        count=True,
+    ) -> Tuple[Cursor, Optional[int]]:
         query: dict = {DATASET: dsFolder['_id']}
         if before is not None:
             query[REVISION] = {'$lte': before}
         if set:
             query[SET] = set
+        total = self.collection.count_documents(query) if count else None
+        keyset = crud.keyset_query(sort, REVISION, continuation)
+        if keyset:
+            query[REVISION] = {**query.get(REVISION, {}), **keyset[REVISION]}
         cursor = self.find(
             offset=offset,
             limit=limit,
@@ -112,40 +700,866 @@ class RevisionLogItem(crud.PydanticModel):
             query=query,
             fields=RevisionLogItem.PROJECT_FIELDS,
         )
-        total = self.find(query=query).count()
         return cursor, total
 
-    def sets(
+    def sets(self, dsFolder: types.GirderModel) -> List[Optional[str]]:
+        """Names of all sets that have been saved, including those read from a clone's source"""
+        names = RevisionCounterItem().sets(dsFolder)
+        source = annotation_source(dsFolder)
+        if source is not None:
+            sourceId, pinned = source
+            inherited = self.collection.distinct(
+                SET, {DATASET: sourceId['_id'], REVISION: {'$lte': pinned}}
+            )
+            inherited = dict.fromkeys(name or None for name in inherited)
+            names += [name for name in inherited if name not in names]
+        return names
+
+
+class RevisionCounterItem(crud.PydanticModel):
+    """
+    One document per dataset holding the highest allocated revision and the
+    highest committed (head) revision.  Allocation is a single atomic increment,
+    so concurrent saves can never be handed the same revision.
+
+    Saves to a dataset run concurrently.  Each allocated revision stays pending until
+    it is committed, released or aborted, and the head only advances past a revision
+    once every older one is done, so reads never see a save that is partly written.
+    Saves that conflict are found by verify_concurrent before they commit.
+
+    The document also lists every set saved to the dataset with its own head, the
+    latest revision that could have changed it.
+    """
+
+    PROJECT_FIELDS = {'_id': 0}
+
+    def initialize(self):
+        self._indices = [
+            [[(DATASET, 1)], {'unique': True}],
+        ]
+        super().initialize("revisionCounterItem", models.RevisionCounter)
+
+    @staticmethod
+    def logged_set_heads(match: dict) -> Iterable[dict]:
+        """Per-set heads found by scanning the log, grouped by dataset"""
+        # Older entries of the default set hold '', count them with those that hold None
+        default_set = {'$cond': [{'$eq': [{'$ifNull': [f'${SET}', '']}, '']}, None, f'${SET}']}
+        return RevisionLogItem().collection.aggregate(
+            [
+                {'$match': match},
+                {'$group': {'_id': [f'${DATASET}', default_set], HEAD: {'$max': f'${REVISION}'}}},
+                {
+                    '$group': {
+                        '_id': {'$first': '$_id'},
+                        SETS: {'$push': {SET: {'$last': '$_id'}, HEAD: f'${HEAD}'}},
+                    }
+                },
+            ]
+        )
+
+    def _seed(self, dsFolder: types.GirderModel):
+        """Create the counter for a dataset that predates it, starting from the log"""
+        latest = RevisionLogItem().latest_logged(dsFolder)
+        heads = next(iter(self.logged_set_heads({DATASET: dsFolder['_id']})), {SETS: []})
+        try:
+            self.collection.update_one(
+                {DATASET: dsFolder['_id']},
+                {'$max': {REVISION: latest, HEAD: latest}, '$setOnInsert': {SETS: heads[SETS]}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # A concurrent request created the counter first
+            pass
+
+    def allocate(
         self,
         dsFolder: types.GirderModel,
-        limit=0,
-        offset=0,
-        sort=DEFAULT_REVISION_SORT,
-    ) -> Tuple[Cursor, int]:
-        query: dict = {DATASET: dsFolder['_id']}
-        cursor = self.find(
-            offset=offset,
-            limit=limit,
-            sort=sort,
-            query=query,
-            fields=RevisionLogItem.PROJECT_FIELDS,
-        ).distinct(SET)
-        return cursor
+        set: Optional[str] = None,
+        overwrite: bool = False,
+        exclusive: bool = False,
+    ) -> Tuple[int, int]:
+        """
+        Reserve the next revision number for a dataset and register it as pending.
+
+        The revision must be finished with commit, release or abort, and its lease
+        renewed with renew while it is written.  A revision whose lease ran out
+        belongs to a save that died, so its writes are undone.  Nothing waits: a save
+        that cannot start alongside the pending ones is rejected right away.
+
+        :param set: set the save writes to, or None when it can write to every set
+        :param overwrite: the save replaces every annotation of its set, so saves to
+            that set allocated after it are rejected until it is done
+        :param exclusive: reject the save if any other save to the dataset is pending,
+            and the saves allocated after it until it is done
+        :returns: the revision, and the head it was allocated at
+        """
+        now = datetime.utcnow()
+        entry = {
+            SET: set or None,
+            OVERWRITE: overwrite,
+            EXCLUSIVE: exclusive,
+            COMMITTED: False,
+            EXPIRES: now + timedelta(seconds=SAVE_LEASE_TIMEOUT),
+        }
+        counter = None
+        while counter is None:
+            counter = self.collection.find_one_and_update(
+                {DATASET: dsFolder['_id']},
+                [
+                    {'$set': {REVISION: {'$add': [f'${REVISION}', 1]}}},
+                    {
+                        '$set': {
+                            PENDING: {
+                                '$concatArrays': [
+                                    {'$ifNull': [f'${PENDING}', []]},
+                                    [
+                                        {
+                                            REVISION: f'${REVISION}',
+                                            **{k: {'$literal': v} for k, v in entry.items()},
+                                        }
+                                    ],
+                                ]
+                            }
+                        }
+                    },
+                ],
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+            if counter is None:
+                self._seed(dsFolder)
+        revision = counter[REVISION]
+        self._undo_abandoned(dsFolder, counter[PENDING], now)
+        for other in counter[PENDING]:
+            if other[REVISION] == revision or other[COMMITTED] or other[EXPIRES] < now:
+                continue
+            blocks = other.get(EXCLUSIVE) or (other[OVERWRITE] and overlaps(other[SET], set))
+            if exclusive or (blocks and other[REVISION] < revision):
+                self.release(dsFolder, revision)
+                raise RestException(
+                    f'Revision {other[REVISION]} of this dataset is still being saved '
+                    'and conflicts with this save, try again once it is done',
+                    code=409,
+                )
+        return revision, counter[HEAD]
+
+    def _undo_abandoned(self, dsFolder: types.GirderModel, pending: List[dict], now: datetime):
+        """Undo and drop the pending revisions whose lease ran out"""
+        for entry in pending:
+            if entry[COMMITTED] or entry[EXPIRES] >= now:
+                continue
+            # The revision holds the head back until its writes are undone
+            undo_revision(dsFolder, entry[REVISION])
+            self.release(dsFolder, entry[REVISION])
+
+    def pending(self, dsFolder: types.GirderModel) -> List[dict]:
+        """Revisions of the dataset that the head does not cover yet"""
+        counter = self.collection.find_one({DATASET: dsFolder['_id']}, {PENDING: 1}) or {}
+        return counter.get(PENDING, [])
+
+    def _lease_query(self, dsFolder: types.GirderModel, revision: int) -> dict:
+        # Matches while the save of revision may still write, with its lease held
+        lease = {REVISION: revision, COMMITTED: False, EXPIRES: {'$gt': datetime.utcnow()}}
+        return {DATASET: dsFolder['_id'], PENDING: {'$elemMatch': lease}}
+
+    def renew(self, dsFolder: types.GirderModel, revision: int):
+        """Extend the lease of a pending revision, called before every batch of its writes"""
+        result = self.collection.update_one(
+            self._lease_query(dsFolder, revision),
+            {
+                '$set': {
+                    f'{PENDING}.$.{EXPIRES}': datetime.utcnow()
+                    + timedelta(seconds=SAVE_LEASE_TIMEOUT)
+                }
+            },
+        )
+        if not result.matched_count:
+            raise RestException(f'Revision {revision} timed out and was abandoned', code=409)
+
+    def release(self, dsFolder: types.GirderModel, revision: int):
+        """Drop a pending revision that made no changes, or whose writes were undone"""
+        self.collection.update_one(
+            {DATASET: dsFolder['_id']},
+            {'$pull': {PENDING: {REVISION: revision, COMMITTED: False}}},
+        )
+        self._advance(dsFolder)
+
+    def abort(self, dsFolder: types.GirderModel, revision: int):
+        """Undo the writes of a save that failed before it was committed"""
+        undo_revision(dsFolder, revision)
+        self.release(dsFolder, revision)
+
+    def commit(self, dsFolder: types.GirderModel, revision: int, set: Optional[str] = None):
+        """
+        Mark a revision committed once it has been logged, and advance the head of the
+        dataset as far as the older pending revisions allow.  Set heads are raised
+        first, and reads of a set never go past the dataset head.
+        """
+        query = {DATASET: dsFolder['_id']}
+        self._commit_sets(query, revision, set)
+        committed = self.collection.update_one(
+            self._lease_query(dsFolder, revision),
+            {'$set': {f'{PENDING}.$.{COMMITTED}': True}},
+        )
+        if not committed.matched_count:
+            raise RestException(f'Revision {revision} timed out and was abandoned', code=409)
+        self._advance(dsFolder)
+
+    def _advance(self, dsFolder: types.GirderModel):
+        """Raise the head to just below the oldest revision that is not committed"""
+        pending = {'$ifNull': [f'${PENDING}', []]}
+        unfinished = {'$filter': {'input': pending, 'cond': {'$not': [f'$$this.{COMMITTED}']}}}
+        self.collection.update_one(
+            {DATASET: dsFolder['_id']},
+            [
+                {
+                    '$set': {
+                        HEAD: {
+                            '$max': [
+                                f'${HEAD}',
+                                {
+                                    '$let': {
+                                        'vars': {'unfinished': unfinished},
+                                        'in': {
+                                            '$cond': [
+                                                {'$gt': [{'$size': '$$unfinished'}, 0]},
+                                                {
+                                                    '$subtract': [
+                                                        {'$min': f'$$unfinished.{REVISION}'},
+                                                        1,
+                                                    ]
+                                                },
+                                                f'${REVISION}',
+                                            ]
+                                        },
+                                    }
+                                },
+                            ]
+                        }
+                    }
+                },
+                {
+                    '$set': {
+                        PENDING: {
+                            '$filter': {
+                                'input': pending,
+                                'cond': {'$gt': [f'$$this.{REVISION}', f'${HEAD}']},
+                            }
+                        }
+                    }
+                },
+            ],
+        )
+
+    def _commit_sets(self, query: dict, revision: int, set: Optional[str]):
+        # The default set is saved as '' but rolled back as None, both are stored as None
+        set = set or None
+        if not set:
+            # Saves without a set can expire records of every set
+            self.collection.update_one(
+                {**query, SETS: {'$type': 'array'}}, {'$max': {f'{SETS}.$[].{HEAD}': revision}}
+            )
+        # Either raise the set's existing head or add the set.  When a racing save adds
+        # the set first, the second attempt raises it.
+        entry = {'$elemMatch': {SET: set}}
+        for _ in range(2):
+            raised = self.collection.update_one(
+                {**query, SETS: entry}, {'$max': {f'{SETS}.$.{HEAD}': revision}}
+            )
+            if raised.matched_count:
+                return
+            added = self.collection.update_one(
+                {**query, SETS: {'$not': entry}}, {'$push': {SETS: {SET: set, HEAD: revision}}}
+            )
+            if added.matched_count:
+                return
+
+    def head(self, dsFolder: types.GirderModel, set: Optional[str] = None) -> Optional[int]:
+        """
+        Head of the dataset, or of set if given, None for datasets without a counter.
+        A set's head can be ahead of the dataset head while an older save is pending,
+        so it is capped at the dataset head.
+        """
+        if not set:
+            result = self.collection.find_one({DATASET: dsFolder['_id']}, {HEAD: 1})
+            return None if result is None else result[HEAD]
+        result = self.collection.find_one(
+            {DATASET: dsFolder['_id']}, {HEAD: 1, SETS: {'$elemMatch': {SET: set}}}
+        )
+        if result is None:
+            return None
+        # A set that was never saved is empty at every revision
+        return min(result[SETS][0][HEAD], result[HEAD]) if result.get(SETS) else 0
 
+    def sets(self, dsFolder: types.GirderModel) -> List[Optional[str]]:
+        result = self.collection.find_one({DATASET: dsFolder['_id']}, {SETS: 1})
+        if result is None:
+            self._seed(dsFolder)
+            result = self.collection.find_one({DATASET: dsFolder['_id']}, {SETS: 1})
+        # Counters written before the default set was stored as None can list it twice
+        return list(dict.fromkeys(entry[SET] or None for entry in result.get(SETS, [])))
 
-def rollback(dsFolder: types.GirderModel, revision: int):
-    """Reset to previous revision."""
-    # TODO implement immutabble forward-rollback (like git revert)
-    # Logic: delete everything created after revision
-    # And erase deletions for anything deleted after revision
+    def compacted(self, dsFolder: types.GirderModel) -> int:
+        """Oldest revision that can still be read, history before it was compacted"""
+        result = self.collection.find_one({DATASET: dsFolder['_id']}, {COMPACTED: 1}) or {}
+        return result.get(COMPACTED, 0)
+
+    def mark_compacted(self, dsFolder: types.GirderModel, revision: int):
+        self._seed(dsFolder)
+        self.collection.update_one({DATASET: dsFolder['_id']}, {'$max': {COMPACTED: revision}})
+
+
+# Stands for "no live track" when comparing the labels of a track before and after a save
+_NO_TRACK = object()
+
+
+class LabelCountItem(crud.PydanticModel):
+    """
+    Rollup of the number of live tracks per (dataset, label).
+
+    A track's label is the type of its first confidence pair.  Saves adjust
+    the counts by the records they expired and inserted, so label queries
+    never need to scan trackItem.
+    """
+
+    PROJECT_FIELDS = {'_id': 0}
+
+    def initialize(self):
+        self._indices = [
+            [[(DATASET, 1), ('label', 1)], {'unique': True}],
+        ]
+        super().initialize("labelCountItem", models.LabelCount)
+
+    def _count(self, match: dict) -> Dict[Optional[str], int]:
+        pipeline = [
+            {'$match': {**match, TOMBSTONE: {'$ne': True}}},
+            {'$group': {'_id': {'$first': {'$first': '$confidencePairs'}}, 'count': {'$sum': 1}}},
+        ]
+        return {row['_id']: row['count'] for row in TrackItem().collection.aggregate(pipeline)}
+
+    def _labels(self, match: dict) -> Dict[int, Optional[str]]:
+        """Label of each matched track by id, with tombstones mapped to _NO_TRACK"""
+        pipeline = [
+            {'$match': match},
+            {
+                '$project': {
+                    '_id': 0,
+                    IDENTIFIER: 1,
+                    TOMBSTONE: 1,
+                    'label': {'$first': {'$first': '$confidencePairs'}},
+                }
+            },
+        ]
+        return {
+            row[IDENTIFIER]: _NO_TRACK if row.get(TOMBSTONE) else row.get('label')
+            for row in TrackItem().collection.aggregate(pipeline)
+        }
+
+    def _increment(self, dsFolder: types.GirderModel, delta: Dict[Optional[str], int]):
+        dsId = dsFolder['_id']
+        operations = [
+            pymongo.UpdateOne(
+                {DATASET: dsId, 'label': label}, {'$inc': {'count': count}}, upsert=True
+            )
+            for label, count in delta.items()
+            if count
+        ]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+            self.collection.delete_many({DATASET: dsId, 'count': {'$lte': 0}})
+
+    def apply_revision(self, dsFolder: types.GirderModel, revision: int):
+        """Adjust counts by the tracks a save expired and inserted at revision"""
+        dsId = dsFolder['_id']
+        source = annotation_source(dsFolder)
+        if source is None:
+            delta = self._count({DATASET: dsId, REVISION_CREATED: revision})
+            for label, count in self._count({DATASET: dsId, REVISION_DELETED: revision}).items():
+                delta[label] = delta.get(label, 0) - count
+            self._increment(dsFolder, delta)
+            return
+        # In a clone, a track without a record of its own at this revision is the source one
+        created = self._labels({DATASET: dsId, REVISION_CREATED: revision})
+        expired = self._labels({DATASET: dsId, REVISION_DELETED: revision})
+        sourceFolder, pinned = source
+        one_sided = [id for id in {**created, **expired} if (id in created) != (id in expired)]
+        source_labels = self._labels(
+            {
+                DATASET: sourceFolder['_id'],
+                IDENTIFIER: {'$in': one_sided},
+                **revision_query(sourceFolder, pinned),
+            }
+        )
+        delta = {}
+        for id in {**created, **expired}:
+            old = expired[id] if id in expired else source_labels.get(id, _NO_TRACK)
+            new = created[id] if id in created else source_labels.get(id, _NO_TRACK)
+            if old is not _NO_TRACK:
+                delta[old] = delta.get(old, 0) - 1
+            if new is not _NO_TRACK:
+                delta[new] = delta.get(new, 0) + 1
+        self._increment(dsFolder, delta)
+
+    def rebuild(self, dsFolder: types.GirderModel):
+        """Recount a dataset from its head tracks, after history has been rewritten"""
+        dsId = dsFolder['_id']
+        head = {DATASET: dsId, REVISION_HEAD: True}
+        counts = self._count(head)
+        source = annotation_source(dsFolder)
+        if source is not None:
+            sourceFolder, pinned = source
+            shadowed = TrackItem().collection.distinct(IDENTIFIER, head)
+            source_counts = self._count(
+                {
+                    DATASET: sourceFolder['_id'],
+                    IDENTIFIER: {'$nin': shadowed},
+                    **revision_query(sourceFolder, pinned),
+                }
+            )
+            for label, count in source_counts.items():
+                counts[label] = counts.get(label, 0) + count
+        self.collection.delete_many({DATASET: dsId})
+        if counts:
+            self.collection.insert_many(
+                [{DATASET: dsId, 'label': label, 'count': count} for label, count in counts.items()]
+            )
+
+    def clone(self, source: types.GirderModel, dest: types.GirderModel, atHead: bool):
+        """Start the counts of a new copy-on-write clone from its source"""
+        if not atHead:
+            self.rebuild(dest)
+            return
+        rows = self.collection.find({DATASET: source['_id']}, {'_id': 0, 'label': 1, 'count': 1})
+        copied = [{**row, DATASET: dest['_id']} for row in rows]
+        if copied:
+            self.collection.insert_many(copied)
+
+    def rebuild_all(self):
+        """Recount every dataset, used to populate the rollup for existing data"""
+        self.collection.delete_many({})
+        pipeline = [
+            {'$match': {REVISION_HEAD: True, TOMBSTONE: {'$ne': True}}},
+            {
+                '$group': {
+                    '_id': {
+                        DATASET: '$dataset',
+                        'label': {'$first': {'$first': '$confidencePairs'}},
+                    },
+                    'count': {'$sum': 1},
+                }
+            },
+            {'$project': {'_id': 0, DATASET: '$_id.dataset', 'label': '$_id.label', 'count': 1}},
+            {'$merge': {'into': 'labelCountItem'}},
+        ]
+        TrackItem().collection.aggregate(pipeline)
+
+
+def verify_revision_available(dsFolder: types.GirderModel, revision: int):
+    """Raise if the history needed to reconstruct a revision has been compacted"""
+    floor = RevisionCounterItem().compacted(dsFolder)
+    if revision < floor:
+        raise RestException(
+            f'Revision {revision} is no longer available, history before revision {floor} '
+            'has been compacted'
+        )
+
+
+def undo_revision(dsFolder: types.GirderModel, revision: int):
+    """
+    Remove every write of a revision that was never committed, including the records
+    it copied in with materialize_clone.
+
+    The records it expired are restored, except those of a set that a later overwrite
+    started since.  That overwrite skipped them as expired already, so they are
+    expired by it instead.
+    """
+    datasetId = dsFolder['_id']
+    overwrites = sorted(
+        (entry[REVISION], entry[SET])
+        for entry in RevisionCounterItem().pending(dsFolder)
+        if entry[OVERWRITE] and entry[REVISION] > revision
+    )
+    for model in [TrackItem(), GroupItem(), FeatureChunkItem()]:
+        model.collection.delete_many({DATASET: datasetId, REVISION_CREATED: revision})
+        model.collection.delete_many({DATASET: datasetId, REVISION_COPIED: revision})
+        expired = {DATASET: datasetId, REVISION_DELETED: revision}
+        for overwrite, set in overwrites:
+            model.collection.update_many(
+                {**expired, **({SET: set} if set else {})},
+                {'$set': {REVISION_DELETED: overwrite}},
+            )
+        model.collection.update_many(
+            expired, {'$unset': {REVISION_DELETED: ""}, '$set': {REVISION_HEAD: True}}
+        )
+    RevisionLogItem().collection.delete_many({DATASET: datasetId, REVISION: revision})
+    LabelCountItem().rebuild(dsFolder)
+
+
+def rollback_size(dsFolder: types.GirderModel, revision: int) -> int:
+    """Number of track and group records a rollback to revision has to expire or restore"""
+    total = 0
+    for model in [TrackItem(), GroupItem()]:
+        total += model.collection.count_documents(_rollback_expire_query(dsFolder, revision))
+        total += model.collection.count_documents(_rollback_restore_query(dsFolder, revision))
+    return total
+
+
+def _rollback_expire_query(dsFolder: types.GirderModel, revision: int) -> dict:
+    # Live records created after the target revision
+    return {DATASET: dsFolder['_id'], REVISION_CREATED: {'$gt': revision}, REVISION_HEAD: True}
+
+
+def _rollback_restore_query(dsFolder: types.GirderModel, revision: int) -> dict:
+    # Records that were live at the target revision and have been deleted since
+    return {
+        DATASET: dsFolder['_id'],
+        REVISION_DELETED: {'$gt': revision},
+        REVISION_CREATED: {'$lte': revision},
+    }
+
+
+def rollback(
+    dsFolder: types.GirderModel,
+    user: types.GirderUserModel,
+    revision: int,
+    progress: Optional[Callable[[int, int], None]] = None,
+):
+    """
+    Revert to a previous revision by writing a new revision, like git revert.
+
+    Only records that differ between the target and head are touched: live records
+    created after the target are expired, and copies of records deleted after the
+    target are inserted in ordered batches.  History is preserved, so a rollback
+    can itself be rolled back.
+
+    :param progress: called with (records done, records total) after each batch
+    """
+    verify_revision_available(dsFolder, revision)
+    # A rollback expires and restores records across every set, based on what it read
+    # before writing, so no other save may run alongside it
+    new_revision, _ = RevisionCounterItem().allocate(dsFolder, exclusive=True)
+    try:
+        return _write_rollback(dsFolder, user, revision, new_revision, progress)
+    except Exception:
+        RevisionCounterItem().abort(dsFolder, new_revision)
+        raise
+
+
+def _write_rollback(
+    dsFolder: types.GirderModel,
+    user: types.GirderUserModel,
+    revision: int,
+    new_revision: int,
+    progress: Optional[Callable[[int, int], None]],
+):
+    datasetId = dsFolder['_id']
+    expire_update = {
+        '$set': {REVISION_DELETED: new_revision},
+        '$unset': {REVISION_HEAD: ""},
+    }
+    models_to_revert = [TrackItem(), GroupItem(), FeatureChunkItem()]
+    total = sum(
+        model.collection.count_documents(_rollback_expire_query(dsFolder, revision))
+        + model.collection.count_documents(_rollback_restore_query(dsFolder, revision))
+        for model in models_to_revert
+    )
+    done = 0
+    counts = {}
+    for model in models_to_revert:
+        # Expire first so the head never holds two versions of a record
+        expired = expire_batched(
+            model, _rollback_expire_query(dsFolder, revision), expire_update, dsFolder, new_revision
+        )
+        done += expired
+        restored = 0
+        batch: List[dict] = []
+        restore_cursor = model.collection.find(
+            _rollback_restore_query(dsFolder, revision),
+            {'_id': 0, REVISION_DELETED: 0},
+        )
+        for record in restore_cursor:
+            record.update({REVISION_CREATED: new_revision, REVISION_HEAD: True})
+            batch.append(record)
+            if len(batch) >= ROLLBACK_BATCH_SIZE:
+                RevisionCounterItem().renew(dsFolder, new_revision)
+                restored += len(model.collection.insert_many(batch, ordered=True).inserted_ids)
+                batch = []
+                if progress:
+                    progress(done + restored, total)
+        if batch:
+            RevisionCounterItem().renew(dsFolder, new_revision)
+            restored += len(model.collection.insert_many(batch, ordered=True).inserted_ids)
+        done += restored
+        if progress:
+            progress(done, total)
+        counts[model.name] = (restored, expired)
+
+    additions = counts[TrackItem().name][0] + counts[GroupItem().name][0]
+    deletions = counts[TrackItem().name][1] + counts[GroupItem().name][1]
+    if additions or deletions:
+        RevisionCounterItem().renew(dsFolder, new_revision)
+        LabelCountItem().apply_revision(dsFolder, new_revision)
+        log_entry = models.RevisionLog(
+            dataset=datasetId,
+            author_name=user['login'],
+            author_id=user['_id'],
+            revision=new_revision,
+            additions=additions,
+            deletions=deletions,
+            description=f"Rollback to revision {revision}",
+        )
+        RevisionLogItem().create(log_entry)
+        RevisionCounterItem().commit(dsFolder, new_revision)
+        cache.annotations.invalidate(datasetId)
+    else:
+        RevisionCounterItem().release(dsFolder, new_revision)
+    return {"updated": additions, "deleted": deletions}
+
+
+def schedule_rollback_job(dsFolder: types.GirderModel, user: types.GirderUserModel, revision: int):
+    """Run a rollback as a local girder job so that the request returns right away"""
+    verify_revision_available(dsFolder, revision)
+    job = Job().createLocalJob(
+        module='dive_server.crud_annotation',
+        function='run_rollback_job',
+        title=f'Rollback {dsFolder["name"]} to revision {revision}',
+        type='rollback',
+        user=user,
+        kwargs={
+            'folderId': str(dsFolder['_id']),
+            'userId': str(user['_id']),
+            'revision': revision,
+        },
+        asynchronous=True,
+    )
+    job[constants.JOBCONST_DATASET_ID] = str(dsFolder['_id'])
+    job[constants.JOBCONST_CREATOR] = str(user['_id'])
+    Job().copyAccessPolicies(dsFolder, job)
+    job = Job().save(job)
+    Job().scheduleJob(job)
+    return job
+
+
+def run_rollback_job(job: dict):
+    """Entry point of the local job created by schedule_rollback_job"""
+    job = Job().updateJob(job, status=JobStatus.RUNNING)
+    kwargs = job['kwargs']
+
+    def progress(current: int, total: int):
+        nonlocal job
+        job = Job().updateJob(job, progressCurrent=current, progressTotal=total)
+
+    try:
+        dsFolder = Folder().load(kwargs['folderId'], force=True)
+        user = User().load(kwargs['userId'], force=True)
+        result = rollback(dsFolder, user, kwargs['revision'], progress=progress)
+        Job().updateJob(
+            job,
+            status=JobStatus.SUCCESS,
+            log=f'Rollback complete: {result["updated"]} restored, {result["deleted"]} removed\n',
+        )
+    except Exception as err:
+        Job().updateJob(job, status=JobStatus.ERROR, log=f'{err}\n')
+        raise
+
+
+def compact_revisions(
+    dsFolder: types.GirderModel,
+    keep: Optional[int] = None,
+    before: Optional[datetime] = None,
+) -> dict:
+    """
+    Permanently discard revision history that is older than a floor revision.
+
+    The floor is the oldest revision that stays readable: either the last `keep`
+    logged revisions are kept, or every revision newer than `before` plus the state
+    at that time.  When both are given, the one that keeps more history wins.
+    Records that were already deleted at the floor are purged and older log
+    entries are folded into the floor entry.
+
+    :returns: counts of purged documents and the number of bytes they occupied
+    """
+    if keep is None and before is None:
+        raise RestException('Either keep or before is required to compact revisions')
+    if keep is not None and keep < 1:
+        raise RestException('keep must be at least 1')
     dsId = dsFolder['_id']
-    RevisionLogItem().removeWithQuery({DATASET: dsId, REVISION: {'$gt': revision}})
-    listQuery = {DATASET: dsId, REVISION_CREATED: {'$gt': revision}}
-    updateQuery = {'$unset': {REVISION_DELETED: ""}}
-    TrackItem().removeWithQuery(listQuery)
-    TrackItem().update(listQuery, updateQuery)
-    GroupItem().removeWithQuery(listQuery)
-    GroupItem().update(listQuery, updateQuery)
+    logItem = RevisionLogItem()
+    floors = []
+    if keep is not None:
+        nth = logItem.collection.find_one(
+            {DATASET: dsId}, sort=[(REVISION, pymongo.DESCENDING)], skip=keep - 1
+        )
+        floors.append(nth[REVISION] if nth else 0)
+    if before is not None:
+        last_before = logItem.findOne(
+            {DATASET: dsId, 'created': {'$lt': before}}, sort=[[REVISION, pymongo.DESCENDING]]
+        )
+        floors.append(last_before[REVISION] if last_before else 0)
+    # Keep the snapshots that copy-on-write clones read from
+    pins = Folder().find(
+        {constants.AnnotationSourceIdMarker: str(dsId)},
+        fields=[constants.AnnotationSourceRevisionMarker],
+    )
+    floor = min([*floors, *(clone[constants.AnnotationSourceRevisionMarker] for clone in pins)])
+    result = {
+        'revision': floor,
+        'tracks': 0,
+        'groups': 0,
+        'chunks': 0,
+        'revisions': 0,
+        'bytes': 0,
+    }
+    if floor <= RevisionCounterItem().compacted(dsFolder):
+        return result
+
+    def purge(model: crud.PydanticModel, query: dict) -> int:
+        sizes = list(
+            model.collection.aggregate(
+                [
+                    {'$match': query},
+                    {'$group': {'_id': None, 'bytes': {'$sum': {'$bsonSize': '$$ROOT'}}}},
+                ]
+            )
+        )
+        if sizes:
+            result['bytes'] += sizes[0]['bytes']
+        return model.collection.delete_many(query).deleted_count
+
+    # Mark the floor first so that no reader can observe a partially purged revision
+    RevisionCounterItem().mark_compacted(dsFolder, floor)
+    expiredQuery = {DATASET: dsId, REVISION_DELETED: {'$lte': floor}}
+    result['tracks'] = purge(TrackItem(), expiredQuery)
+    result['groups'] = purge(GroupItem(), expiredQuery)
+    result['chunks'] = purge(FeatureChunkItem(), expiredQuery)
+
+    folded = logItem.collection.aggregate(
+        [
+            {'$match': {DATASET: dsId, REVISION: {'$lt': floor}}},
+            {
+                '$group': {
+                    '_id': None,
+                    'additions': {'$sum': '$additions'},
+                    'deletions': {'$sum': '$deletions'},
+                }
+            },
+        ]
+    )
+    for totals in folded:
+        logItem.collection.update_one(
+            {DATASET: dsId, REVISION: floor},
+            {
+                '$inc': {'additions': totals['additions'], 'deletions': totals['deletions']},
+                '$set': {'description': f'History compacted through revision {floor}'},
+            },
+        )
+    result['revisions'] = purge(logItem, {DATASET: dsId, REVISION: {'$lt': floor}})
+    cache.annotations.invalidate(dsId)
+    return result
+
+
+def conditional_annotation_response(
+    dsFolder: types.GirderModel,
+    revision: Optional[int],
+    key: list,
+    immutable: bool = True,
+    set: Optional[str] = None,
+) -> int:
+    """
+    Revision-keyed ETag for an annotation read, see crud.conditional_response.
+
+    This costs one head lookup.  Reads of a set use the head of that set, so saves to
+    other sets keep their ETags and cache entries valid.  Clones use the dataset head,
+    since their sets may only exist in the source.  Reads at an explicit revision no
+    later than the head never change.
+
+    :returns: the revision the response should be read at
+    """
+    if set and annotation_source(dsFolder) is None:
+        head = RevisionLogItem().latest(dsFolder, set)
+    else:
+        head = RevisionLogItem().latest(dsFolder)
+    pinned = revision is not None and revision <= head
+    read = revision if pinned else head
+    crud.conditional_response([str(dsFolder['_id']), read, *key], immutable and pinned)
+    return read
+
+
+def get_changes(dsFolder: types.GirderModel, since: int, set: Optional[str] = None) -> dict:
+    """
+    Get the tracks and groups that changed after revision `since`.
+    The result has the same upsert/delete shape as an annotation update.
+    """
+    head = RevisionLogItem().latest(dsFolder)
+    if since < 0 or since > head:
+        raise RestException(f'since={since} must be between 0 and the head revision {head}')
+    verify_revision_available(dsFolder, since)
+    upsert_tracks, delete_tracks = TrackItem().changes(dsFolder, since, head, set)
+    upsert_groups, delete_groups = GroupItem().changes(dsFolder, since, head, set)
+    return {
+        'since': since,
+        'revision': head,
+        'tracks': {'upsert': upsert_tracks, 'delete': delete_tracks},
+        'groups': {'upsert': upsert_groups, 'delete': delete_groups},
+    }
+
+
+def _confidence_pair_query(label, minimum: float) -> dict:
+    # Pairs are stored as [type, confidence] arrays, matched by position
+    return {'confidencePairs': {'$elemMatch': {'0': label, '1': {'$gte': minimum}}}}
+
+
+def threshold_query(
+    thresholds: Optional[Dict[str, float]], typeFilter: Optional[Iterable[str]] = None
+) -> dict:
+    """Mongo query matching the annotations for which exceeds_thresholds would be true"""
+    thresholds = thresholds or {}
+    default = thresholds.get('default', 0)
+    if typeFilter:
+        # Only a pair of one of the filtered types can exceed its threshold
+        clauses = [
+            _confidence_pair_query(t, thresholds.get(t, default)) for t in sorted(typeFilter)
+        ]
+    else:
+        named = sorted(key for key in thresholds if key != 'default')
+        clauses = [_confidence_pair_query(t, thresholds[t]) for t in named]
+        clauses.append(_confidence_pair_query({'$nin': named}, default))
+    return {'$or': clauses}
+
+
+def type_query(typeFilter: Iterable[str]) -> dict:
+    """Mongo query matching the annotations with at least one type in typeFilter"""
+    return {'confidencePairs': {'$elemMatch': {'0': {'$in': sorted(typeFilter)}}}}
+
+
+def export_filter_query(
+    thresholds: Optional[Dict[str, float]],
+    excludeBelowThreshold: bool,
+    typeFilter: Optional[Iterable[str]],
+    thresholdTypes: Optional[Iterable[str]] = None,
+) -> Optional[dict]:
+    """
+    Combine the export threshold and type filters into one query, so that
+    filtered out tracks are never read from the database.
+
+    :param thresholdTypes: passed to threshold_query as its typeFilter
+    """
+    clauses = []
+    if excludeBelowThreshold:
+        clauses.append(threshold_query(thresholds, thresholdTypes))
+    if typeFilter:
+        clauses.append(type_query(typeFilter))
+    if not clauses:
+        return None
+    return {'$and': clauses}
+
+
+def export_image_files(
+    folder: types.GirderModel, user: types.GirderUserModel
+) -> Optional[List[str]]:
+    """Names of the images a CSV export refers to by frame, None unless an image sequence"""
+    if fromMeta(folder, constants.TypeMarker) != constants.ImageSequenceType:
+        return None
+    return [img['name'] for img in crud.valid_images(folder, user)]
 
 
 def get_annotation_csv_generator(
@@ -154,21 +1568,28 @@ def get_annotation_csv_generator(
     excludeBelowThreshold=False,
     typeFilter=None,
     revision=None,
+    imageFiles: Optional[List[str]] = None,
 ) -> Tuple[str, Callable[[], Generator[str, None, None]]]:
-    """Get the annotation generator for a folder"""
+    """
+    Get the annotation generator for a folder
+
+    :param imageFiles: result of export_image_files, when the caller already has it
+    """
     fps = None
-    imageFiles = None
 
     source_type = fromMeta(folder, constants.TypeMarker)
     if source_type == constants.VideoType:
         fps = fromMeta(folder, constants.FPSMarker)
-    elif source_type == constants.ImageSequenceType:
-        imageFiles = [img['name'] for img in crud.valid_images(folder, user)]
+    elif imageFiles is None:
+        imageFiles = export_image_files(folder, user)
 
     thresholds = fromMeta(folder, "confidenceFilters", {})
 
+    # The serializer filters the same way, with thresholds applied to the filtered types
+    filters = export_filter_query(thresholds, excludeBelowThreshold, typeFilter, typeFilter)
+
     def downloadGenerator():
-        datalist = TrackItem().list(folder, revision=revision)
+        datalist = TrackItem().list(folder, revision=revision, filters=filters)
         for data in viame.export_tracks_as_csv(
             datalist,
             excludeBelowThreshold,
@@ -177,6 +1598,7 @@ def get_annotation_csv_generator(
             fps=fps,
             typeFilter=typeFilter,
             revision=revision,
+            trusted=True,
         ):
             yield data
 
@@ -184,9 +1606,152 @@ def get_annotation_csv_generator(
     return filename, downloadGenerator
 
 
+def get_frame_detections(
+    dsFolder: types.GirderModel,
+    frameStart: int,
+    frameEnd: int,
+    revision: Optional[int] = None,
+    set: Optional[str] = None,
+) -> List[dict]:
+    """
+    Detections present in the frame window [frameStart, frameEnd], ordered by frame.
+
+    Tracks are found through the frame bucket index, and frames between keyframes
+    are interpolated the same way the annotator does.
+    """
+    tracks = TrackItem().list(
+        dsFolder,
+        revision=revision,
+        set=set,
+        frameStart=frameStart,
+        frameEnd=frameEnd,
+        filters=frame_bucket_query(frameStart, frameEnd),
+    )
+    detections = []
+    for track in tracks:
+        for feature, interpolated in models.features_at(track[FEATURES], frameStart, frameEnd):
+            detections.append(
+                {
+                    'trackId': track[IDENTIFIER],
+                    'frame': feature.frame,
+                    'interpolated': interpolated,
+                    **feature.dict(include={'bounds', 'geometry'}, exclude_none=True),
+                }
+            )
+    detections.sort(key=lambda detection: (detection['frame'], detection['trackId']))
+    return detections
+
+
+def get_annotation_json_generator(
+    folder: types.GirderModel,
+    excludeBelowThreshold=False,
+    typeFilter=None,
+    revision=None,
+) -> Tuple[str, Callable[[], Generator[str, None, None]]]:
+    """Get a generator that streams the DIVE json annotation file for a folder"""
+    thresholds = fromMeta(folder, "confidenceFilters", {})
+    filters = export_filter_query(thresholds, excludeBelowThreshold, typeFilter)
+
+    def records(collection: Iterable[dict]) -> Generator[str, None, None]:
+        separator = ''
+        buffer: List[str] = []
+        size = 0
+        for record in collection:
+            item = f'{separator}{json.dumps(str(record[IDENTIFIER]))}: {json.dumps(record)}'
+            separator = ', '
+            buffer.append(item)
+            size += len(item)
+            if size >= JSON_EXPORT_FLUSH_SIZE:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        yield ''.join(buffer)
+
+    def downloadGenerator():
+        yield '{"tracks": {'
+        yield from records(TrackItem().list(folder, revision=revision, filters=filters))
+        yield '}, "groups": {'
+        yield from records(GroupItem().list(folder, revision=revision))
+        yield f'}}, "version": {constants.AnnotationsCurrentVersion}}}'
+
+    filename = folder["name"] + ".dive.json"
+    return filename, downloadGenerator
+
+
+class BulkAnnotationRequest(BaseModel):
+    folderId: str
+    revision: Optional[int]
+    set: Optional[str]
+
+
+def get_bulk_annotation_generator(
+    requests: List[BulkAnnotationRequest], user: types.GirderUserModel
+) -> Callable[[], Generator[str, None, None]]:
+    """
+    Get a generator that streams the annotations of many datasets as NDJSON.
+
+    Every line is {"type": ..., "folderId": ..., "data": ...}.  Each dataset starts
+    with a "dataset" line holding its name and the revision read, followed by one
+    "track" or "group" line per annotation.  A dataset that cannot be read gets a
+    single "error" line instead, so one bad id does not fail the whole request.
+    """
+    for request in requests:
+        if not ObjectId.is_valid(request.folderId):
+            raise RestException(f'Invalid folderId {request.folderId}')
+    # Check access to every dataset in one query
+    readable = Folder().findWithPermissions(
+        {'_id': {'$in': [ObjectId(request.folderId) for request in requests]}},
+        user=user,
+        level=AccessType.READ,
+    )
+    folders = {str(folder['_id']): folder for folder in readable}
+
+    def line(kind: str, folderId: str, data) -> str:
+        return json.dumps({'type': kind, 'folderId': folderId, 'data': data}) + '\n'
+
+    def dataset_lines(request: BulkAnnotationRequest) -> Generator[str, None, None]:
+        folder = folders.get(request.folderId)
+        try:
+            if folder is None:
+                raise RestException('Dataset not found or not readable', code=404)
+            crud.verify_dataset(folder)
+            revision = request.revision
+            if revision is None:
+                revision = RevisionLogItem().latest(folder)
+            verify_revision_available(folder, revision)
+        except (RestException, ValueError) as err:
+            yield line('error', request.folderId, str(err))
+            return
+        yield line('dataset', request.folderId, {'name': folder['name'], 'revision': revision})
+        for kind, model in [('track', TrackItem()), ('group', GroupItem())]:
+            # Head reads are pinned to the revision on the dataset line, so both listings
+            # agree with it even when a save commits in between
+            records = model.list(
+                folder, revision=request.revision, set=request.set, committed=revision
+            )
+            for record in records:
+                yield line(kind, request.folderId, record)
+
+    def downloadGenerator():
+        buffer: List[str] = []
+        size = 0
+        for request in requests:
+            for item in dataset_lines(request):
+                buffer.append(item)
+                size += len(item)
+                if size >= JSON_EXPORT_FLUSH_SIZE:
+                    yield ''.join(buffer)
+                    buffer = []
+                    size = 0
+        yield ''.join(buffer)
+
+    return downloadGenerator
+
+
 class TrackUpdateArgs(BaseModel):
     delete: List[int] = Field(default_factory=list)
     upsert: List[models.Track] = Field(default_factory=list)
+    patch: List[models.TrackPatch] = Field(default_factory=list)
 
 
 class GroupUpdateArgs(BaseModel):
@@ -197,12 +1762,136 @@ class GroupUpdateArgs(BaseModel):
 class AnnotationUpdateArgs(BaseModel):
     tracks: TrackUpdateArgs = Field(default_factory=TrackUpdateArgs)
     groups: GroupUpdateArgs = Field(default_factory=GroupUpdateArgs)
+    # Revision that track patches were made against
+    revision: Optional[int]
     set: Optional[str]
 
     class Config:
         extra = 'ignore'
 
 
+def changed_ids(
+    collection: crud.PydanticModel,
+    scope: dict,
+    ids: List[int],
+    since: int,
+    exclude: Optional[int] = None,
+) -> List[int]:
+    """The ids among ids with a record in scope upserted or deleted after revision since"""
+    after = {'$gt': since, '$ne': exclude}
+    query = {**scope, '$or': [{REVISION_CREATED: after}, {REVISION_DELETED: after}]}
+    return distinct_ids(collection, query, ids)
+
+
+def verify_unchanged(
+    dsFolder: types.GirderModel,
+    ids: List[int],
+    since: int,
+    set: Optional[str] = None,
+    exclude: Optional[int] = None,
+):
+    """
+    Raise if any of the tracks was upserted or deleted after revision since
+
+    :param exclude: revision of the save making the check, whose own writes don't count
+    """
+    scope = {DATASET: dsFolder['_id'], SET: set or None}
+    changed = changed_ids(TrackItem(), scope, ids, since, exclude)
+    if changed:
+        raise RestException(
+            f'Tracks {sorted(changed)} changed after revision {since}, reload and try again',
+            code=409,
+        )
+
+
+def verify_concurrent(
+    dsFolder: types.GirderModel,
+    revision: int,
+    base: int,
+    set: Optional[str],
+    track_ids: List[int],
+    group_ids: List[int],
+):
+    """
+    Raise if a save that ran alongside the save of revision conflicts with it: one
+    allocated after head base that wrote any of the same tracks or groups, or an
+    overwrite of its set allocated after it.
+
+    Called once every write of revision has landed, so of two conflicting saves the
+    one that checks last always fails, and is undone.
+    """
+    for entry in RevisionCounterItem().pending(dsFolder):
+        if entry[OVERWRITE] and entry[REVISION] > revision and overlaps(entry[SET], set):
+            raise RestException(
+                f'Revision {entry[REVISION]} is replacing these annotations, '
+                'reload and try again',
+                code=409,
+            )
+    # A save without a set can expire records of every set
+    scope = {DATASET: dsFolder['_id'], **({SET: set} if set else {})}
+    for collection, ids, kind in [
+        (TrackItem(), track_ids, 'Tracks'),
+        (GroupItem(), group_ids, 'Groups'),
+    ]:
+        changed = changed_ids(collection, scope, ids, base, revision)
+        if changed:
+            raise RestException(
+                f'{kind} {sorted(changed)} were changed by another save, ' 'reload and try again',
+                code=409,
+            )
+
+
+def patch_tracks(
+    dsFolder: types.GirderModel,
+    patches: List[models.TrackPatch],
+    set: Optional[str] = None,
+    revision: Optional[int] = None,
+) -> Tuple[List[dict], int]:
+    """
+    Apply feature-level patches to the head version of tracks.
+
+    :param revision: revision the patches were made against, they are rejected if
+        any of the tracks changed after it
+    :returns: the tracks to upsert, and the revision they were read at, which should be
+        passed to save_annotations as unchanged_since
+    """
+    head_revision = RevisionLogItem().latest(dsFolder)
+    if not patches:
+        return [], head_revision
+    ids = [patch.id for patch in patches]
+    if len(ids) != len({*ids}):
+        raise RestException('Each track may only be patched once per request')
+    if revision is not None:
+        verify_unchanged(dsFolder, ids, revision, set)
+    head = TrackItem().head_records(dsFolder, ids, set, head_revision)
+    patched = []
+    for patch in patches:
+        track = head.get(patch.id)
+        if track is None:
+            raise RestException(f'Cannot patch track {patch.id}: it does not exist', code=404)
+        features = {feature['frame']: feature for feature in track.get(FEATURES, [])}
+        for frame in patch.removeFrames:
+            features.pop(frame, None)
+        for feature in patch.features:
+            features[feature.frame] = feature.dict(exclude_none=True)
+        if not features:
+            raise RestException(f'Cannot patch track {patch.id}: no features would remain')
+        track[FEATURES] = [features[frame] for frame in sorted(features)]
+        track[BEGIN] = track[FEATURES][0]['frame']
+        track[END] = track[FEATURES][-1]['frame']
+        if patch.confidencePairs is not None:
+            track['confidencePairs'] = patch.confidencePairs
+        if patch.attributes is not None:
+            attributes = track.setdefault('attributes', {})
+            for key, value in patch.attributes.items():
+                if value is None:
+                    attributes.pop(key, None)
+                else:
+                    attributes[key] = value
+        patched.append(track)
+    return patched, head_revision if revision is None else revision
+
+
 def save_annotations(
     dsFolder: types.GirderModel,
     user: types.GirderUserModel,
@@ -213,13 +1902,69 @@ def save_annotations(
     description="save",
     overwrite=False,
     set='',
+    unchanged_since: Optional[Tuple[List[int], int]] = None,
 ):
     """
     Annotations are lazy-deleted by marking their staleness property as true.
+
+    Every record is written with the head flag set, and the flag is cleared in the
+    same update that expires a record.  The writes of a save land in several batches,
+    so head reads are pinned to the committed revision with head_filter, and only see
+    the save once it is committed.
+
+    Saves to a dataset run alongside each other, and a save that conflicts with
+    another one is rejected with verify_concurrent once it is written.  An overwrite
+    only conflicts with the saves to its set that are allocated after it, and those
+    are rejected right away.  A save that fails is undone.
+
+    :param unchanged_since: track ids and a revision, such as from patch_tracks.
+        The save is rejected if any of those tracks changed after that revision.
     """
+    new_revision, base = RevisionCounterItem().allocate(dsFolder, set, overwrite=overwrite)
+    try:
+        return _write_revision(
+            dsFolder,
+            user,
+            new_revision,
+            base,
+            unchanged_since,
+            upsert_tracks,
+            delete_tracks,
+            upsert_groups,
+            delete_groups,
+            description,
+            overwrite,
+            set,
+        )
+    except Exception:
+        RevisionCounterItem().abort(dsFolder, new_revision)
+        raise
+
+
+def _write_revision(
+    dsFolder: types.GirderModel,
+    user: types.GirderUserModel,
+    new_revision: int,
+    base: int,
+    unchanged_since: Optional[Tuple[List[int], int]],
+    upsert_tracks: Optional[Iterable[dict]],
+    delete_tracks: Optional[Iterable[int]],
+    upsert_groups: Optional[Iterable[dict]],
+    delete_groups: Optional[Iterable[int]],
+    description: str,
+    overwrite: bool,
+    set: str,
+):
     datasetId = dsFolder['_id']
-    new_revision = RevisionLogItem().latest(dsFolder) + 1
-    delete_annotation_update = {'$set': {REVISION_DELETED: new_revision}}
+    source = annotation_source(dsFolder)
+    delete_annotation_update = {
+        '$set': {REVISION_DELETED: new_revision},
+        '$unset': {REVISION_HEAD: ""},
+    }
+
+    # Overwriting every set of a clone detaches it from its source, instead of
+    # hiding each source annotation behind a tombstone
+    materialize = overwrite and not set and source is not None
 
     if upsert_tracks is None:
         upsert_tracks = []
@@ -235,33 +1980,68 @@ def save_annotations(
         upsert_list: Iterable[dict],
         delete_list: Iterable[int],
         set: Optional[str] = None,
+        chunker: Optional[FeatureChunker] = None,
     ):
         expire_operations = []  # Mark existing records as deleted
-        expire_result = {}
         insert_operations = []  # Insert new records
-        insert_result = {}
+        modified = 0
+        inserted = 0
+
+        def flush():
+            nonlocal expire_operations, insert_operations, modified, inserted
+            RevisionCounterItem().renew(dsFolder, new_revision)
+            if chunker:
+                # Chunks are written before the tracks that reference them
+                chunk_operations = chunker.operations()
+                if len(chunk_operations):
+                    FeatureChunkItem().collection.bulk_write(chunk_operations, ordered=True)
+            # Ordered=false allows fast parallel writes
+            if len(expire_operations):
+                expire_result = collection.collection.bulk_write(
+                    expire_operations, ordered=False
+                ).bulk_api_result
+                modified += expire_result.get('nModified', 0)
+            if len(insert_operations):
+                insert_result = collection.collection.bulk_write(
+                    insert_operations, ordered=False
+                ).bulk_api_result
+                inserted += insert_result.get('nInserted', 0)
+            expire_operations = []
+            insert_operations = []
 
         if overwrite:
             query = {DATASET: datasetId, REVISION_DELETED: {'$exists': False}}
             if set:
                 query[SET] = set
-            expire_result = collection.collection.bulk_write(
-                [pymongo.UpdateMany(query, delete_annotation_update)]
-            ).bulk_api_result
+            modified += expire_batched(
+                collection, query, delete_annotation_update, dsFolder, new_revision
+            )
+            if chunker:
+                chunks = {**chunker.base, REVISION_HEAD: True}
+                expire_batched(
+                    FeatureChunkItem(), chunks, delete_annotation_update, dsFolder, new_revision
+                )
 
+        delete_list = list(delete_list)
+        upserted_ids = []
         for id in delete_list:
             filter = {IDENTIFIER: id, DATASET: datasetId, REVISION_DELETED: {'$exists': False}}
             if set:
                 filter[SET] = set
             # UpdateMany for safety, UpdateOne would also work
             expire_operations.append(pymongo.UpdateMany(filter, delete_annotation_update))
+            if chunker:
+                chunker.delete(id)
 
         for newdict in upsert_list:
-            update_dict = {DATASET: datasetId, REVISION_CREATED: new_revision}
+            update_dict = {DATASET: datasetId, REVISION_CREATED: new_revision, REVISION_HEAD: True}
             if set:
                 update_dict[SET] = set
             newdict.update(update_dict)
             newdict.pop(REVISION_DELETED, None)
+            collection.prepare(newdict)
+            if chunker:
+                chunker.upsert(newdict)
             filter = {
                 IDENTIFIER: newdict[IDENTIFIER],
                 DATASET: datasetId,
@@ -273,29 +2053,79 @@ def save_annotations(
                 # UpdateMany for safety, UpdateOne would also work
                 expire_operations.append(pymongo.UpdateMany(filter, delete_annotation_update))
             insert_operations.append(pymongo.InsertOne(newdict))
+            upserted_ids.append(newdict[IDENTIFIER])
+            if len(insert_operations) >= SAVE_BATCH_SIZE:
+                # Write the batch so a streamed upsert list is never held whole
+                flush()
+
+        # Write the last batch, so the records it expired can be looked up below
+        flush()
+        tombstones = []
+        recounted: List[int] = []
+        if source is not None:
+            # Expiring a tombstone does not delete anything visible
+            modified -= collection.collection.count_documents(
+                {DATASET: datasetId, REVISION_DELETED: new_revision, TOMBSTONE: True}
+            )
+        if source is not None and not materialize:
+            # Hide the source annotations this save deletes or overwrites
+            sourceFolder, pinned = source
+            source_query = {
+                DATASET: sourceFolder['_id'],
+                SET: set or None,
+                **revision_query(sourceFolder, pinned),
+            }
+            if overwrite:
+                hidden = collection.collection.distinct(IDENTIFIER, source_query)
+            else:
+                hidden = distinct_ids(collection, source_query, delete_list)
+            kept = frozenset(upserted_ids)
+            hidden = [id for id in dict.fromkeys(hidden) if id not in kept]
+            own_query = {DATASET: datasetId, REVISION_DELETED: new_revision}
+            if set:
+                own_query[SET] = set
+            # Hiding an annotation the clone had edited or deleted is not another deletion
+            recounted = distinct_ids(collection, own_query, hidden)
+            for id in hidden:
+                tombstone = {
+                    DATASET: datasetId,
+                    IDENTIFIER: id,
+                    REVISION_CREATED: new_revision,
+                    REVISION_HEAD: True,
+                    TOMBSTONE: True,
+                }
+                if set:
+                    tombstone[SET] = set
+                tombstones.append(pymongo.InsertOne(tombstone))
+
+        insert_operations += tombstones
+        flush()
 
-        # Ordered=false allows fast parallel writes
-        if len(expire_operations):
-            expire_result = collection.collection.bulk_write(
-                expire_operations, ordered=False
-            ).bulk_api_result
-        if len(insert_operations):
-            insert_result = collection.collection.bulk_write(
-                insert_operations, ordered=False
-            ).bulk_api_result
-
-        additions = insert_result.get('nInserted', 0)
-        deletions = expire_result.get('nModified', 0)
-        return additions, deletions
-
-    track_additions, track_deletions = update_collection(
-        TrackItem(), upsert_tracks, delete_tracks, set
+        additions = inserted - len(tombstones)
+        deletions = modified + len(tombstones) - len(recounted)
+        return additions, deletions, upserted_ids + delete_list
+
+    track_additions, track_deletions, track_ids = update_collection(
+        TrackItem(),
+        upsert_tracks,
+        delete_tracks,
+        set,
+        chunker=FeatureChunker(datasetId, set, new_revision, overwrite),
     )
-    group_additions, group_deletions = update_collection(
+    group_additions, group_deletions, group_ids = update_collection(
         GroupItem(), upsert_groups, delete_groups, set
     )
+    if not overwrite:
+        verify_concurrent(dsFolder, new_revision, base, set, track_ids, group_ids)
+    if unchanged_since is not None:
+        verify_unchanged(dsFolder, *unchanged_since, set, exclude=new_revision)
     additions = track_additions + group_additions
     deletions = track_deletions + group_deletions
+    if materialize:
+        deletions += materialize_clone(dsFolder, new_revision)
+    if track_additions or track_deletions:
+        RevisionCounterItem().renew(dsFolder, new_revision)
+        LabelCountItem().apply_revision(dsFolder, new_revision)
 
     if additions or deletions:
         # Write the revision to the log
@@ -307,19 +2137,162 @@ def save_annotations(
             additions=additions,
             deletions=deletions,
             description=description,
-            set=set,
+            set=set or None,
         )
         RevisionLogItem().create(log_entry)
+        RevisionCounterItem().commit(dsFolder, new_revision, set)
+        cache.annotations.invalidate(datasetId)
+    else:
+        RevisionCounterItem().release(dsFolder, new_revision)
 
     return {"updated": additions, "deleted": deletions}
 
 
+def expire_batched(
+    collection: crud.PydanticModel,
+    query: dict,
+    update: dict,
+    dsFolder: types.GirderModel,
+    revision: int,
+) -> int:
+    """
+    Apply an expiring update to every record matching query, in batches of
+    SAVE_BATCH_SIZE, renewing the lease of revision before each batch.
+
+    :returns: the number of records modified
+    """
+    modified = 0
+    for page in _pages(collection.collection.find(query, {'_id': 1}), SAVE_BATCH_SIZE):
+        RevisionCounterItem().renew(dsFolder, revision)
+        batch = {**query, '_id': {'$in': [record['_id'] for record in page]}}
+        modified += collection.collection.update_many(batch, update).modified_count
+    return modified
+
+
+def distinct_ids(collection: crud.PydanticModel, query: dict, ids: List[int]) -> List[int]:
+    """The ids among ids that have a record matching query, looked up in bounded batches"""
+    found: List[int] = []
+    for start in range(0, len(ids), SAVE_BATCH_SIZE):
+        batch = ids[start : start + SAVE_BATCH_SIZE]
+        found += collection.collection.distinct(IDENTIFIER, {**query, IDENTIFIER: {'$in': batch}})
+    return found
+
+
+def _uncovered(spans: List[Tuple[int, int]], end: int) -> List[Tuple[int, int]]:
+    """The [start, end) revision ranges before end that none of spans covers"""
+    gaps = []
+    start = 0
+    for covered_start, covered_end in sorted(spans):
+        if covered_start > start:
+            gaps.append((start, covered_start))
+        start = max(start, covered_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+def materialize_clone(dsFolder: types.GirderModel, revision: int) -> int:
+    """
+    Detach a copy-on-write clone whose records were all expired at revision from its
+    source.
+
+    Each source annotation is copied into the clone once for every range of revisions
+    the clone read it in, that is while the clone had no record of its own for it, so
+    earlier revisions stay readable and can be rolled back to.  Tombstones only hid
+    source annotations, so they are dropped.
+
+    :returns: the number of source annotations the clone stops reading
+    """
+    sourceFolder, pinned = annotation_source(dsFolder)
+    datasetId = dsFolder['_id']
+    source_visible = revision_query(sourceFolder, pinned)
+    hidden = 0
+    for model in [TrackItem(), GroupItem()]:
+        source_records = model.collection.find(
+            {DATASET: sourceFolder['_id'], **source_visible}, {'_id': 0, REVISION_HEAD: 0}
+        )
+        for page in _pages(source_records, OVERLAY_PAGE_SIZE):
+            RevisionCounterItem().renew(dsFolder, revision)
+            ids = [record[IDENTIFIER] for record in page]
+            own: Dict[Tuple[Optional[str], int], List[Tuple[int, int]]] = {}
+            for record in model.collection.find(
+                {DATASET: datasetId, IDENTIFIER: {'$in': ids}, REVISION_CREATED: {'$lt': revision}},
+                {SET: 1, IDENTIFIER: 1, REVISION_CREATED: 1, REVISION_DELETED: 1},
+            ):
+                own.setdefault((record.get(SET), record[IDENTIFIER]), []).append(
+                    (record[REVISION_CREATED], record.get(REVISION_DELETED, revision))
+                )
+            gaps = {}
+            copies = []
+            for record in page:
+                key = (record.get(SET), record[IDENTIFIER])
+                gaps[key] = _uncovered(own.get(key, []), revision)
+                for start, end in gaps[key]:
+                    copies.append(
+                        {
+                            **record,
+                            DATASET: datasetId,
+                            REVISION_CREATED: start,
+                            REVISION_DELETED: end,
+                            REVISION_COPIED: revision,
+                        }
+                    )
+                if gaps[key] and gaps[key][-1][1] == revision:
+                    hidden += 1
+            chunked = [record[IDENTIFIER] for record in page if record.get(FEATURE_CHUNKS)]
+            chunk_copies = []
+            if chunked:
+                for chunk in FeatureChunkItem().collection.find(
+                    {DATASET: sourceFolder['_id'], IDENTIFIER: {'$in': chunked}, **source_visible},
+                    {'_id': 0, REVISION_HEAD: 0},
+                ):
+                    for start, end in gaps.get((chunk.get(SET), chunk[IDENTIFIER]), []):
+                        chunk_copies.append(
+                            {
+                                **chunk,
+                                DATASET: datasetId,
+                                REVISION_CREATED: start,
+                                REVISION_DELETED: end,
+                                REVISION_COPIED: revision,
+                            }
+                        )
+            if chunk_copies:
+                FeatureChunkItem().collection.insert_many(chunk_copies, ordered=False)
+            if copies:
+                model.collection.insert_many(copies, ordered=False)
+    RevisionCounterItem().renew(dsFolder, revision)
+    # The copies are undone with the save, the rest can't be, so it is done last
+    dsFolder.pop(constants.AnnotationSourceIdMarker)
+    dsFolder.pop(constants.AnnotationSourceRevisionMarker)
+    Folder().save(dsFolder)
+    for model in [TrackItem(), GroupItem()]:
+        model.collection.delete_many({DATASET: datasetId, TOMBSTONE: True})
+    LabelCountItem().rebuild(dsFolder)
+    return hidden
+
+
 def clone_annotations(
     source: types.GirderModel,
     dest: types.GirderModel,
     user: types.GirderUserModel,
     revision: Optional[int] = None,
 ):
+    """
+    Give dest the annotations of source at revision, or at head if None.
+
+    dest becomes a copy-on-write clone that reads from source at the pinned revision,
+    so no annotation records are copied.  A clone of a clone is copied in full
+    instead, so reads never chain through more than one source.
+    """
+    if annotation_source(source) is None:
+        head = RevisionLogItem().latest(source)
+        pinned = head if revision is None else min(revision, head)
+        verify_revision_available(source, pinned)
+        dest[constants.AnnotationSourceIdMarker] = str(source['_id'])
+        dest[constants.AnnotationSourceRevisionMarker] = pinned
+        Folder().save(dest)
+        LabelCountItem().clone(source, dest, pinned == head)
+        return
     track_iter = TrackItem().list(source, revision=revision)
     group_iter = GroupItem().list(source, revision=revision)
     save_annotations(
@@ -343,10 +2316,10 @@ def get_annotations(
         'version': constants.AnnotationsCurrentVersion,
     }
     for t in tracks:
-        serialized = models.Track(**t).dict(exclude_none=True)
+        serialized = models.trusted_track(t)
         annotations['tracks'][serialized['id']] = serialized
     for g in groups:
-        serialized = models.Group(**g).dict(exclude_none=True)
+        serialized = models.trusted_group(g)
         annotations['groups'][serialized['id']] = serialized
     return annotations
 
@@ -366,7 +2339,7 @@ def add_annotations(
     }
     max_track_id = -1
     for t in tracks:
-        serialized = models.Track(**t).dict(exclude_none=True)
+        serialized = models.trusted_track(t)
         annotations['tracks'][serialized['id']] = serialized
         max_track_id = max(max_track_id, serialized['id'])
     # Now add in the new tracks while renaming them
@@ -385,6 +2358,147 @@ def add_annotations(
     return annotations['tracks']
 
 
+# Update pipeline computing the same summary fields as TrackItem.prepare
+_confidences = {'$map': {'input': '$confidencePairs', 'in': {'$arrayElemAt': ['$$this', 1]}}}
+SUMMARY_MIGRATION = [
+    {
+        '$set': {
+            'maxConfidence': {'$max': _confidences},
+            'featureCount': {'$size': {'$ifNull': ['$features', []]}},
+            'hasGeometry': {
+                '$anyElementTrue': [
+                    {
+                        '$map': {
+                            'input': {'$ifNull': ['$features', []]},
+                            'in': {'$gt': ['$$this.geometry', None]},
+                        }
+                    }
+                ]
+            },
+        }
+    },
+    {
+        '$set': {
+            'topLabel': {
+                '$arrayElemAt': [
+                    {
+                        '$arrayElemAt': [
+                            '$confidencePairs',
+                            {'$indexOfArray': [_confidences, '$maxConfidence']},
+                        ]
+                    },
+                    0,
+                ]
+            }
+        }
+    },
+]
+
+
+def _frame_bucket_of(field: str) -> dict:
+    frame = {'$ifNull': [f'${field}', 0]}
+    return {'$toInt': {'$floor': {'$divide': [frame, constants.FrameBucketSize]}}}
+
+
+# Same as track_frame_buckets, for records saved before tracks stored them
+FRAME_BUCKET_MIGRATION = [
+    {
+        '$set': {
+            FRAME_BUCKETS: {
+                '$cond': [
+                    {
+                        '$gt': [
+                            {'$subtract': [_frame_bucket_of(END), _frame_bucket_of(BEGIN)]},
+                            TRACK_FRAME_BUCKET_LIMIT - 1,
+                        ]
+                    },
+                    [LONG_TRACK_BUCKET],
+                    {'$range': [_frame_bucket_of(BEGIN), {'$add': [_frame_bucket_of(END), 1]}]},
+                ]
+            }
+        }
+    },
+]
+
+
+def migrate_annotation_records():
+    """
+    Bring existing annotation records up to the current storage schema.
+    Progress is recorded in a setting so that each migration runs only once.
+    """
+    version = Setting().get(constants.SETTINGS_CONST_ANNOTATION_SCHEMA_VERSION) or 0
+    if version >= constants.AnnotationSchemaCurrentVersion:
+        return
+    if version < 1:
+        # Flag every live record as head so head-only reads can find them
+        for model in [TrackItem(), GroupItem()]:
+            model.collection.update_many(
+                {REVISION_DELETED: {'$exists': False}, REVISION_HEAD: {'$exists': False}},
+                {'$set': {REVISION_HEAD: True}},
+            )
+    if version < 2:
+        # Populate the label count rollup
+        LabelCountItem().rebuild_all()
+    if version < 3:
+        # Add the summary fields to existing tracks
+        TrackItem().collection.update_many(
+            {'featureCount': {'$exists': False}, TOMBSTONE: {'$exists': False}},
+            SUMMARY_MIGRATION,
+        )
+        # Raw revision filter, since this runs at plugin load where compaction errors are fatal
+        for track in TrackItem().collection.find(
+            {FEATURE_CHUNKS: {'$exists': True}},
+            {IDENTIFIER: 1, DATASET: 1, SET: 1, REVISION_CREATED: 1},
+        ):
+            chunks = FeatureChunkItem().collection.find(
+                {
+                    DATASET: track[DATASET],
+                    SET: track.get(SET),
+                    IDENTIFIER: track[IDENTIFIER],
+                    **revision_filter(track[REVISION_CREATED]),
+                },
+                {FEATURES: 1},
+            )
+            features = [feature for chunk in chunks for feature in chunk[FEATURES]]
+            TrackItem().collection.update_one(
+                {'_id': track['_id']},
+                {
+                    '$set': {
+                        'featureCount': len(features),
+                        'hasGeometry': any(feature.get('geometry') for feature in features),
+                    }
+                },
+            )
+    if version < 4:
+        # Indexes that did not lead with set were replaced by ones that do
+        for model in [TrackItem(), GroupItem()]:
+            existing = model.collection.index_information()
+            for name in ['dataset_1_id_1', 'dataset_1_begin_1_end_1_rev_created_1']:
+                if name in existing:
+                    model.collection.drop_index(name)
+        # List the sets of every dataset on its counter
+        for heads in RevisionCounterItem.logged_set_heads({}):
+            RevisionCounterItem().collection.update_one(
+                {DATASET: heads['_id']}, {'$set': {SETS: heads[SETS]}}
+            )
+    if version < 5:
+        # Index existing tracks by the frame buckets they span
+        TrackItem().collection.update_many(
+            {FRAME_BUCKETS: {'$exists': False}, TOMBSTONE: {'$exists': False}},
+            FRAME_BUCKET_MIGRATION,
+        )
+    if version < 6:
+        # Long tracks were indexed by every bucket they span, bound them
+        TrackItem().collection.update_many(
+            {f'{FRAME_BUCKETS}.{TRACK_FRAME_BUCKET_LIMIT}': {'$exists': True}},
+            FRAME_BUCKET_MIGRATION,
+        )
+    Setting().set(
+        constants.SETTINGS_CONST_ANNOTATION_SCHEMA_VERSION,
+        constants.AnnotationSchemaCurrentVersion,
+    )
+
+
 def get_labels(user: types.GirderUserModel, published=False, shared=False):
     """Find all the labels in all datasets belonging to the user"""
     accessLevel = AccessType.WRITE
@@ -398,37 +2512,26 @@ def get_labels(user: types.GirderUserModel, published=False, shared=False):
             )
         },
         {
-            # Left join to get annotationItems for all datasets
+            # Left join to get the label counts for all datasets
             '$lookup': {
-                'from': 'trackItem',
-                # Map the foreign key _id to dataset_id in the query
-                'let': {'dataset_id': '$_id'},
-                # Create a new field 'label' for each annotation
+                'from': 'labelCountItem',
+                'localField': '_id',
+                'foreignField': 'dataset',
                 'as': 'label',
-                'pipeline': [
-                    {'$match': {'$expr': {'$eq': ['$dataset', '$$dataset_id']}}},
-                    {'$match': {'$expr': {'$eq': [{'$type': "$rev_deleted"}, 'missing']}}},
-                    # Select the confidencePairs, which is the only field needed
-                    {'$project': {'confidencePairs': 1}},
-                    # Use the first confidence pair in the array, which assumes they are
-                    # sorted in descending order
-                    {'$set': {'confidencePairs': {'$first': '$confidencePairs'}}},
-                    {'$set': {'confidencePairs': {'$first': '$confidencePairs'}}},
-                ],
             },
         },
-        # after the lookup, label will be an array of strings on each dataset.
+        # after the lookup, label will be an array of counts on each dataset.
         # unwind to duplicate N records in the query for N labels.
         {'$unwind': '$label'},
         # Preserve properties of dataset by moving them into a sub-object.
         {'$set': {'dataset': {'id': '$_id', 'name': '$name'}}},
         # Drop unwanted fields.
-        {'$project': {'label.confidencePairs': 1, '_id': 1, 'dataset': 1}},
+        {'$project': {'label.label': 1, 'label.count': 1, '_id': 1, 'dataset': 1}},
         # Group records by label values
         {
             '$group': {
-                '_id': '$label.confidencePairs',
-                'count': {'$count': {}},
+                '_id': '$label.label',
+                'count': {'$sum': '$label.count'},
                 'datasets': {'$addToSet': '$dataset'},
             }
         },
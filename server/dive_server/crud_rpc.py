@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
 import json
-from typing import Dict, List, Optional, Tuple, TypedDict
+import os
+from typing import Dict, Iterator, List, Optional, Tuple, TypedDict
 
 from girder.constants import AccessType
 from girder.exceptions import RestException
@@ -358,6 +359,16 @@ GetDataReturnType = TypedDict(
 )
 
 
+# CSV files at least this large are parsed by DIVE_CSV_IMPORT_PROCESSES worker processes
+PARALLEL_IMPORT_MIN_BYTES = 16 * 1024 * 1024
+
+
+def _csv_import_processes(file: types.GirderModel) -> int:
+    if file.get('size', 0) < PARALLEL_IMPORT_MIN_BYTES:
+        return 1
+    return int(os.environ.get('DIVE_CSV_IMPORT_PROCESSES', 1))
+
+
 def _get_data_by_type(
     file: types.GirderModel,
     image_map: Optional[Dict[str, int]] = None,
@@ -374,14 +385,15 @@ def _get_data_by_type(
     if file is None:
         return None, None
     file_generator = File().download(file, headers=False)()
-    file_string = b"".join(list(file_generator)).decode()
     data_dict = None
     warnings = None
 
     # Discover the type of the mystery file
     if file['exts'][-1] == 'csv':
+        # CSV is parsed line by line as it downloads, never as a whole string
         as_type = crud.FileType.VIAME_CSV
     elif file['exts'][-1] == 'json':
+        file_string = b"".join(list(file_generator)).decode()
         data_dict = json.loads(file_string)
         if type(data_dict) is list:
             raise RestException('No array-type json objects are supported')
@@ -393,6 +405,7 @@ def _get_data_by_type(
         else:
             as_type = crud.FileType.DIVE_JSON
     elif file['exts'][-1] in ['yml', 'yaml']:
+        file_string = b"".join(list(file_generator)).decode()
         as_type = crud.FileType.MEVA_KPF
     else:
         raise RestException('Got file of unknown and unusable type')
@@ -400,7 +413,7 @@ def _get_data_by_type(
     # Parse the file as the now known type
     if as_type == crud.FileType.VIAME_CSV:
         converted, attributes, warnings, fps = viame.load_csv_as_tracks_and_attributes(
-            file_string.splitlines(), image_map
+            viame.iter_lines(file_generator), image_map, _csv_import_processes(file)
         )
         meta = None
         if fps is not None:
@@ -450,6 +463,12 @@ def _get_data_by_type(
     return None, None
 
 
+def _drain(tracks: Dict[str, dict]) -> Iterator[dict]:
+    """Yield and forget tracks so a batched save can release them as it writes"""
+    while tracks:
+        yield tracks.popitem()[1]
+
+
 def process_items(
     folder: types.GirderModel,
     user: types.GirderUserModel,
@@ -500,7 +519,7 @@ def process_items(
         item['meta'][constants.ProcessedMarker] = True
         Item().move(item, auxiliary)
         if results['annotations']:
-            updated_tracks = results['annotations']['tracks'].values()
+            updated_tracks = _drain(results['annotations']['tracks'])
             if additive:  # get annotations and add them to the end
                 tracks = crud_annotation.add_annotations(
                     folder, results['annotations']['tracks'], additivePrepend
@@ -1,17 +1,19 @@
+from datetime import datetime
 import json
-from typing import List, Optional
+from typing import Iterable, List, Optional
 
 import cherrypy
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import Resource, setRawResponse
+from girder.api.rest import Resource
 from girder.constants import AccessType, TokenScope
 from girder.exceptions import RestException
 from girder.models.folder import Folder
 
-from dive_utils import constants, fromMeta, models, setContentDisposition
+from dive_utils import constants, setContentDisposition
+from dive_utils.serializers import columnar
 
-from . import crud, crud_annotation
+from . import cache, crud, crud_annotation
 
 DatasetModelParam = {
     'description': "dataset id",
@@ -21,15 +23,85 @@ DatasetModelParam = {
 }
 
 
+ContinuationParam = {
+    'description': (
+        "Token from the Dive-Continuation header of the previous page. "
+        "Resumes after that page without skipping records; offset should be 0."
+    ),
+    'dataType': 'string',
+    'required': False,
+}
+
 GetAnnotationParams = (
     Description("Get annotations of a dataset")
     .pagingParams("id", defaultLimit=0)
     .modelParam("folderId", **DatasetModelParam, level=AccessType.READ)
     .param('revision', 'revision', dataType='integer', required=False)
     .param('set', 'set', dataType='string', required=False)
+    .param('continuation', **ContinuationParam)
+)
+
+GetTrackParams = (
+    Description("Get tracks of a dataset, optionally limited to a frame window")
+    .notes(
+        'Send "Accept: application/x-dive-columnar" to receive the compact binary '
+        'encoding described in docs/DataFormats.md instead of JSON.'
+    )
+    .pagingParams("id", defaultLimit=0)
+    .modelParam("folderId", **DatasetModelParam, level=AccessType.READ)
+    .param('revision', 'revision', dataType='integer', required=False)
+    .param('set', 'set', dataType='string', required=False)
+    .param(
+        'frameStart',
+        'Only include tracks that end on or after this frame',
+        dataType='integer',
+        required=False,
+    )
+    .param(
+        'frameEnd',
+        'Only include tracks that begin on or before this frame',
+        dataType='integer',
+        required=False,
+    )
+    .param('continuation', **ContinuationParam)
+    .param(
+        'fields',
+        'Use summary to get only id, begin, end, maxConfidence, topLabel, featureCount '
+        'and hasGeometry for each track, without loading its features',
+        dataType='string',
+        enum=['all', 'summary'],
+        default='all',
+        required=False,
+    )
 )
 
 
+def request_key() -> list:
+    """Query parameters and content type that an annotation response depends on"""
+    params = {key: value for key, value in cherrypy.request.params.items() if key != 'token'}
+    return [sorted(params.items()), cherrypy.request.headers.get('Accept', '')]
+
+
+def whole_listing(limit: int, offset: int, continuation: Optional[str]) -> bool:
+    """Whole listings, as loaded when a dataset is opened, are served from the cache"""
+    return not (limit or offset or continuation)
+
+
+def pinned(revision: Optional[int], read: int) -> Optional[int]:
+    """
+    Revision to list at, or None for head reads.  Head reads use the head flag
+    instead of walking the revision history, and are listed with committed=read so a
+    save that commits meanwhile can't put a newer body in the cache entry for read.
+    """
+    return revision if revision == read else None
+
+
+def serialize(records: Iterable[dict], mime: str) -> bytes:
+    if mime == columnar.MIME_TYPE:
+        return b''.join(columnar.encode_tracks(records))
+    return json.dumps(list(records)).encode('utf-8')
+
+
 class AnnotationResource(Resource):
     """RESTFul Annotation Resource"""
 
@@ -40,25 +112,142 @@ class AnnotationResource(Resource):
         self.route("GET", ("track",), self.get_tracks)
         self.route("GET", ("group",), self.get_groups)
         self.route("GET", ("revision",), self.get_revisions)
+        self.route("GET", ("changes",), self.get_changes)
+        self.route("GET", ("frame",), self.get_frame)
         self.route("GET", ("export",), self.export)
         self.route("GET", ("labels",), self.get_labels)
         self.route("GET", ("sets",), self.get_sets)
         self.route("PATCH", (), self.save_annotations)
         self.route("POST", ("rollback",), self.rollback)
+        self.route("POST", ("compact",), self.compact)
+        self.route("GET", ("cache",), self.get_cache_stats)
+        self.route("POST", ("bulk",), self.get_bulk)
 
     @access.user
-    @autoDescribeRoute(GetAnnotationParams)
-    def get_tracks(self, limit: int, offset: int, sort, folder, revision, set):
-        return crud_annotation.TrackItem().list(
-            folder, limit=limit, offset=offset, sort=sort, revision=revision, set=set
+    @autoDescribeRoute(GetTrackParams)
+    def get_tracks(
+        self,
+        limit: int,
+        offset: int,
+        sort,
+        folder,
+        revision,
+        set,
+        frameStart: Optional[int],
+        frameEnd: Optional[int],
+        continuation: Optional[str],
+        fields: str,
+    ):
+        read = crud_annotation.conditional_annotation_response(
+            folder, revision, request_key(), set=set
+        )
+        projection = None
+        if fields == 'summary':
+            projection = crud_annotation.TrackItem.SUMMARY_FIELDS
+        mime = 'application/json'
+        if columnar.MIME_TYPE in cherrypy.request.headers.get('Accept', ''):
+            mime = columnar.MIME_TYPE
+        if whole_listing(limit, offset, continuation) and frameStart is None and frameEnd is None:
+            key = cache.annotation_key(folder, read, set, 'track', fields, sort, mime)
+            payload = cache.annotations.get(key)
+            if payload is None:
+                tracks = crud_annotation.TrackItem().list(
+                    folder,
+                    sort=sort,
+                    revision=pinned(revision, read),
+                    set=set,
+                    fields=projection,
+                    committed=read,
+                )
+                payload = serialize(tracks, mime)
+                cache.annotations.put(key, payload)
+            return cache.respond(payload, mime)
+        filters = None
+        if frameStart is not None and frameEnd is not None:
+            filters = crud_annotation.frame_bucket_query(frameStart, frameEnd)
+        tracks = crud_annotation.TrackItem().list(
+            folder,
+            limit=limit,
+            offset=offset,
+            sort=sort,
+            revision=revision,
+            set=set,
+            frameStart=frameStart,
+            frameEnd=frameEnd,
+            continuation=continuation,
+            fields=projection,
+            filters=filters,
         )
+        if mime == columnar.MIME_TYPE:
+            if limit:
+                # The continuation header must be set before the body starts streaming
+                tracks = list(tracks)
+                crud.set_continuation_header(tracks, limit, sort, 'id')
+            cherrypy.response.headers['Content-Type'] = columnar.MIME_TYPE
+
+            def stream():
+                yield from columnar.encode_tracks(tracks)
+
+            return stream
+        tracks = list(tracks)
+        crud.set_continuation_header(tracks, limit, sort, 'id')
+        return tracks
 
     @access.user
     @autoDescribeRoute(GetAnnotationParams)
-    def get_groups(self, limit: int, offset: int, sort, folder, revision, set):
-        return crud_annotation.GroupItem().list(
-            folder, limit=limit, offset=offset, sort=sort, revision=revision, set=set
+    def get_groups(self, limit: int, offset: int, sort, folder, revision, set, continuation):
+        read = crud_annotation.conditional_annotation_response(
+            folder, revision, request_key(), set=set
+        )
+        if whole_listing(limit, offset, continuation):
+            key = cache.annotation_key(folder, read, set, 'group', sort)
+            payload = cache.annotations.get(key)
+            if payload is None:
+                groups = crud_annotation.GroupItem().list(
+                    folder, sort=sort, revision=pinned(revision, read), set=set, committed=read
+                )
+                payload = serialize(groups, 'application/json')
+                cache.annotations.put(key, payload)
+            return cache.respond(payload, 'application/json')
+        groups = list(
+            crud_annotation.GroupItem().list(
+                folder,
+                limit=limit,
+                offset=offset,
+                sort=sort,
+                revision=revision,
+                set=set,
+                continuation=continuation,
+            )
+        )
+        crud.set_continuation_header(groups, limit, sort, 'id')
+        return groups
+
+    @access.user
+    @autoDescribeRoute(
+        Description("Get the detections present at a frame or in a range of frames")
+        .notes(
+            "Returns trackId, frame, bounds and geometry of each detection, ordered by frame. "
+            "Frames between keyframes are interpolated and marked as interpolated."
+        )
+        .modelParam("folderId", **DatasetModelParam, level=AccessType.READ)
+        .param('frame', 'Frame, or first frame of the range', dataType='integer')
+        .param(
+            'frameEnd',
+            'Last frame of the range, inclusive. Defaults to frame',
+            dataType='integer',
+            required=False,
         )
+        .param('revision', 'revision', dataType='integer', required=False)
+        .param('set', 'set', dataType='string', required=False)
+    )
+    def get_frame(self, folder, frame: int, frameEnd: Optional[int], revision, set):
+        if frameEnd is None:
+            frameEnd = frame
+        if frameEnd < frame:
+            raise RestException('frameEnd must not be before frame')
+        crud_annotation.conditional_annotation_response(folder, revision, request_key(), set=set)
+        return crud_annotation.get_frame_detections(folder, frame, frameEnd, revision, set)
 
     @access.user
     @autoDescribeRoute(
@@ -73,23 +262,61 @@ class AnnotationResource(Resource):
             default='',
             required=False,
         )
+        .param('continuation', **ContinuationParam)
+        .param(
+            'includeTotal',
+            'Count all revisions for the Girder-Total-Count header',
+            dataType='boolean',
+            default=True,
+            required=False,
+        )
     )
-    def get_revisions(self, limit: int, offset: int, sort, folder, set):
-        cursor, total = crud_annotation.RevisionLogItem().list(
-            folder, limit, offset, sort, None, set
+    def get_revisions(
+        self,
+        limit: int,
+        offset: int,
+        sort,
+        folder,
+        set,
+        continuation: Optional[str],
+        includeTotal: bool,
+    ):
+        # Revisions logged after the head are hidden until the older saves are done
+        logItem = crud_annotation.RevisionLogItem()
+        cursor, total = logItem.list(
+            folder,
+            limit,
+            offset,
+            sort,
+            logItem.latest(folder),
+            set,
+            continuation=continuation,
+            count=includeTotal,
         )
-        cherrypy.response.headers['Girder-Total-Count'] = total
-        return cursor
+        if total is not None:
+            cherrypy.response.headers['Girder-Total-Count'] = total
+        revisions = list(cursor)
+        crud.set_continuation_header(revisions, limit, sort, 'revision')
+        return revisions
 
     @access.user
     @autoDescribeRoute(
-        Description("Get dataset annotation revision log")
-        .pagingParams("revision", defaultLimit=20)
+        Description("Get tracks and groups that changed since a revision")
+        .modelParam("folderId", **DatasetModelParam, level=AccessType.READ)
+        .param('since', 'Revision the client already has', dataType='integer')
+        .param('set', 'set', dataType='string', required=False)
+    )
+    def get_changes(self, folder, since: int, set: Optional[str]):
+        return crud_annotation.get_changes(folder, since, set)
+
+    @access.user
+    @autoDescribeRoute(
+        Description("Get the names of every annotation set saved to a dataset")
+        .notes("Sets are not paged, every set is returned.")
         .modelParam("folderId", **DatasetModelParam, level=AccessType.READ)
     )
-    def get_sets(self, limit: int, offset: int, sort, folder):
-        cursor = crud_annotation.RevisionLogItem().sets(folder, limit, offset, sort)
-        return cursor
+    def get_sets(self, folder):
+        return crud_annotation.RevisionLogItem().sets(folder)
 
     @access.public(scope=TokenScope.DATA_READ, cookie=True)
     @autoDescribeRoute(
@@ -137,51 +364,60 @@ class AnnotationResource(Resource):
         typeFilter: Optional[List[str]],
     ):
         crud.verify_dataset(folder)
+        user = self.getCurrentUser()
+        # CSV rows name the image of their frame, and images can be added or removed
+        # without a new revision or a change to the dataset folder
+        imageFiles = None
+        if format == 'viame_csv':
+            imageFiles = crud_annotation.export_image_files(folder, user)
+        # Exports also depend on dataset metadata such as confidence thresholds and fps,
+        # which can change without a new revision, so they are always revalidated.
+        crud_annotation.conditional_annotation_response(
+            folder, revisionId, [request_key(), folder['updated'], imageFiles], immutable=False
+        )
 
         if format == 'viame_csv':
             filename, gen = crud_annotation.get_annotation_csv_generator(
                 folder,
-                self.getCurrentUser(),
+                user,
                 excludeBelowThreshold=excludeBelowThreshold,
                 typeFilter=typeFilter,
                 revision=revisionId,
+                imageFiles=imageFiles,
             )
             setContentDisposition(filename, mime='text/csv')
             return gen
         elif format == 'dive_json':
-            setContentDisposition(f'{folder["name"]}.dive.json', mime='application/json')
-            setRawResponse()
-            annotations = crud_annotation.get_annotations(folder, revision=revisionId)
-            tracks = annotations['tracks']
-            thresholds = None
-            if excludeBelowThreshold:
-                thresholds = fromMeta(folder, "confidenceFilters", {})
-            if thresholds is None:
-                thresholds = {}
-
-            updated_tracks = []
-            if typeFilter is None:
-                typeFilter = set()
-            print(tracks)
-            for t in tracks:
-                print(t)
-                print(tracks[t])
-                track = models.Track(**tracks[t])
-                if (not excludeBelowThreshold) or track.exceeds_thresholds(thresholds):
-                    # filter by types if applicable
-                    if typeFilter:
-                        confidence_pairs = [
-                            item for item in track.confidencePairs if item[0] in typeFilter
-                        ]
-                        # skip line if no confidence pairs
-                        if not confidence_pairs:
-                            continue
-                    updated_tracks.append(tracks[t])
-            annotations['tracks'] = updated_tracks
-            return json.dumps(annotations).encode('utf-8')
+            filename, gen = crud_annotation.get_annotation_json_generator(
+                folder,
+                excludeBelowThreshold=excludeBelowThreshold,
+                typeFilter=typeFilter,
+                revision=revisionId,
+            )
+            setContentDisposition(filename, mime='application/json')
+            return gen
         else:
             raise RestException(f'Format {format} is not a valid option.')
 
+    @access.user
+    @autoDescribeRoute(
+        Description("Get the annotations of many datasets in one response")
+        .notes(
+            'The body is a list of {"folderId", "revision", "set"} objects, where revision '
+            'and set are optional.  The response is newline-delimited JSON, see '
+            'docs/scripting/Endpoints.md for the line format.'
+        )
+        .jsonParam("body", "datasets to read", paramType="body", requireArray=True)
+    )
+    def get_bulk(self, body):
+        requests = [
+            crud.get_validated_model(crud_annotation.BulkAnnotationRequest, **request)
+            for request in body
+        ]
+        gen = crud_annotation.get_bulk_annotation_generator(requests, self.getCurrentUser())
+        cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+        return gen
+
     @access.user
     @autoDescribeRoute(
         Description("Update annotations")
@@ -194,6 +430,13 @@ class AnnotationResource(Resource):
             crud_annotation.AnnotationUpdateArgs, **body
         )
         upsert_tracks = [track.dict(exclude_none=True) for track in validated.tracks.upsert]
+        patched_ids = {patch.id for patch in validated.tracks.patch}
+        if patched_ids & {*validated.tracks.delete, *(track['id'] for track in upsert_tracks)}:
+            raise RestException('A track cannot be patched and upserted or deleted together')
+        patched, read = crud_annotation.patch_tracks(
+            folder, validated.tracks.patch, validated.set, validated.revision
+        )
+        upsert_tracks += patched
         upsert_groups = [group.dict(exclude_none=True) for group in validated.groups.upsert]
         user = self.getCurrentUser()
         return crud_annotation.save_annotations(
@@ -204,17 +447,56 @@ class AnnotationResource(Resource):
             upsert_groups=upsert_groups,
             delete_groups=validated.groups.delete,
             set=validated.set,
+            unchanged_since=(list(patched_ids), read) if patched_ids else None,
         )
 
     @access.user
     @autoDescribeRoute(
         Description("Rollback annotation revision to the specified version")
+        .notes(
+            "The rollback is written as a new revision, so history is kept. "
+            "Large rollbacks run as a background job, which is returned instead of the result."
+        )
         .modelParam("folderId", **DatasetModelParam, level=AccessType.WRITE)
         .param('revision', 'revision', dataType='integer')
     )
     def rollback(self, folder, revision):
         crud.verify_dataset(folder)
-        crud_annotation.rollback(folder, revision)
+        crud_annotation.verify_revision_available(folder, revision)
+        user = self.getCurrentUser()
+        size = crud_annotation.rollback_size(folder, revision)
+        if size > crud_annotation.ROLLBACK_JOB_THRESHOLD:
+            return crud_annotation.schedule_rollback_job(folder, user, revision)
+        return crud_annotation.rollback(folder, user, revision)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description("Permanently discard old annotation revision history")
+        .notes(
+            "Keeps the last `keep` revisions and/or every revision newer than `before`. "
+            "Revisions older than the resulting floor can no longer be read or rolled back to."
+        )
+        .modelParam("folderId", **DatasetModelParam, level=AccessType.WRITE)
+        .param(
+            'keep', 'Number of most recent revisions to keep', dataType='integer', required=False
+        )
+        .param(
+            'before',
+            'Discard history older than this time',
+            dataType='dateTime',
+            required=False,
+        )
+    )
+    def compact(self, folder, keep: Optional[int], before: Optional[datetime]):
+        crud.verify_dataset(folder)
+        return crud_annotation.compact_revisions(folder, keep=keep, before=before)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description("Get hit, miss and size counters of this server's annotation cache")
+    )
+    def get_cache_stats(self):
+        return cache.annotations.stats()
 
     @access.user
     @autoDescribeRoute(
@@ -48,6 +48,14 @@ def validateInstalledAddons(doc):
         assert isinstance(val['downloaded'], list), 'downloaded key is not a list'
 
 
+@setting_utilities.validator({constants.SETTINGS_CONST_ANNOTATION_SCHEMA_VERSION})
+def validateAnnotationSchemaVersion(doc):
+    """Internal bookkeeping for annotation record migrations"""
+    val = doc['value']
+    if val is not None:
+        assert isinstance(val, int), 'annotation schema version must be an integer'
+
+
 class ConfigurationResource(Resource):
     """Configuration resource handles get/set of global configuration"""
 
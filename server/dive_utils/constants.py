@@ -3,6 +3,7 @@ import re
 SETTINGS_CONST_JOBS_CONFIGS = 'jobs_configs'
 BRAND_DATA_CONFIG = 'brand_data_config'
 INSTALLED_ADDONS_CONFIGS = 'installed_addons'
+SETTINGS_CONST_ANNOTATION_SCHEMA_VERSION = 'annotation_schema_version'
 
 ImageSequenceType = "image-sequence"
 VideoType = "video"
@@ -11,6 +12,15 @@ DefaultVideoFPS = -1
 JsonMetaCurrentVersion = 1
 SettingsCurrentVersion = 1
 AnnotationsCurrentVersion = 2
+AnnotationSchemaCurrentVersion = 6
+# Response header carrying the token for the next page of a keyset paginated listing
+ContinuationHeader = 'Dive-Continuation'
+# Seconds that responses for an explicit annotation revision may be cached
+ImmutableMaxAge = 365 * 24 * 60 * 60
+# Tracks with more features than this are stored in chunks of this many frames
+FeatureChunkSize = 1000
+# Tracks are indexed by the buckets of this many frames that their [begin, end] spans
+FrameBucketSize = 1000
 
 webValidImageFormats = {"png", "jpg", "jpeg"}
 validImageFormats = {*webValidImageFormats, "sgi", "bmp", "pgm"}
@@ -102,6 +112,9 @@ PublishedMarker = "published"
 SharedMarker = "shared"
 ProcessedMarker = "processed"
 ForeignMediaIdMarker = "foreign_media_id"
+# Copy-on-write clones read unedited annotations from this dataset at the pinned revision
+AnnotationSourceIdMarker = "annotation_source_id"
+AnnotationSourceRevisionMarker = "annotation_source_revision"
 TrainedPipelineMarker = "trained_pipeline"
 TypeMarker = "type"
 AssetstoreSourceMarker = "import_source"
@@ -1,5 +1,6 @@
+import bisect
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 
 from bson.objectid import ObjectId
 from pydantic import BaseModel, Field, validator
@@ -52,6 +53,31 @@ class Feature(BaseModel):
     keyframe: Optional[bool] = None
 
 
+def exceeds_thresholds(
+    confidencePairs: List[Tuple[str, float]],
+    thresholds: Dict[str, float],
+    typeFilter: Set[str] = None,
+) -> bool:
+    defaultThresh = thresholds.get('default', 0)
+
+    # Check if there is any confidence value that exceeds the threshold
+    exceeds_default_threshold = False
+    for field, confidence in confidencePairs:
+        if confidence >= thresholds.get(field, defaultThresh):
+            if typeFilter and field in typeFilter:  # field is in the set and confidence > threshold
+                exceeds_default_threshold = True
+            elif typeFilter:  # if typeFilter has a set and the field isn't in it we return false
+                exceeds_default_threshold = False
+            elif not typeFilter:  # if no typeFilter we return true based on confidence > threshold
+                exceeds_default_threshold = True
+        else:
+            exceeds_default_threshold = False
+        if exceeds_default_threshold:
+            return True
+
+    return False
+
+
 class BaseAnnotation(BaseModel):
     begin: Optional[int]
     end: Optional[int]
@@ -61,30 +87,7 @@ class BaseAnnotation(BaseModel):
     meta: Optional[Dict[str, Any]]
 
     def exceeds_thresholds(self, thresholds: Dict[str, float], typeFilter: Set[str] = None) -> bool:
-        defaultThresh = thresholds.get('default', 0)
-
-        # Check if there is any confidence value that exceeds the threshold
-        exceeds_default_threshold = False
-        for field, confidence in self.confidencePairs:
-            if confidence >= thresholds.get(field, defaultThresh):
-                if (
-                    typeFilter and field in typeFilter
-                ):  # field is in the set and confidence > threshold
-                    exceeds_default_threshold = True
-                elif (
-                    typeFilter
-                ):  # if typeFilter has a set and the field isn't in it we return false
-                    exceeds_default_threshold = False
-                elif (
-                    not typeFilter
-                ):  # if no typeFilter we return true based on confidence > threshold
-                    exceeds_default_threshold = True
-            else:
-                exceeds_default_threshold = False
-            if exceeds_default_threshold:
-                return True
-
-        return False
+        return exceeds_thresholds(self.confidencePairs, thresholds, typeFilter)
 
     def __hash__(self):
         return self.id
@@ -113,6 +116,19 @@ class Track(BaseAnnotation):
         return v
 
 
+class TrackPatch(BaseModel):
+    """Feature-level edit of an existing track, applied against its head version"""
+
+    id: int
+    # Added or replaced features, matched to existing ones by frame
+    features: List[Feature] = Field(default_factory=lambda: [])
+    removeFrames: List[int] = Field(default_factory=lambda: [])
+    # Replaces the track's confidencePairs when given
+    confidencePairs: Optional[List[Tuple[str, float]]]
+    # Merged into the track's attributes; a null value removes the key
+    attributes: Optional[Dict[str, Any]]
+
+
 class GroupMember(BaseModel):
     ranges: List[List[int]]
 
@@ -128,6 +144,28 @@ class TrackItemSchema(Track):
     set: Optional[str]
     rev_created: int = 0
     rev_deleted: Optional[int]
+    rev_head: Optional[bool]
+    # Set when features are stored in FeatureChunkItemSchema documents instead
+    featureChunks: Optional[List[int]]
+    # Summary computed on save, so listings and filters can skip the features
+    maxConfidence: Optional[float]
+    topLabel: Optional[str]
+    featureCount: Optional[int]
+    hasGeometry: Optional[bool]
+    # Frame buckets spanned by [begin, end], a multikey index maps frames to tracks.
+    # Long tracks store a single marker bucket instead, so the array stays small
+    frameBuckets: Optional[List[int]]
+
+
+class FeatureChunkItemSchema(BaseModel):
+    dataset: PydanticObjectId
+    set: Optional[str]
+    id: int
+    chunk: int
+    features: List[Feature]
+    rev_created: int = 0
+    rev_deleted: Optional[int]
+    rev_head: Optional[bool]
 
 
 class GroupItemSchema(Group):
@@ -135,6 +173,7 @@ class GroupItemSchema(Group):
     set: Optional[str]
     rev_created: int = 0
     rev_deleted: Optional[int]
+    rev_head: Optional[bool]
 
 
 class RevisionLog(BaseModel):
@@ -149,6 +188,35 @@ class RevisionLog(BaseModel):
     set: Optional[str]
 
 
+class SetHead(BaseModel):
+    set: Optional[str]
+    head: int = 0  # Latest revision that could have changed this set
+
+
+class PendingRevision(BaseModel):
+    revision: int
+    set: Optional[str]  # Set the save writes to, None if it can write to every set
+    overwrite: bool = False  # Whether the save replaces every annotation of its set
+    exclusive: bool = False  # Whether no other save may run alongside it
+    committed: bool = False  # Logged, but an older pending revision holds the head back
+    expires: datetime  # When the save is undone as abandoned unless it renews its lease
+
+
+class RevisionCounter(BaseModel):
+    dataset: PydanticObjectId
+    revision: int = 0  # Highest revision handed out to a save
+    head: int = 0  # Highest revision that every older revision was finished before
+    compacted: int = 0  # Oldest revision still readable after history compaction
+    sets: List[SetHead] = Field(default_factory=lambda: [])
+    pending: List[PendingRevision] = Field(default_factory=lambda: [])
+
+
+class LabelCount(BaseModel):
+    dataset: PydanticObjectId
+    label: Optional[str]  # Type of the first confidence pair of each counted track
+    count: int = 0  # Number of live tracks with this label
+
+
 class NumericAttributeOptions(BaseModel):
     type: Literal['combo', 'slider']
     range: Optional[List[float]]
@@ -304,6 +372,56 @@ class BrandData(BaseModel):
         extra = 'forbid'
 
 
+def _trusted_fields(model: Type[BaseModel], data: dict) -> dict:
+    """
+    The result of model(**data).dict(exclude_none=True) for data that was already
+    validated against model: defaults fill missing fields and unknown keys are dropped.
+    """
+    serialized = {}
+    for name, field in model.__fields__.items():
+        value = data[name] if name in data else field.get_default()
+        if value is not None:
+            serialized[name] = value
+    return serialized
+
+
+def trusted_track(data: dict) -> dict:
+    """
+    Serialize a stored track without validating it again.
+
+    Only for records read back from the database, which were validated as Track
+    when they were written.  User input must go through Track instead.
+    """
+    track = _trusted_fields(Track, data)
+    track['features'] = [_trusted_fields(Feature, feature) for feature in track['features']]
+    return track
+
+
+def trusted_group(data: dict) -> dict:
+    """Serialize a stored group without validating it again, see trusted_track"""
+    group = _trusted_fields(Group, data)
+    group['members'] = {
+        key: _trusted_fields(GroupMember, member) for key, member in group['members'].items()
+    }
+    return group
+
+
+def _interpolate_bounds(
+    a_frame: int, a_bounds: List[int], b_frame: int, b_bounds: List[int], frame: int
+) -> List[int]:
+    delta = (frame - a_frame) / (b_frame - a_frame)
+    inverse_delta = 1 - delta
+    return [
+        round((abox * inverse_delta) + (bbox * delta)) for (abox, bbox) in zip(a_bounds, b_bounds)
+    ]
+
+
+def interpolate_at(a: Feature, b: Feature, frame: int) -> Feature:
+    """Linearly interpolated feature at a frame between keyframes a and b"""
+    bounds = _interpolate_bounds(a.frame, a.bounds, b.frame, b.bounds, frame)
+    return Feature(frame=frame, bounds=bounds, keyframe=False)
+
+
 # interpolate all features [a, b)
 def interpolate(a: Feature, b: Feature) -> List[Feature]:
     if a.interpolate is False:
@@ -311,13 +429,45 @@ def interpolate(a: Feature, b: Feature) -> List[Feature]:
     if b.frame <= a.frame:
         raise ValueError('b.frame must be larger than a.frame')
     feature_list = [a]
-    frame_range = b.frame - a.frame
-    for frame in range(1, frame_range):
-        delta = frame / frame_range
-        inverse_delta = 1 - delta
-        bounds: List[float] = [
-            round((abox * inverse_delta) + (bbox * delta))
-            for (abox, bbox) in zip(a.bounds, b.bounds)
-        ]
-        feature_list.append(Feature(frame=a.frame + frame, bounds=bounds, keyframe=False))
+    for frame in range(a.frame + 1, b.frame):
+        feature_list.append(interpolate_at(a, b, frame))
+    return feature_list
+
+
+def features_at(features: List[dict], start: int, end: int) -> List[Tuple[Feature, bool]]:
+    """
+    Features of a track in the frame window [start, end], as (feature, interpolated).
+
+    Frames between a keyframe with interpolate enabled and the next keyframe are
+    interpolated.  Only the features around the window are parsed.
+    """
+    features = sorted(features, key=lambda feature: feature['frame'])
+    frames = [feature['frame'] for feature in features]
+    # The keyframe before the window may interpolate into it, the one after may end it
+    first = max(bisect.bisect_right(frames, start) - 1, 0)
+    last = bisect.bisect_right(frames, end) + 1
+    window = [Feature(**feature) for feature in features[first:last]]
+    result: List[Tuple[Feature, bool]] = []
+    for index, a in enumerate(window):
+        if a.frame > end:
+            break
+        if a.frame >= start:
+            result.append((a, False))
+        if a.interpolate and index + 1 < len(window):
+            b = window[index + 1]
+            for frame in range(max(a.frame + 1, start), min(b.frame - 1, end) + 1):
+                result.append((interpolate_at(a, b, frame), True))
+    return result
+
+
+def interpolate_serialized(a: dict, b: dict) -> List[dict]:
+    """interpolate for serialized features, all features [a, b) as dicts"""
+    if a.get('interpolate') is False:
+        raise ValueError('Cannot interpolate feature without interpolate enabled')
+    if b['frame'] <= a['frame']:
+        raise ValueError('b.frame must be larger than a.frame')
+    feature_list = [a]
+    for frame in range(a['frame'] + 1, b['frame']):
+        bounds = _interpolate_bounds(a['frame'], a['bounds'], b['frame'], b['bounds'], frame)
+        feature_list.append({'frame': frame, 'bounds': bounds, 'keyframe': False})
     return feature_list
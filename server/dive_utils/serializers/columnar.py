@@ -0,0 +1,123 @@
+"""
+Columnar binary encoding of DIVE tracks, see docs/DataFormats.md.
+
+A stream is the magic bytes followed by one record per track, until end of stream.
+Each record is a little-endian uint32 header length, a UTF-8 JSON header holding
+every track field except features, then the packed feature columns:
+
+* frames: int32[columnLength]
+* bounds: int32[columnLength * 4], as x1, y1, x2, y2 for each feature
+* flags: uint8[columnLength], bits 0 and 1 are keyframe and interpolate, and bits
+  2 and 3 mark whether each of them was present at all
+
+The header carries the number of features as ``columnLength``, which is absent
+for tracks without a features field, such as summaries.
+
+Any other feature field is rare, so it is stored sparsely in the header under
+``extra`` as a map of feature index to the remaining fields.
+"""
+
+import json
+import struct
+from typing import BinaryIO, Generator, Iterable, List
+
+MAGIC = b'DIVC'
+VERSION = 2
+MIME_TYPE = 'application/x-dive-columnar'
+
+KEYFRAME = 1
+INTERPOLATE = 2
+HAS_KEYFRAME = 4
+HAS_INTERPOLATE = 8
+COLUMN_LENGTH = 'columnLength'
+
+_header_length = struct.Struct('<I')
+_column_fields = {'frame', 'bounds', 'keyframe', 'interpolate'}
+
+
+def encode_track(track: dict) -> bytes:
+    """Encode a single track record"""
+    header = {key: value for key, value in track.items() if key != 'features'}
+    features: List[dict] = []
+    if 'features' in track:
+        features = track['features']
+        header[COLUMN_LENGTH] = len(features)
+    extra = {}
+    frames = []
+    bounds = []
+    flags = bytearray()
+    for index, feature in enumerate(features):
+        frames.append(feature['frame'])
+        bounds.extend(int(value) for value in feature['bounds'])
+        flag = 0
+        if 'keyframe' in feature:
+            flag |= HAS_KEYFRAME | (KEYFRAME if feature['keyframe'] else 0)
+        if 'interpolate' in feature:
+            flag |= HAS_INTERPOLATE | (INTERPOLATE if feature['interpolate'] else 0)
+        flags.append(flag)
+        others = {key: value for key, value in feature.items() if key not in _column_fields}
+        if others:
+            extra[str(index)] = others
+    if extra:
+        header['extra'] = extra
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    count = len(features)
+    return b''.join(
+        [
+            _header_length.pack(len(encoded)),
+            encoded,
+            struct.pack(f'<{count}i', *frames),
+            struct.pack(f'<{count * 4}i', *bounds),
+            bytes(flags),
+        ]
+    )
+
+
+def encode_tracks(tracks: Iterable[dict]) -> Generator[bytes, None, None]:
+    """Encode a stream of tracks, one chunk per track"""
+    yield MAGIC + bytes([VERSION])
+    for track in tracks:
+        yield encode_track(track)
+
+
+def _read(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of columnar track stream')
+    return data
+
+
+def decode_tracks(stream: BinaryIO) -> Generator[dict, None, None]:
+    """Decode a stream produced by encode_tracks back into DIVE track dicts"""
+    preamble = stream.read(len(MAGIC) + 1)
+    if preamble[: len(MAGIC)] != MAGIC:
+        raise ValueError('Not a columnar track stream')
+    if preamble[len(MAGIC)] != VERSION:
+        raise ValueError(f'Unsupported columnar track stream version {preamble[len(MAGIC)]}')
+    while True:
+        prefix = stream.read(_header_length.size)
+        if not prefix:
+            return
+        if len(prefix) != _header_length.size:
+            raise ValueError('Unexpected end of columnar track stream')
+        (length,) = _header_length.unpack(prefix)
+        track = json.loads(_read(stream, length).decode('utf-8'))
+        hasFeatures = COLUMN_LENGTH in track
+        count = track.pop(COLUMN_LENGTH, 0)
+        extra = track.pop('extra', {})
+        frames = struct.unpack(f'<{count}i', _read(stream, count * 4))
+        bounds = struct.unpack(f'<{count * 4}i', _read(stream, count * 16))
+        flags = _read(stream, count)
+        features = []
+        for index in range(count):
+            flag = flags[index]
+            feature = {'frame': frames[index], 'bounds': list(bounds[index * 4 : index * 4 + 4])}
+            if flag & HAS_KEYFRAME:
+                feature['keyframe'] = bool(flag & KEYFRAME)
+            if flag & HAS_INTERPOLATE:
+                feature['interpolate'] = bool(flag & INTERPOLATE)
+            feature.update(extra.get(str(index), {}))
+            features.append(feature)
+        if hasFeatures:
+            track['features'] = features
+        yield track
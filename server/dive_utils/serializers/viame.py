@@ -2,16 +2,25 @@
 VIAME Fish format deserializer
 """
 
+import codecs
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import datetime
 import io
 import json
+import multiprocessing
 import os
 import re
-from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple, Union
 
 from dive_utils import constants, types
-from dive_utils.models import Feature, Track, interpolate
+from dive_utils.models import (
+    Feature,
+    Track,
+    exceeds_thresholds,
+    interpolate_serialized,
+    trusted_track,
+)
 
 
 def format_timestamp(fps: int, frame: int) -> str:
@@ -107,6 +116,18 @@ def create_geoJSONFeature(features: Dict[str, Any], type: str, coords: List[Any]
     features['geometry']['features'].append(feature)
 
 
+_NUMBER = r'-?[0-9]+\.*-?[0-9]*'
+# Every column that is not a confidence pair is classified by its prefix in a single match
+_COLUMN_TOKEN = re.compile(
+    r'\((?:'
+    rf'kp\) (?P<keypoint>head|tail) (?P<x>{_NUMBER}) (?P<y>{_NUMBER})'
+    r'|atr\) (?P<atr>.*?)\s(?P<atrValue>.+)'
+    r'|trk-atr\) (?P<trackAtr>.*?)\s(?P<trackAtrValue>.+)'
+    rf'|poly\) (?P<poly>(?:{_NUMBER}\s*)+)'
+    r')'
+)
+
+
 def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
     """
     Parse a single CSV line into its composite track and detection parts
@@ -124,34 +145,23 @@ def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
     start = 9 + len(sorted_confidence_pairs) * 2
 
     for j in range(start, len(row)):
-        # (kp) head x y
-        head_regex = re.match(r"^\(kp\) head (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)", row[j])
-        if head_regex:
-            point = [float(head_regex[1]), float(head_regex[2])]
-            head_tail.append(point)
-            create_geoJSONFeature(features, 'Point', point, 'head')
-
-        # (kp) tail x y
-        tail_regex = re.match(r"^\(kp\) tail (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)", row[j])
-        if tail_regex:
-            point = [float(tail_regex[1]), float(tail_regex[2])]
+        token = _COLUMN_TOKEN.match(row[j])
+        if token is None:
+            continue
+        if token['keypoint']:
+            # (kp) head x y or (kp) tail x y
+            point = [float(token['x']), float(token['y'])]
             head_tail.append(point)
-            create_geoJSONFeature(features, 'Point', point, 'tail')
-
-        # (atr) text
-        atr_regex = re.match(r"^\(atr\) (.*?)\s(.+)", row[j])
-        if atr_regex:
-            attributes[atr_regex[1]] = _deduceType(atr_regex[2])
-
-        # (trk-atr) text
-        trk_regex = re.match(r"^\(trk-atr\) (.*?)\s(.+)", row[j])
-        if trk_regex:
-            track_attributes[trk_regex[1]] = _deduceType(trk_regex[2])
-
-        # (poly) x1 y1 x2 y2 ...
-        poly_regex = re.match(r"^(\(poly\)) ((?:-?[0-9]+\.*-?[0-9]*\s*)+)", row[j])
-        if poly_regex:
-            temp = [float(x) for x in poly_regex[2].split()]
+            create_geoJSONFeature(features, 'Point', point, token['keypoint'])
+        elif token['atr'] is not None:
+            # (atr) text
+            attributes[token['atr']] = _deduceType(token['atrValue'])
+        elif token['trackAtr'] is not None:
+            # (trk-atr) text
+            track_attributes[token['trackAtr']] = _deduceType(token['trackAtrValue'])
+        else:
+            # (poly) x1 y1 x2 y2 ...
+            temp = [float(x) for x in token['poly'].split()]
             coords = list(zip(temp[::2], temp[1::2]))
             create_geoJSONFeature(features, 'Polygon', coords)
 
@@ -172,17 +182,27 @@ def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
     return features, attributes, track_attributes, sorted_confidence_pairs
 
 
-def _parse_row_for_tracks(row: List[str]) -> Tuple[Feature, Dict, Dict, List]:
+def _parse_row_for_tracks(row: List[str]) -> Tuple[dict, Dict, Dict, List]:
+    """Parse a CSV line into a serialized feature and the rest of its parts"""
     head_tail_feature, attributes, track_attributes, confidence_pairs = _parse_row(row)
     _, _, frame, bounds, fishLength = row_info(row)
 
-    feature = Feature(
-        frame=frame,
-        bounds=bounds,
-        attributes=attributes or None,
-        fishLength=fishLength if fishLength > 0 else None,
-        **head_tail_feature,
-    )
+    if head_tail_feature:
+        feature = Feature(
+            frame=frame,
+            bounds=bounds,
+            attributes=attributes or None,
+            fishLength=fishLength if fishLength > 0 else None,
+            **head_tail_feature,
+        ).dict(exclude_none=True)
+    else:
+        # Without geometry every field is already in its validated form,
+        # so the common detection row skips building a model
+        feature = {'frame': frame, 'bounds': bounds}
+        if attributes:
+            feature['attributes'] = dict(attributes)
+        if fishLength > 0:
+            feature['fishLength'] = fishLength
 
     # Pass the rest of the unchanged info through as well
     return feature, attributes, track_attributes, confidence_pairs
@@ -271,198 +291,310 @@ def load_json_as_track_and_attributes(
     return json_data, metadata_attributes
 
 
-def custom_sort(row):
-    if len(row) == 0 or row[0].startswith("#"):
-        return (0, 0)
-    else:
-        return (1, int(row[2]))
+def iter_lines(chunks: Iterable[bytes]) -> Generator[str, None, None]:
+    """Decode a stream of UTF-8 byte chunks, such as a file download, into lines"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def _remap_track_frames(
+    tracks: Dict[int, dict], foundImages: List[Dict[str, int]], warnings: List[str]
+) -> Dict[int, dict]:
+    """Map the CSV frames of tracks onto the frames of the images that were found"""
+    minFrame = float('inf')
+    maxFrame = float('-inf')
+    frameMapper = {}
+    for index, item in enumerate(foundImages):
+        k = index + 1
+        if k < len(foundImages):
+            item_difference = foundImages[k]['csvFrame'] - item['csvFrame']
+            if (
+                item['csvFrame'] + item_difference != foundImages[k]['csvFrame']
+                or item['frame'] + item_difference != foundImages[k]['frame']
+            ):
+                # There are misaliged video sequences so we are going to
+                # utilize the imageMap
+                # We have misaligned video sequences so we handle that
+                # with the image map if possible
+                warnings.append(
+                    (
+                        'A subsampling of images were used with the CSV '
+                        'but they were not sequential'
+                        f'foundImage: {foundImages[k]} item: {item}'
+                        f'item difference: {item_difference}'
+                    )
+                )
+        frameMapper[item['csvFrame']] = item['frame']
+        minFrame = min(minFrame, item['csvFrame'])
+        maxFrame = max(maxFrame, item['csvFrame'])
+
+    # Now we need to remap and filter tracks that are outside the frame range
+    newDataMap: Dict[int, dict] = {}
+    for track in tracks.values():
+        if track['end'] >= minFrame or track['begin'] <= maxFrame:
+            begin = track['begin']
+            end = track['end']
+            if begin < minFrame or begin not in frameMapper.keys():
+                begin = frameMapper[minFrame]
+            else:
+                begin = frameMapper[begin]
+            if end > maxFrame or end not in frameMapper.keys():
+                end = frameMapper[maxFrame]
+            else:
+                end = frameMapper[end]
+            features = [
+                # Empty optional fields are dropped, frame 0 is kept
+                {
+                    **{key: value for key, value in subFeature.items() if value},
+                    'frame': frameMapper[subFeature['frame']],
+                    'bounds': subFeature['bounds'],
+                }
+                for subFeature in track['features']
+                # feature frame is within the subFeature add and remap the frame to the new time
+                if subFeature['frame'] >= minFrame and subFeature['frame'] <= maxFrame
+            ]
+            if len(features):
+                # Only add the track if it has features
+                newDataMap[track['id']] = {
+                    **track,
+                    'begin': begin,
+                    'end': end,
+                    'features': features,
+                }
+    return newDataMap
+
+
+class _CsvTracks:
+    """
+    Tracks and attribute statistics read from the data rows of a VIAME CSV.
+
+    Rows need not be sorted, so every value taken from a row remembers its
+    (frame, row number) and the result matches reading the rows sorted by frame.
+    Readers of disjoint track ids can be merged, which allows parallel parsing.
+    """
+
+    def __init__(self, imageMap: Optional[Dict[str, int]]):
+        self.imageMap = imageMap
+        self.tracks: Dict[int, dict] = {}
+        self.metadata_attributes: Dict[str, Dict[str, Any]] = {}
+        self.test_vals: Dict[str, Dict[str, int]] = {}
+        self.multiFrameTracks = False
+        self.missingImages: List[str] = []
+        # (image, frame, csvFrame) of each found image, with the position it was first seen
+        self.foundImages: Dict[Tuple[str, int, int], Tuple[int, int]] = {}
+        # Rows sorted by frame would visit the latest frame last, so values taken from
+        # a row are kept only while its (frame, row number) is the greatest seen.
+        self.latest: Dict[Tuple[int, Optional[str]], Tuple[int, int]] = {}
+        self.firstSeen: Dict[Tuple[str, str], Tuple[int, int]] = {}
+
+    def _is_latest(self, key: Tuple[int, Optional[str]], order: Tuple[int, int]) -> bool:
+        if order < self.latest.get(key, order):
+            return False
+        self.latest[key] = order
+        return True
+
+    def _count_attribute(self, atr_type: str, key: str, val, order: Tuple[int, int]):
+        create_attributes(self.metadata_attributes, self.test_vals, atr_type, key, val)
+        if val is not None:
+            seen = (f'{atr_type}_{key}', f'{val}')
+            self.firstSeen[seen] = min(self.firstSeen.get(seen, order), order)
+
+    def read(self, numbered_rows: Iterable[Tuple[int, List[str]]]) -> '_CsvTracks':
+        """Read data rows, each paired with its row number in the file"""
+        unsorted: Set[int] = set()
+        for rowNumber, row in numbered_rows:
+            (
+                feature,
+                attributes,
+                track_attributes,
+                confidence_pairs,
+            ) = _parse_row_for_tracks(row)
+
+            trackId = int(row[0])
+            imageFile = row[1]
+            frame = feature['frame']
+            order = (frame, rowNumber)
+            if self.imageMap:
+                # validate image ordering if the imageMap is provided
+                imageName, _ = os.path.splitext(os.path.basename(imageFile))
+                expectedFrameNumber = self.imageMap.get(imageName)
+                if expectedFrameNumber is None:
+                    self.missingImages.append(imageFile)
+                else:
+                    found = (imageName, expectedFrameNumber, frame)
+                    self.foundImages[found] = min(self.foundImages.get(found, order), order)
+
+            track = self.tracks.get(trackId)
+            if track is None:
+                track = self.tracks[trackId] = {
+                    'id': trackId,
+                    'begin': frame,
+                    'end': frame,
+                    'confidencePairs': [],
+                    'attributes': {},
+                    'features': [],
+                }
+            else:
+                # trackId was already in tracks, so the track consists of multiple frames
+                self.multiFrameTracks = True
+                if frame < track['end']:
+                    unsorted.add(trackId)
+            track['begin'] = min(frame, track['begin'])
+            track['end'] = max(track['end'], frame)
+            track['features'].append(feature)
+            if self._is_latest((trackId, None), order):
+                track['confidencePairs'] = confidence_pairs
+
+            for key, val in track_attributes.items():
+                if self._is_latest((trackId, key), order):
+                    track['attributes'][key] = val
+                self._count_attribute('track', key, val, order)
+            for key, val in attributes.items():
+                self._count_attribute('detection', key, val, order)
+
+        for trackId in unsorted:
+            self.tracks[trackId]['features'].sort(key=lambda feature: feature['frame'])
+        return self
+
+    def merge(self, other: '_CsvTracks'):
+        """Add the tracks and statistics of a reader of other track ids"""
+        self.tracks.update(other.tracks)
+        self.latest.update(other.latest)
+        self.multiFrameTracks = self.multiFrameTracks or other.multiFrameTracks
+        self.missingImages += other.missingImages
+        for found, order in other.foundImages.items():
+            self.foundImages[found] = min(self.foundImages.get(found, order), order)
+        for seen, order in other.firstSeen.items():
+            self.firstSeen[seen] = min(self.firstSeen.get(seen, order), order)
+        for attribute_key, attribute in other.metadata_attributes.items():
+            self.metadata_attributes.setdefault(attribute_key, attribute)
+            counts = self.test_vals.setdefault(attribute_key, {})
+            for valstring, count in other.test_vals[attribute_key].items():
+                counts[valstring] = counts.get(valstring, 0) + count
+
+    def finish(self) -> Tuple[types.DIVEAnnotationSchema, dict, List[str]]:
+        """Check image order, remap frames and type the attributes of every row read"""
+        tracks = self.tracks
+        warnings: List[str] = []
+        sortedImages = [
+            {'image': image, 'frame': frame, 'csvFrame': csvFrame}
+            for (image, frame, csvFrame), _ in sorted(
+                self.foundImages.items(), key=lambda item: item[1]
+            )
+        ]
+
+        if self.imageMap and len(self.missingImages) and len(sortedImages):
+            tracks = _remap_track_frames(tracks, sortedImages, warnings)
+        elif len(sortedImages) and len(self.missingImages) == 0 and self.multiFrameTracks:
+            # check ordering
+            for index, item in enumerate(sortedImages):
+                k = index + 1
+                if k < len(sortedImages):
+                    # sometimes the frame difference isn't 1
+                    item_difference = sortedImages[k]['csvFrame'] - item['csvFrame']
+                    if (
+                        item['csvFrame'] + item_difference != sortedImages[k]['csvFrame']
+                        or item['frame'] + item_difference != sortedImages[k]['frame']
+                    ):
+                        # We have misaligned video sequences so we error out
+                        warnings.append(
+                            (
+                                'Images were provided in an unexpected order '
+                                'and dataset contains multi-frame tracks.'
+                                f'foundImage: {sortedImages[k]} item: {item}'
+                                f'itemDifference: {item_difference}'
+                            )
+                        )
+
+        # Value order decides the attribute types, so match the order of sorted rows
+        test_vals = {
+            attribute_key: dict(
+                sorted(counts.items(), key=lambda item: self.firstSeen[(attribute_key, item[0])])
+            )
+            for attribute_key, counts in self.test_vals.items()
+        }
+        # Now we process all the metadata_attributes for the types
+        calculate_attribute_types(self.metadata_attributes, test_vals)
+        annotations: types.DIVEAnnotationSchema = {
+            'tracks': {str(trackId): track for trackId, track in tracks.items()},
+            'groups': {},
+            'version': constants.AnnotationsCurrentVersion,
+        }
+        return annotations, self.metadata_attributes, warnings
+
+
+def _read_csv_partition(
+    numbered_rows: List[Tuple[int, List[str]]], imageMap: Optional[Dict[str, int]]
+) -> _CsvTracks:
+    """Parse one partition of rows in a worker process"""
+    reader = _CsvTracks(imageMap).read(numbered_rows)
+    # Only needed while reading, so it is not sent back to the parent
+    reader.latest = {}
+    reader.imageMap = None
+    return reader
 
 
 def load_csv_as_tracks_and_attributes(
-    rows: List[str],
+    rows: Iterable[str],
     imageMap: Optional[Dict[str, int]] = None,
+    processes: int = 1,
 ) -> Tuple[types.DIVEAnnotationSchema, dict, List[str], Optional[str]]:
     """
     Convert VIAME CSV to json tracks
 
+    Rows are read in a single pass and may be produced lazily, such as by iter_lines
+    over a download, so the file never has to be held in memory.  Rows need not be
+    sorted: the features of a track are put in frame order once every row is read,
+    and the result is the same as reading the rows sorted by frame.
+
+    With more than one process, rows are partitioned by track id and each partition
+    is parsed in its own process.  The partitions are held in memory until dispatched.
+
     :param rows: string rows of a VIAME CSV file
     :param imageMap: map of image names to frame numbers.  keys do NOT include file extension
+    :param processes: number of worker processes to parse rows with
     """
-    reader = csv.reader(row for row in rows)
-    tracks: Dict[int, Track] = {}
-    metadata_attributes: Dict[str, Dict[str, Any]] = {}
-    test_vals: Dict[str, Dict[str, int]] = {}
-    multiFrameTracks = False
-    missingImages: List[str] = []
-    foundImages: List[Dict[str, Any]] = []  # {image:str, frame: int, csvFrame: int}
-    sortedlist = sorted(reader, key=custom_sort)
-    warnings: List[str] = []
     fps = None
-    for row in sortedlist:
-        if len(row) == 0 or row[0].startswith('#'):
-            # This is not a data row
-            if len(row) > 0 and row[0] == '# metadata':
-                if row[1].startswith('Fps: '):
-                    fps_splits = row[1].split(':')
-                    if len(fps_splits) > 1:
-                        fps = fps_splits[1]
-            continue
-        (
-            feature,
-            attributes,
-            track_attributes,
-            confidence_pairs,
-        ) = _parse_row_for_tracks(row)
-
-        trackId, imageFile, _, _, _ = row_info(row)
-        if imageMap:
-            # validate image ordering if the imageMap is provided
-            imageName, _ = os.path.splitext(os.path.basename(imageFile))
-            expectedFrameNumber = imageMap.get(imageName)
-            foundFrame = expectedFrameNumber
-            if expectedFrameNumber is None:
-                foundFrame = -1
-            foundImage = {'image': imageName, 'frame': foundFrame, 'csvFrame': feature.frame}
-            hasImageAlready = foundImage in foundImages
-            if foundFrame != -1 and not hasImageAlready:
-                foundImages.append(foundImage)
-            if expectedFrameNumber is None:
-                missingImages.append(imageFile)
-
-        if trackId not in tracks:
-            tracks[trackId] = Track(begin=feature.frame, end=feature.frame, id=trackId)
-        else:
-            track = tracks[trackId]
-            multiFrameTracks = True
-            maxFeatureFrame = float('-inf')
-            for subFeature in track.features:
-                maxFeatureFrame = max(maxFeatureFrame, subFeature.frame)
-            if feature.frame < maxFeatureFrame:
-                # trackId was already in tracks, so the track consists of multiple frames
-                raise ValueError(
-                    (
-                        'Images were provided in an unexpected order '
-                        'and dataset contains multi-frame tracks. '
-                        f'featureFrame: {feature.frame} maxFeatureFrame: {maxFeatureFrame}'
-                        f'TrackId: {trackId}'
-                    )
-                )
 
-        track = tracks[trackId]
-        track.begin = min(feature.frame, track.begin)
-        track.end = max(track.end, feature.frame)
-        track.features.append(feature)
-        track.confidencePairs = confidence_pairs
-
-        for key, val in track_attributes.items():
-            track.attributes[key] = val
-            create_attributes(metadata_attributes, test_vals, 'track', key, val)
-        for key, val in attributes.items():
-            create_attributes(metadata_attributes, test_vals, 'detection', key, val)
-
-    if imageMap and len(missingImages) and len(foundImages):
-        minFrame = float('inf')
-        maxFrame = float('-inf')
-        frameMapper = {}
-        filteredImages = [item for item in foundImages if item['frame'] != -1]
-        for index, item in enumerate(filteredImages):
-            if item['frame'] == -1:
+    def data_rows() -> Generator[Tuple[int, List[str]], None, None]:
+        nonlocal fps
+        for rowNumber, row in enumerate(csv.reader(rows)):
+            if len(row) == 0 or row[0].startswith('#'):
+                # This is not a data row
+                if len(row) > 0 and row[0] == '# metadata':
+                    if row[1].startswith('Fps: '):
+                        fps_splits = row[1].split(':')
+                        if len(fps_splits) > 1:
+                            fps = fps_splits[1]
                 continue
-            k = index + 1
-            if k < len(filteredImages):
-                item_difference = foundImages[k]['csvFrame'] - item['csvFrame']
-                if (
-                    item['csvFrame'] + item_difference != filteredImages[k]['csvFrame']
-                    or item['frame'] + item_difference != filteredImages[k]['frame']
-                ):
-                    # There are misaliged video sequences so we are going to
-                    # utilize the imageMap
-                    # We have misaligned video sequences so we handle that
-                    # with the image map if possible
-                    warnings.append(
-                        (
-                            'A subsampling of images were used with the CSV '
-                            'but they were not sequential'
-                            f'foundImage: {filteredImages[k]} item: {item}'
-                            f'item difference: {item_difference}'
-                        )
-                    )
-            frameMapper[item['csvFrame']] = item['frame']
-            minFrame = min(minFrame, item['csvFrame'])
-            maxFrame = max(maxFrame, item['csvFrame'])
-
-        # Now we need to remap and filter tracks that are outside the frame range
-        trackValArr = list(tracks.values())
-        newDataMap: Dict[int, Track] = {}
-        for track in trackValArr:
-            if track.end >= minFrame or track.begin <= maxFrame:
-                begin = track.begin
-                end = track.end
-                if begin < minFrame or begin not in frameMapper.keys():
-                    begin = frameMapper[minFrame]
-                else:
-                    begin = frameMapper[begin]
-                if end > maxFrame or end not in frameMapper.keys():
-                    end = frameMapper[maxFrame]
-                else:
-                    end = frameMapper[end]
-                newTrack = Track(
-                    begin=begin,
-                    end=end,
-                    id=track.id,
-                    attributes=track.attributes,
-                    confidencePairs=track.confidencePairs,
-                )
-                for subFeature in track.features:
-                    # feature frame is within the subFeature add and remap the frame to the new time
-                    if subFeature.frame >= minFrame and subFeature.frame <= maxFrame:
-                        newFeature = Feature(
-                            frame=subFeature.frame,
-                            bounds=subFeature.bounds,
-                            attributes=subFeature.attributes or None,
-                            geometry=subFeature.geometry or None,
-                            head=subFeature.head or None,
-                            tail=subFeature.tail or None,
-                            fishLength=subFeature.fishLength or None,
-                            interpolate=subFeature.interpolate or None,
-                            keyframe=subFeature.keyframe or None,
-                        )
-                        newFeature.frame = frameMapper[newFeature.frame]
-                        newTrack.features.append(newFeature)
-                if len(newTrack.features):
-                    # Only add the track if it has features
-                    newDataMap[newTrack.id] = newTrack
-        # Set the original tracks to the new list
-        tracks = newDataMap
-    elif len(foundImages) and len(missingImages) == 0 and multiFrameTracks:
-        # check ordering
-        for index, item in enumerate(foundImages):
-            k = index + 1
-            if k < len(foundImages):
-                # sometimes the frame difference isn't 1
-                item_difference = foundImages[k]['csvFrame'] - item['csvFrame']
-                if (
-                    item['csvFrame'] + item_difference != foundImages[k]['csvFrame']
-                    or item['frame'] + item_difference != foundImages[k]['frame']
-                ):
-                    # We have misaligned video sequences so we error out
-                    warnings.append(
-                        (
-                            'Images were provided in an unexpected order '
-                            'and dataset contains multi-frame tracks.'
-                            f'foundImage: {foundImages[k]} item: {item}'
-                            f'itemDifference: {item_difference}'
-                        )
-                    )
+            yield rowNumber, row
 
-    # Now we process all the metadata_attributes for the types
-    trackarr = tracks.items()
-    calculate_attribute_types(metadata_attributes, test_vals)
-    annotations: types.DIVEAnnotationSchema = {
-        'tracks': {str(trackId): track.dict(exclude_none=True) for trackId, track in trackarr},
-        'groups': {},
-        'version': constants.AnnotationsCurrentVersion,
-    }
+    if processes <= 1:
+        result = _CsvTracks(imageMap).read(data_rows())
+    else:
+        partitions: List[List[Tuple[int, List[str]]]] = [[] for _ in range(processes)]
+        for rowNumber, row in data_rows():
+            partitions[int(row[0]) % processes].append((rowNumber, row))
+        result = _CsvTracks(imageMap)
+        # Spawned workers do not inherit the threads and locks of a web server process
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(processes, mp_context=context) as pool:
+            futures = [
+                pool.submit(_read_csv_partition, partition, imageMap)
+                for partition in partitions
+                if partition
+            ]
+            partitions.clear()
+            for future in futures:
+                result.merge(future.result())
+    annotations, metadata_attributes, warnings = result.finish()
     return annotations, metadata_attributes, warnings, fps
 
 
@@ -475,6 +607,7 @@ def export_tracks_as_csv(
     header=True,
     typeFilter=None,
     revision=None,
+    trusted=False,
 ) -> Generator[str, None, None]:
     """
     Export track json to a CSV format.
@@ -485,6 +618,7 @@ def export_tracks_as_csv(
     :param fps: if FPS is set, column 2 will be video timestamp derived from (frame / fps)
     :param header: include or omit header
     :param typeFilter: set of track types to only export if not empty
+    :param trusted: tracks were read back from the database and need no validation
     """
     if thresholds is None:
         thresholds = {}
@@ -502,77 +636,83 @@ def export_tracks_as_csv(
         writeHeader(writer, metadata)
 
     for t in track_iterator:
-        track = Track(**t)
-        if (not excludeBelowThreshold) or track.exceeds_thresholds(thresholds, typeFilter):
+        # Stored tracks were validated on write, anything else is validated here
+        track = trusted_track(t) if trusted else Track(**t).dict(exclude_none=True)
+        if (not excludeBelowThreshold) or exceeds_thresholds(
+            track['confidencePairs'], thresholds, typeFilter
+        ):
             # filter by types if applicable
             if typeFilter:
-                confidence_pairs = [item for item in track.confidencePairs if item[0] in typeFilter]
+                confidence_pairs = [
+                    item for item in track['confidencePairs'] if item[0] in typeFilter
+                ]
                 # skip line if no confidence pairs
                 if not confidence_pairs:
                     continue
             else:
-                confidence_pairs = track.confidencePairs
+                confidence_pairs = track['confidencePairs']
 
             sorted_confidence_pairs = sorted(
                 confidence_pairs, key=lambda item: item[1], reverse=True
             )
 
-            for index, keyframe in enumerate(track.features):
+            track_features = track['features']
+            for index, keyframe in enumerate(track_features):
                 features = [keyframe]
 
                 # If this is not the last keyframe, and interpolation is
                 # enabled for this keyframe, interpolate
-                if keyframe.interpolate and index < len(track.features) - 1:
-                    nextKeyframe = track.features[index + 1]
+                if keyframe.get('interpolate') and index < len(track_features) - 1:
+                    nextKeyframe = track_features[index + 1]
                     # interpolate all features in [a,b)
-                    features = interpolate(keyframe, nextKeyframe)
+                    features = interpolate_serialized(keyframe, nextKeyframe)
 
                 for feature in features:
+                    frame = feature['frame']
                     columns = [
-                        track.id,
+                        track['id'],
                         "",
-                        feature.frame,
-                        *feature.bounds,
+                        frame,
+                        *feature['bounds'],
                         sorted_confidence_pairs[0][1],
-                        feature.fishLength or -1,
+                        feature.get('fishLength') or -1,
                     ]
 
                     # If FPS is set, column 2 will be video timestamp
                     if fps is not None and fps > 0:
-                        columns[1] = format_timestamp(fps, feature.frame)
+                        columns[1] = format_timestamp(fps, frame)
                     # else if filenames is set, column 2 will be image file name
-                    elif filenames and feature.frame < len(filenames):
-                        columns[1] = filenames[feature.frame]
+                    elif filenames and frame < len(filenames):
+                        columns[1] = filenames[frame]
 
                     for pair in sorted_confidence_pairs:
                         columns.extend(list(pair))
 
-                    if feature.attributes:
-                        for key, val in feature.attributes.items():
+                    if feature.get('attributes'):
+                        for key, val in feature['attributes'].items():
                             columns.append(f"(atr) {key} {valueToString(val)}")
 
-                    if track.attributes:
-                        for key, val in track.attributes.items():
+                    if track['attributes']:
+                        for key, val in track['attributes'].items():
                             columns.append(f"(trk-atr) {key} {valueToString(val)}")
 
-                    if feature.geometry and "FeatureCollection" == feature.geometry.type:
-                        for geoJSONFeature in feature.geometry.features:
-                            if 'Polygon' == geoJSONFeature.geometry.type:
+                    geometry = feature.get('geometry')
+                    if geometry and "FeatureCollection" == geometry['type']:
+                        for geoJSONFeature in geometry['features']:
+                            if 'Polygon' == geoJSONFeature['geometry']['type']:
                                 # Coordinates need to be flattened out from their list of tuples
                                 coordinates = [
                                     item
-                                    for sublist in geoJSONFeature.geometry.coordinates[
-                                        0
-                                    ]  # type: ignore
-                                    for item in sublist  # type: ignore
+                                    for sublist in geoJSONFeature['geometry']['coordinates'][0]
+                                    for item in sublist
                                 ]
                                 columns.append(
                                     f"(poly) {' '.join(map(lambda x: str(round(x)), coordinates))}"
                                 )
-                            if 'Point' == geoJSONFeature.geometry.type:
-                                coordinates = geoJSONFeature.geometry.coordinates  # type: ignore
+                            if 'Point' == geoJSONFeature['geometry']['type']:
+                                coordinates = geoJSONFeature['geometry']['coordinates']
                                 columns.append(
-                                    f"(kp) {geoJSONFeature.properties['key']} "
+                                    f"(kp) {geoJSONFeature['properties']['key']} "
                                     f"{round(coordinates[0])} {round(coordinates[1])}"
                                 )
                             # TODO: support for multiple GeoJSON Objects of the same type
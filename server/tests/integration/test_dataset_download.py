@@ -1,10 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 import io
 import json
 import os
+import threading
 from zipfile import ZipFile
 
+from girder_client import GirderClient, HttpError
 import pytest
 
+from dive_utils import constants, fromMeta
+from dive_utils.models import Track
+
 from .conftest import getClient, getTestFolder, match_user_server_data, users
 
 
@@ -21,6 +27,171 @@ def test_download_annotation(user: dict):
             assert len(downloaded) == expected[0]['trackCount']
 
 
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_frame_window(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        all_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        windowed = client.get(
+            f'dive_annotation/track?folderId={dataset["_id"]}&frameStart=5&frameEnd=10'
+        )
+        expected = [t['id'] for t in all_tracks if t['begin'] <= 10 and t['end'] >= 5]
+        assert sorted([t['id'] for t in windowed]) == sorted(expected)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_continuation(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        all_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        paged = []
+        continuation = ''
+        while True:
+            response = client.sendRestRequest(
+                'GET',
+                f'dive_annotation/track?folderId={dataset["_id"]}&limit=2&continuation={continuation}',
+                jsonResp=False,
+            )
+            paged.extend(response.json())
+            continuation = response.headers.get('Dive-Continuation')
+            if not continuation:
+                break
+        assert [t['id'] for t in paged] == [t['id'] for t in all_tracks]
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_continuation_other_sort(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        response = client.sendRestRequest(
+            'GET',
+            f'dive_annotation/track?folderId={dataset["_id"]}&limit=1&sort=begin',
+            jsonResp=False,
+        )
+        # Tokens resume after an id, so they are only sent for listings sorted by id
+        assert 'Dive-Continuation' not in response.headers
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_summary(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        all_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        summaries = client.get(f'dive_annotation/track?folderId={dataset["_id"]}&fields=summary')
+        assert len(summaries) == len(all_tracks)
+        for track, summary in zip(all_tracks, summaries):
+            assert 'features' not in summary
+            assert summary['id'] == track['id']
+            assert summary['featureCount'] == len(track['features'])
+            if track['confidencePairs']:
+                assert summary['maxConfidence'] == max(c for _, c in track['confidencePairs'])
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_changes(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        all_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        changes = client.get(f'dive_annotation/changes?folderId={dataset["_id"]}&since=0')
+        assert len(changes['tracks']['upsert']) == len(all_tracks)
+        assert changes['tracks']['delete'] == []
+        head = changes['revision']
+        unchanged = client.get(f'dive_annotation/changes?folderId={dataset["_id"]}&since={head}')
+        assert unchanged['tracks'] == {'upsert': [], 'delete': []}
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_not_modified(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        path = f'dive_annotation/track?folderId={dataset["_id"]}'
+        first = client.sendRestRequest('GET', path, jsonResp=False)
+        etag = first.headers['ETag']
+        cached = client.sendRestRequest(
+            'GET', path, headers={'If-None-Match': etag}, jsonResp=False
+        )
+        assert cached.status_code == 304
+        assert cached.content == b''
+        pinned = client.sendRestRequest('GET', f'{path}&revision=0', jsonResp=False)
+        assert 'immutable' in pinned.headers['Cache-Control']
+        assert pinned.headers['ETag'] != etag
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_annotation_cached(user: dict, admin_client: GirderClient):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        path = f'dive_annotation/track?folderId={dataset["_id"]}'
+        first = client.get(path)
+        hits = admin_client.get('dive_annotation/cache')['hits']
+        assert client.get(path) == first
+        assert admin_client.get('dive_annotation/cache')['hits'] == hits + 1
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_bulk(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    datasets = list(client.listFolder(privateFolder['_id']))
+    body = [{'folderId': dataset['_id']} for dataset in datasets]
+    body.append({'folderId': '000000000000000000000000'})
+    response = client.sendRestRequest('POST', 'dive_annotation/bulk', json=body, jsonResp=False)
+    lines = [json.loads(line) for line in response.content.decode('utf-8').splitlines()]
+    assert lines[-1]['type'] == 'error'
+    for dataset in datasets:
+        tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        bulk_tracks = [
+            line['data']
+            for line in lines
+            if line['type'] == 'track' and line['folderId'] == dataset['_id']
+        ]
+        assert bulk_tracks == tracks
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_frame(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        detections = client.get(f'dive_annotation/frame?folderId={dataset["_id"]}&frame=5')
+        keyframes = {
+            track['id']
+            for track in tracks
+            for feature in track['features']
+            if feature['frame'] == 5
+        }
+        found = {detection['trackId'] for detection in detections}
+        assert keyframes <= found
+        assert all(detection['frame'] == 5 for detection in detections)
+        assert {d['trackId'] for d in detections if not d['interpolated']} == keyframes
+
+
 @pytest.mark.integration
 @pytest.mark.parametrize("user", users.values())
 @pytest.mark.run(order=6)
@@ -41,6 +212,74 @@ def test_download_csv(user: dict):
                 if not row.startswith('#'):
                     track_set.add(row.split(',')[0])
             assert len(track_set) == expected[0]['trackCount']
+        if dataset['meta'].get('type') != 'image-sequence':
+            continue
+        # The rows name their images, so renaming an image changes the ETag
+        path = f'dive_annotation/export?folderId={dataset["_id"]}'
+        etag = client.sendRestRequest('GET', path, jsonResp=False).headers['ETag']
+        items = client.listItem(dataset['_id'])
+        image = next(i for i in items if constants.safeImageRegex.search(i['name']))
+        client.put(f'item/{image["_id"]}', parameters={'name': f'renamed_{image["name"]}'})
+        renamed = client.sendRestRequest(
+            'GET', path, headers={'If-None-Match': etag}, jsonResp=False
+        )
+        client.put(f'item/{image["_id"]}', parameters={'name': image['name']})
+        assert renamed.status_code == 200
+        assert renamed.headers['ETag'] != etag
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_filtered_dive_json(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        downloaded = client.sendRestRequest(
+            'GET',
+            f'dive_annotation/export?format=dive_json&excludeBelowThreshold=true&folderId={dataset["_id"]}',
+            jsonResp=False,
+        )
+        annotations = json.loads(downloaded.content.decode('utf-8'))
+        thresholds = fromMeta(client.getFolder(dataset['_id']), 'confidenceFilters', {}) or {}
+        expected = [
+            str(track['id'])
+            for track in client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+            if Track(**track).exceeds_thresholds(thresholds)
+        ]
+        assert sorted(annotations['tracks'].keys()) == sorted(expected)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_dive_json(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        downloaded = client.sendRestRequest(
+            'GET',
+            f'dive_annotation/export?format=dive_json&excludeBelowThreshold=false&folderId={dataset["_id"]}',
+            jsonResp=False,
+        )
+        annotations = json.loads(downloaded.content.decode('utf-8'))
+        all_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        assert sorted(annotations['tracks'].keys()) == sorted(str(t['id']) for t in all_tracks)
+        assert 'groups' in annotations
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=6)
+def test_download_labels(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    labels = {row['_id']: row for row in client.get('dive_annotation/labels')}
+    for dataset in client.listFolder(privateFolder['_id']):
+        for track in client.get(f'dive_annotation/track?folderId={dataset["_id"]}'):
+            if track['confidencePairs']:
+                label = labels[track['confidencePairs'][0][0]]
+                assert str(dataset['_id']) in [str(d['id']) for d in label['datasets']]
 
 
 @pytest.mark.integration
@@ -139,3 +378,405 @@ def test_upload_json_detections(user: dict):
         assert '999999' in new_tracks, "Should have one track, 999999"
         assert len(new_tracks_list) == 1, "Should have a single track"
         client.post(f'dive_annotation/rollback?folderId={dataset["_id"]}&revision={old_revision}')
+        rolled_back = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        assert sorted(t['id'] for t in rolled_back) == sorted(t['id'] for t in old_tracks_list)
+        revisions = client.get(
+            f'dive_annotation/revision?folderId={dataset["_id"]}&sort=revision&sortdir=-1'
+        )
+        assert revisions[0]['description'] == f'Rollback to revision {old_revision}'
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_read_during_overwrite(user: dict, tmp_path):
+    """
+    An import expires every track before inserting the new ones in batches.
+    Reads that land between those phases must still see the committed revision.
+    """
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    dataset = next(d for d in client.listFolder(privateFolder['_id']) if 'clone' not in d['name'])
+    path = f'dive_annotation/track?folderId={dataset["_id"]}&fields=summary'
+    old_count = len(client.get(path))
+    old_revision = client.get(f'dive_annotation/revision?folderId={dataset["_id"]}')[0]['revision']
+    feature = {'frame': 0, 'bounds': [0, 0, 1, 1]}
+    tracks = {
+        str(id): {'id': id, 'begin': 0, 'end': 0, 'features': [feature], 'confidencePairs': []}
+        for id in range(5000)
+    }
+    annotation_file = tmp_path / 'overwrite.json'
+    annotation_file.write_text(json.dumps({'tracks': tracks, 'groups': {}, 'version': 2}))
+
+    def overwrite():
+        client.uploadFileToFolder(dataset['_id'], str(annotation_file))
+        client.post(f'dive_rpc/postprocess/{dataset["_id"]}', data={"skipJobs": True})
+
+    writer = threading.Thread(target=overwrite)
+    writer.start()
+    counts = set()
+    while writer.is_alive():
+        counts.add(len(client.get(path)))
+    writer.join()
+    counts.add(len(client.get(path)))
+    assert counts <= {old_count, len(tracks)}
+    assert len(client.get(path)) == len(tracks)
+    client.post(f'dive_annotation/rollback?folderId={dataset["_id"]}&revision={old_revision}')
+    assert len(client.get(path)) == old_count
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_concurrent_saves(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    dataset = next(d for d in client.listFolder(privateFolder['_id']) if 'clone' not in d['name'])
+    path = f'dive_annotation/track?folderId={dataset["_id"]}'
+    revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+    old_revision = client.get(revisions_path)[0]['revision']
+
+    def save(id: int, end: int = 0):
+        features = [{'frame': frame, 'bounds': [0, 0, 1, 1]} for frame in range(end + 1)]
+        track = {'id': id, 'begin': 0, 'end': end, 'features': features}
+        client.sendRestRequest(
+            'PATCH',
+            f'dive_annotation?folderId={dataset["_id"]}',
+            json={'tracks': {'upsert': [track]}},
+        )
+
+    # Saves of different tracks don't conflict, so none of them waits or fails
+    saves = 8
+    ids = list(range(424200, 424200 + saves))
+    with ThreadPoolExecutor(max_workers=saves) as executor:
+        list(executor.map(save, ids))
+    head_ids = [t['id'] for t in client.get(path)]
+    assert all(head_ids.count(id) == 1 for id in ids)
+    logged = client.get(f'{revisions_path}&sort=revision&sortdir=1&limit=0')
+    logged = [entry['revision'] for entry in logged if entry['revision'] > old_revision]
+    assert logged == list(range(old_revision + 1, old_revision + saves + 1))
+    # A revision shows every save up to it, even when later ones committed first
+    for revision in logged:
+        tracks = client.get(f'{path}&revision={revision}')
+        assert len([t for t in tracks if t['id'] in ids]) == revision - old_revision
+
+    # Saves of the same track conflict, and only the ones that lose are rejected
+    def edit(end: int) -> bool:
+        try:
+            save(424242, end)
+        except HttpError as err:
+            assert err.status == 409
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=saves) as executor:
+        saved = list(executor.map(edit, range(saves)))
+    assert any(saved)
+    head = client.get(path)
+    assert [t['id'] for t in head].count(424242) == 1
+    logged = client.get(f'{revisions_path}&sort=revision&sortdir=1&limit=0')
+    for entry in logged:
+        if entry['revision'] > old_revision + saves:
+            tracks = client.get(f'{path}&revision={entry["revision"]}')
+            assert [t['id'] for t in tracks].count(424242) == 1
+    client.post(f'dive_annotation/rollback?folderId={dataset["_id"]}&revision={old_revision}')
+    head_ids = [t['id'] for t in client.get(path)]
+    assert not {424242, *ids} & {*head_ids}
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_cached_read_during_saves(user: dict):
+    """
+    Saves that commit between a head read resolving its revision and listing must
+    not leave a newer body in the cache entry of the older revision.
+    """
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    dataset = next(d for d in client.listFolder(privateFolder['_id']) if 'clone' not in d['name'])
+    path = f'dive_annotation/track?folderId={dataset["_id"]}'
+    revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+    old_revision = client.get(revisions_path)[0]['revision']
+    track = {'id': 434343, 'begin': 0, 'end': 0, 'features': [{'frame': 0, 'bounds': [0, 0, 1, 1]}]}
+    saved = {}
+
+    def saves():
+        for count in range(20):
+            save_tracks(client, dataset, upsert=[{**track, 'attributes': {'count': count}}])
+            saved[client.get(revisions_path)[0]['revision']] = count
+
+    writer = threading.Thread(target=saves)
+    writer.start()
+    while writer.is_alive():
+        client.get(path)
+    writer.join()
+    for revision, count in saved.items():
+        pinned = get_track(client, dataset, track['id'], f'&revision={revision}')
+        assert pinned['attributes'] == {'count': count}
+    client.post(f'dive_annotation/rollback?folderId={dataset["_id"]}&revision={old_revision}')
+    assert get_track(client, dataset, track['id']) is None
+
+
+def long_track(id: int, length: int, x: int = 0) -> dict:
+    """A track with more features than fit in a single feature chunk"""
+    features = [
+        {
+            'frame': frame,
+            'bounds': [x, 0, x + 10, 10],
+            'attributes': {},
+            'keyframe': True,
+            'interpolate': False,
+        }
+        for frame in range(length)
+    ]
+    return {
+        'id': id,
+        'begin': 0,
+        'end': length - 1,
+        'confidencePairs': [['fish', 0.5]],
+        'attributes': {},
+        'features': features,
+    }
+
+
+def save_tracks(client: GirderClient, dataset: dict, upsert=(), delete=()):
+    client.sendRestRequest(
+        'PATCH',
+        f'dive_annotation?folderId={dataset["_id"]}',
+        json={'tracks': {'upsert': list(upsert), 'delete': list(delete)}},
+    )
+
+
+def get_track(client: GirderClient, dataset: dict, id: int, params: str = ''):
+    tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}{params}')
+    return next((track for track in tracks if track['id'] == id), None)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_chunked_track_roundtrip(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        track = long_track(616161, 5000)
+        save_tracks(client, dataset, upsert=[track])
+        assert get_track(client, dataset, track['id']) == track
+        # Windowed reads fetch the chunks overlapping the window and their neighbours
+        windowed = get_track(client, dataset, track['id'], '&frameStart=2200&frameEnd=2300')
+        assert [f['frame'] for f in windowed['features']] == list(range(1000, 4000))
+        save_tracks(client, dataset, delete=[track['id']])
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_long_track_frame_window(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        # Spans more frame buckets than a track indexes, so it is found by begin and end
+        track = {
+            'id': 636363,
+            'begin': 0,
+            'end': 100000,
+            'features': [
+                {'frame': 0, 'bounds': [0, 0, 1, 1], 'keyframe': True},
+                {'frame': 100000, 'bounds': [0, 0, 1, 1], 'keyframe': True},
+            ],
+        }
+        save_tracks(client, dataset, upsert=[track])
+        assert get_track(client, dataset, track['id'], '&frameStart=50000&frameEnd=50010')
+        assert not get_track(client, dataset, track['id'], '&frameStart=200000&frameEnd=200010')
+        save_tracks(client, dataset, delete=[track['id']])
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_chunked_track_partial_rewrite(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        track = long_track(626262, 2500)
+        save_tracks(client, dataset, upsert=[track])
+        revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+        first_revision = client.get(revisions_path)[0]['revision']
+        edited = long_track(626262, 2500)
+        edited['features'][1500]['bounds'] = [5, 5, 15, 15]
+        save_tracks(client, dataset, upsert=[edited])
+        assert get_track(client, dataset, edited['id']) == edited
+        # The previous version keeps its own copy of the rewritten chunk
+        assert get_track(client, dataset, track['id'], f'&revision={first_revision}') == track
+        save_tracks(client, dataset, delete=[track['id']])
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_chunked_track_delete(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        track = long_track(636363, 2500)
+        save_tracks(client, dataset, upsert=[track])
+        revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+        saved_revision = client.get(revisions_path)[0]['revision']
+        save_tracks(client, dataset, delete=[track['id']])
+        assert get_track(client, dataset, track['id']) is None
+        detections = client.get(f'dive_annotation/frame?folderId={dataset["_id"]}&frame=1500')
+        assert track['id'] not in [detection['trackId'] for detection in detections]
+        # Expired chunks stay readable through the revision history
+        assert get_track(client, dataset, track['id'], f'&revision={saved_revision}') == track
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_chunked_track_frame(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        # Keyframes fill the first chunk and resume in the third, with a gap between
+        track = long_track(646464, 1000)
+        track['features'][-1]['interpolate'] = True
+        resumed = long_track(646464, 1100)['features'][1000:]
+        for feature in resumed:
+            feature['frame'] += 1500
+        track['features'] += resumed
+        track['end'] = track['features'][-1]['frame']
+        save_tracks(client, dataset, upsert=[track])
+        detections = client.get(f'dive_annotation/frame?folderId={dataset["_id"]}&frame=2000')
+        found = [detection for detection in detections if detection['trackId'] == track['id']]
+        assert [(d['frame'], d['interpolated']) for d in found] == [(2000, True)]
+        save_tracks(client, dataset, delete=[track['id']])
+
+
+def patch_tracks(client: GirderClient, dataset: dict, patches: list, **body):
+    return client.sendRestRequest(
+        'PATCH',
+        f'dive_annotation?folderId={dataset["_id"]}',
+        json={'tracks': {'patch': patches}, **body},
+    )
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_patch_track(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        track = long_track(656565, 3)
+        track['attributes'] = {'color': 'red', 'size': 2}
+        save_tracks(client, dataset, upsert=[track])
+        patch_tracks(
+            client,
+            dataset,
+            [
+                {
+                    'id': track['id'],
+                    'attributes': {'shape': 'round', 'size': None},
+                    'removeFrames': [0],
+                    'features': [{'frame': 3, 'bounds': [1, 1, 2, 2]}],
+                }
+            ],
+        )
+        patched = get_track(client, dataset, track['id'])
+        # Attributes are merged, and null removes a key
+        assert patched['attributes'] == {'color': 'red', 'shape': 'round'}
+        assert [f['frame'] for f in patched['features']] == [1, 2, 3]
+        assert (patched['begin'], patched['end']) == (1, 3)
+        assert patched['features'][-1]['bounds'] == [1, 1, 2, 2]
+        save_tracks(client, dataset, delete=[track['id']])
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_patch_track_rejected(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        with pytest.raises(HttpError) as err:
+            patch_tracks(client, dataset, [{'id': 676767, 'removeFrames': [0]}])
+        assert err.value.status == 404
+        track = long_track(676767, 3)
+        save_tracks(client, dataset, upsert=[track])
+        revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+        loaded = client.get(revisions_path)[0]['revision']
+        save_tracks(client, dataset, upsert=[{**track, 'attributes': {'edited': True}}])
+        # The client's copy of the track is older than the head version
+        with pytest.raises(HttpError) as err:
+            patch_tracks(
+                client, dataset, [{'id': track['id'], 'removeFrames': [0]}], revision=loaded
+            )
+        assert err.value.status == 409
+        assert get_track(client, dataset, track['id'])['attributes'] == {'edited': True}
+        save_tracks(client, dataset, delete=[track['id']])
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_save_to_set(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        default_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        track = {'id': 1, 'begin': 0, 'end': 0, 'features': [{'frame': 0, 'bounds': [0, 0, 1, 1]}]}
+        client.sendRestRequest(
+            'PATCH',
+            f'dive_annotation?folderId={dataset["_id"]}',
+            json={'set': 'review', 'tracks': {'upsert': [track]}},
+        )
+        assert 'review' in client.get(f'dive_annotation/sets?folderId={dataset["_id"]}')
+        in_set = client.get(f'dive_annotation/track?folderId={dataset["_id"]}&set=review')
+        assert [t['id'] for t in in_set] == [1]
+        assert client.get(f'dive_annotation/track?folderId={dataset["_id"]}') == default_tracks
+        # A save to the default set and a rollback of it list the default set once
+        revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+        before = client.get(revisions_path)[0]['revision']
+        client.sendRestRequest(
+            'PATCH',
+            f'dive_annotation?folderId={dataset["_id"]}',
+            json={'set': '', 'tracks': {'upsert': [{**track, 'id': 2}]}},
+        )
+        client.post(f'dive_annotation/rollback?folderId={dataset["_id"]}&revision={before}')
+        names = client.get(f'dive_annotation/sets?folderId={dataset["_id"]}')
+        assert len(names) == len(set(names))
+        assert client.get(f'dive_annotation/track?folderId={dataset["_id"]}') == default_tracks
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=7)
+def test_sets_heads(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    for dataset in client.listFolder(privateFolder['_id']):
+        track = {'id': 1, 'begin': 0, 'end': 0, 'features': [{'frame': 0, 'bounds': [0, 0, 1, 1]}]}
+        names = [f'sets-{index}' for index in range(25)]
+        for name in names:
+            client.sendRestRequest(
+                'PATCH',
+                f'dive_annotation?folderId={dataset["_id"]}',
+                json={'set': name, 'tracks': {'upsert': [track]}},
+            )
+        # Sets are not paged
+        assert set(names) <= set(client.get(f'dive_annotation/sets?folderId={dataset["_id"]}'))
+        if 'clone' in dataset['name']:
+            continue
+        # Saving to another set leaves the ETag of a set-scoped read valid
+        path = f'dive_annotation/track?folderId={dataset["_id"]}&set={names[0]}'
+        etag = client.sendRestRequest('GET', path, jsonResp=False).headers['ETag']
+        client.sendRestRequest(
+            'PATCH',
+            f'dive_annotation?folderId={dataset["_id"]}',
+            json={'set': names[1], 'tracks': {'delete': [1]}},
+        )
+        cached = client.sendRestRequest(
+            'GET', path, headers={'If-None-Match': etag}, jsonResp=False
+        )
+        assert cached.status_code == 304
@@ -1,3 +1,4 @@
+from girder_client import HttpError
 import pytest
 from requests.exceptions import RequestException
 
@@ -54,7 +55,7 @@ def test_dataset_clone(user: dict):
     client = getClient(user['login'])
     privateFolder = getTestFolder(client)
     for dataset in client.listFolder(privateFolder['_id']):
-        client.post(
+        clone = client.post(
             'dive_dataset',
             parameters={
                 'cloneId': dataset['_id'],
@@ -62,6 +63,9 @@ def test_dataset_clone(user: dict):
                 'name': dataset['name'] + ' clone',
             },
         )
+        source_tracks = client.get(f'dive_annotation/track?folderId={dataset["_id"]}')
+        clone_tracks = client.get(f'dive_annotation/track?folderId={clone["_id"]}')
+        assert clone_tracks == source_tracks
 
 
 @pytest.mark.integration
@@ -89,3 +93,118 @@ def test_invalid_upload(user: dict):
         client.uploadFileToFolder(dataset['_id'], '../testutils/invalid.json')
         with pytest.raises(RequestException):
             client.post(f'dive_rpc/postprocess/{dataset["_id"]}', data={"skipJobs": True})
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=5)
+def test_dataset_clone_edits(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    datasets = list(client.listFolder(privateFolder['_id']))
+    for source in datasets:
+        clone = next((d for d in datasets if d['name'] == source['name'] + ' clone'), None)
+        if clone is None:
+            continue
+        source_tracks = client.get(f'dive_annotation/track?folderId={source["_id"]}')
+        source_groups = client.get(f'dive_annotation/group?folderId={source["_id"]}')
+        revisions_path = f'dive_annotation/revision?folderId={clone["_id"]}'
+        save_path = f'dive_annotation?folderId={clone["_id"]}'
+        # Deleting a track that only the clone has needs no tombstone, and counts once
+        track = {
+            'id': 737373,
+            'begin': 0,
+            'end': 0,
+            'features': [{'frame': 0, 'bounds': [0, 0, 1, 1]}],
+        }
+        client.sendRestRequest('PATCH', save_path, json={'tracks': {'upsert': [track]}})
+        client.sendRestRequest('PATCH', save_path, json={'tracks': {'delete': [track['id']]}})
+        assert client.get(revisions_path)[0]['deletions'] == 1
+        if source_tracks:
+            # Deleting an edited source track counts once too
+            edited = {**source_tracks[0], 'attributes': {'edited': True}}
+            client.sendRestRequest('PATCH', save_path, json={'tracks': {'upsert': [edited]}})
+            client.sendRestRequest('PATCH', save_path, json={'tracks': {'delete': [edited['id']]}})
+            assert client.get(revisions_path)[0]['deletions'] == 1
+            clone_ids = [
+                t['id'] for t in client.get(f'dive_annotation/track?folderId={clone["_id"]}')
+            ]
+            assert edited['id'] not in clone_ids
+        before_import = client.get(revisions_path)[0]['revision']
+        tracks_before_import = client.get(f'dive_annotation/track?folderId={clone["_id"]}')
+        # An import replaces every annotation, so the clone stops reading its source
+        client.uploadFileToFolder(clone['_id'], '../testutils/tracks.json')
+        client.post(f'dive_rpc/postprocess/{clone["_id"]}', data={"skipJobs": True})
+        clone_tracks = client.get(f'dive_annotation/track?folderId={clone["_id"]}')
+        assert [t['id'] for t in clone_tracks] == [999999]
+        # The deleted track is not counted again
+        expected = len(source_tracks) + len(source_groups) - (1 if source_tracks else 0)
+        assert client.get(revisions_path)[0]['deletions'] == expected
+        assert client.get(f'dive_annotation/track?folderId={source["_id"]}') == source_tracks
+        # The clone keeps its history from before the import, and can be rolled back to it
+        before_path = f'dive_annotation/track?folderId={clone["_id"]}&revision={before_import}'
+        assert client.get(before_path) == tracks_before_import
+        client.post(f'dive_annotation/rollback?folderId={clone["_id"]}&revision={before_import}')
+        clone_tracks = client.get(f'dive_annotation/track?folderId={clone["_id"]}')
+        assert clone_tracks == tracks_before_import
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize("user", users.values())
+@pytest.mark.run(order=5)
+def test_compact_revisions(user: dict):
+    client = getClient(user['login'])
+    privateFolder = getTestFolder(client)
+    source = next(d for d in client.listFolder(privateFolder['_id']) if 'clone' not in d['name'])
+
+    def clone(dataset: dict, name: str, **params) -> dict:
+        return client.post(
+            'dive_dataset',
+            parameters={
+                'cloneId': dataset['_id'],
+                'parentFolderId': privateFolder['_id'],
+                'name': f'{source["name"]} {name} clone',
+                **params,
+            },
+        )
+
+    # A clone of a clone is a full copy, so compacting it leaves the test data alone
+    shallow = clone(source, 'shallow')
+    dataset = clone(shallow, 'compacted')
+    path = f'dive_annotation/track?folderId={dataset["_id"]}'
+    save_path = f'dive_annotation?folderId={dataset["_id"]}'
+    revisions_path = f'dive_annotation/revision?folderId={dataset["_id"]}'
+    track = {
+        'id': 747474,
+        'begin': 0,
+        'end': 0,
+        'features': [{'frame': 0, 'bounds': [0, 0, 1, 1]}],
+    }
+    client.sendRestRequest('PATCH', save_path, json={'tracks': {'upsert': [track]}})
+    expired = client.get(revisions_path)[0]['revision']
+    track['attributes'] = {'edited': 1}
+    client.sendRestRequest('PATCH', save_path, json={'tracks': {'upsert': [track]}})
+    pinned = client.get(revisions_path)[0]['revision']
+    pinned_tracks = client.get(path)
+    pinning = clone(dataset, 'pinning', revision=pinned)
+    track['attributes'] = {'edited': 2}
+    client.sendRestRequest('PATCH', save_path, json={'tracks': {'upsert': [track]}})
+    head_tracks = client.get(path)
+
+    result = client.post(f'dive_annotation/compact?folderId={dataset["_id"]}&keep=1')
+    # The clone's pinned revision holds the floor back, so it and the head are kept
+    assert result['revision'] == pinned
+    assert result['tracks'] > 0
+    assert client.get(revisions_path)[-1]['revision'] == pinned
+    assert client.get(path) == head_tracks
+    assert client.get(f'{path}&revision={pinned}') == pinned_tracks
+    assert client.get(f'dive_annotation/track?folderId={pinning["_id"]}') == pinned_tracks
+    # History below the floor can no longer be read or rolled back to
+    with pytest.raises(HttpError) as err:
+        client.get(f'{path}&revision={expired}')
+    assert 'compacted' in err.value.responseText
+    with pytest.raises(HttpError) as err:
+        client.post(f'dive_annotation/rollback?folderId={dataset["_id"]}&revision={expired}')
+    assert 'compacted' in err.value.responseText
+    for folder in [pinning, dataset, shallow]:
+        client.delete(f'folder/{folder["_id"]}')
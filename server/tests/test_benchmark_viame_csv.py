@@ -0,0 +1,206 @@
+"""
+Scaling and parsing benchmarks for the VIAME CSV importer.
+
+These are slow, so they only run when selected with ``-m benchmark``.
+"""
+
+import os
+import re
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import pytest
+
+from dive_utils.models import Feature
+from dive_utils.serializers import viame
+from dive_utils.serializers.viame import _deduceType, create_geoJSONFeature, row_info
+
+# Few tracks, so each track grows long, as with pipeline outputs on long sequences
+TRACK_COUNT = 10
+SIZES = [10_000, 100_000, 1_000_000]
+# Allowed growth of the time per row from the smallest to the largest size
+MAX_SLOWDOWN = 2.0
+
+
+def generate_rows(count: int) -> Iterator[str]:
+    for frame in range(count // TRACK_COUNT):
+        for trackId in range(TRACK_COUNT):
+            yield (
+                f'{trackId},{frame}.png,{frame},10,20,110,120,0.9,-1,fish,0.9,'
+                '(trk-atr) color red'
+            )
+
+
+def image_map(count: int) -> Dict[str, int]:
+    return {str(frame): frame for frame in range(count // TRACK_COUNT)}
+
+
+def seconds_per_row(count: int, run: Callable[[int], None]) -> float:
+    start = time.perf_counter()
+    run(count)
+    return (time.perf_counter() - start) / count
+
+
+def assert_linear(run: Callable[[int], None]):
+    per_row = {count: seconds_per_row(count, run) for count in SIZES}
+    for count, seconds in per_row.items():
+        print(f'{count} rows: {seconds * 1e6:.1f}us per row')
+    slowdown = per_row[SIZES[-1]] / per_row[SIZES[0]]
+    assert slowdown < MAX_SLOWDOWN, f'time per row grew {slowdown:.1f}x'
+
+
+@pytest.mark.benchmark
+def test_load_csv_scales_linearly():
+    def run(count: int):
+        viame.load_csv_as_tracks_and_attributes(generate_rows(count))
+
+    assert_linear(run)
+
+
+@pytest.mark.benchmark
+def test_load_csv_with_image_map_scales_linearly():
+    def run(count: int):
+        viame.load_csv_as_tracks_and_attributes(generate_rows(count), image_map(count))
+
+    assert_linear(run)
+
+
+# The parser before columns were tokenized, copied verbatim from commit 6d36316 as the baseline.
+# The helpers it calls and the Feature model are unchanged since then.
+
+
+def _parse_row(row: List[str]) -> Tuple[Dict, Dict, Dict, List]:
+    """
+    Parse a single CSV line into its composite track and detection parts
+    """
+    features: Dict[str, Any] = {}
+    attributes: Dict[str, Any] = {}
+    track_attributes: Dict[str, Any] = {}
+    confidence_pairs: List[Tuple[str, float]] = [
+        (row[i], float(row[i + 1]))
+        for i in range(9, len(row), 2)
+        if i + 1 < len(row) and row[i] and row[i + 1] and not row[i].startswith("(")
+    ]
+    sorted_confidence_pairs = sorted(confidence_pairs, key=lambda item: item[1], reverse=True)
+    head_tail = []
+    start = 9 + len(sorted_confidence_pairs) * 2
+
+    for j in range(start, len(row)):
+        # (kp) head x y
+        head_regex = re.match(r"^\(kp\) head (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)", row[j])
+        if head_regex:
+            point = [float(head_regex[1]), float(head_regex[2])]
+            head_tail.append(point)
+            create_geoJSONFeature(features, 'Point', point, 'head')
+
+        # (kp) tail x y
+        tail_regex = re.match(r"^\(kp\) tail (-?[0-9]+\.*-?[0-9]*) (-?[0-9]+\.*-?[0-9]*)", row[j])
+        if tail_regex:
+            point = [float(tail_regex[1]), float(tail_regex[2])]
+            head_tail.append(point)
+            create_geoJSONFeature(features, 'Point', point, 'tail')
+
+        # (atr) text
+        atr_regex = re.match(r"^\(atr\) (.*?)\s(.+)", row[j])
+        if atr_regex:
+            attributes[atr_regex[1]] = _deduceType(atr_regex[2])
+
+        # (trk-atr) text
+        trk_regex = re.match(r"^\(trk-atr\) (.*?)\s(.+)", row[j])
+        if trk_regex:
+            track_attributes[trk_regex[1]] = _deduceType(trk_regex[2])
+
+        # (poly) x1 y1 x2 y2 ...
+        poly_regex = re.match(r"^(\(poly\)) ((?:-?[0-9]+\.*-?[0-9]*\s*)+)", row[j])
+        if poly_regex:
+            temp = [float(x) for x in poly_regex[2].split()]
+            coords = list(zip(temp[::2], temp[1::2]))
+            create_geoJSONFeature(features, 'Polygon', coords)
+
+    if len(head_tail) == 2:
+        create_geoJSONFeature(features, 'LineString', head_tail, 'HeadTails')
+
+    # ensure confidence pairs list is not empty
+    if len(sorted_confidence_pairs) == 0:
+        # extract Detection or Length Confidence field
+        try:
+            confidence = float(row[7])
+        except ValueError:  # in case field is empty
+            confidence = 1.0
+
+        # add a dummy pair with a default type
+        sorted_confidence_pairs.append(('unknown', confidence))
+
+    return features, attributes, track_attributes, sorted_confidence_pairs
+
+
+def _parse_row_for_tracks(row: List[str]) -> Tuple[Feature, Dict, Dict, List]:
+    head_tail_feature, attributes, track_attributes, confidence_pairs = _parse_row(row)
+    _, _, frame, bounds, fishLength = row_info(row)
+
+    feature = Feature(
+        frame=frame,
+        bounds=bounds,
+        attributes=attributes or None,
+        fishLength=fishLength if fishLength > 0 else None,
+        **head_tail_feature,
+    )
+
+    # Pass the rest of the unchanged info through as well
+    return feature, attributes, track_attributes, confidence_pairs
+
+
+def seconds_per_parse(parse: Callable[[List[str]], Any], row: List[str]) -> float:
+    count = 20_000
+    start = time.perf_counter()
+    for _ in range(count):
+        parse(row)
+    return (time.perf_counter() - start) / count
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    "row,min_speedup",
+    [
+        # Detector output, a single confidence pair or a few
+        ('1,5.png,5,10,20,110,120,0.9,-1,fish,0.9', 3.0),
+        ('1,5.png,5,10,20,110,120,0.9,-1,fish,0.9,scallop,0.2,skate,0.1', 3.0),
+        ('1,5.png,5,10,20,110,120,0.9,-1,fish,0.9,(atr) size 3,(trk-atr) color red', 3.0),
+        # Rows with geometry still validate it, so they only must not regress
+        ('1,5.png,5,10,20,110,120,0.9,-1,fish,0.9,(kp) head 10 20,(kp) tail 30 40', 0.7),
+        ('1,5.png,5,10,20,110,120,0.9,-1,fish,0.9,(poly) 10 20 110 20 110 120 10 120', 0.7),
+    ],
+)
+def test_parse_row_speedup(row: str, min_speedup: float):
+    columns = row.split(',')
+    feature, *parts = viame._parse_row_for_tracks(columns)
+    baseline, *baseline_parts = _parse_row_for_tracks(columns)
+    assert feature == baseline.dict(exclude_none=True)
+    assert parts == baseline_parts
+    # The baseline loader serialized each feature as it added it to a track
+    reference = seconds_per_parse(
+        lambda row: _parse_row_for_tracks(row)[0].dict(exclude_none=True), columns
+    )
+    tokenized = seconds_per_parse(viame._parse_row_for_tracks, columns)
+    speedup = reference / tokenized
+    print(f'{speedup:.1f}x: {tokenized * 1e6:.1f}us per row, from {reference * 1e6:.1f}us')
+    assert speedup >= min_speedup
+
+
+@pytest.mark.benchmark
+@pytest.mark.skipif((os.cpu_count() or 1) < 4, reason='needs at least 4 cores')
+def test_load_csv_scales_with_processes():
+    processes = min(os.cpu_count() or 1, 8)
+    rows = list(generate_rows(SIZES[-1]))
+
+    def seconds(processes: int) -> float:
+        start = time.perf_counter()
+        viame.load_csv_as_tracks_and_attributes(rows, processes=processes)
+        return time.perf_counter() - start
+
+    serial = seconds(1)
+    parallel = seconds(processes)
+    speedup = serial / parallel
+    print(f'{processes} processes: {speedup:.1f}x, {parallel:.1f}s from {serial:.1f}s')
+    # Partitioning and merging stay serial, so allow for a part of the ideal speedup
+    assert speedup >= processes / 3
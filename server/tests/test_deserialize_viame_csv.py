@@ -15,7 +15,44 @@ def test_read_viame_csv(
     expected_tracks: Dict[str, dict],
     expected_attributes: Dict[str, dict],
 ):
-    (converted, attributes, warnings, fps) = viame.load_csv_as_tracks_and_attributes(input)
+    converted, attributes, warnings, fps = viame.load_csv_as_tracks_and_attributes(input)
+    assert json.dumps(converted['tracks'], sort_keys=True) == json.dumps(
+        expected_tracks, sort_keys=True
+    )
+    assert json.dumps(attributes, sort_keys=True) == json.dumps(expected_attributes, sort_keys=True)
+
+
+@pytest.mark.parametrize("input,expected_tracks,expected_attributes", test_tuple)
+def test_read_viame_csv_unsorted(
+    input: List[str],
+    expected_tracks: Dict[str, dict],
+    expected_attributes: Dict[str, dict],
+):
+    """Rows read in reverse give the same tracks and attributes as sorted rows"""
+    converted, attributes, _, _ = viame.load_csv_as_tracks_and_attributes(reversed(input))
+    assert json.dumps(converted['tracks'], sort_keys=True) == json.dumps(
+        expected_tracks, sort_keys=True
+    )
+    assert json.dumps(attributes, sort_keys=True) == json.dumps(expected_attributes, sort_keys=True)
+
+
+def test_iter_lines():
+    text = '1,é.png,0\n2,ü.png,1\n3,last.png,2'
+    encoded = text.encode('utf-8')
+    # Chunk boundaries fall inside multi-byte characters and rows
+    chunks = [encoded[start : start + 3] for start in range(0, len(encoded), 3)]
+    assert list(viame.iter_lines(chunks)) == text.split('\n')
+    assert list(viame.iter_lines([b'a\n', b'b\n'])) == ['a', 'b']
+
+
+@pytest.mark.parametrize("input,expected_tracks,expected_attributes", test_tuple[0:3:2])
+def test_read_viame_csv_partitioned(
+    input: List[str],
+    expected_tracks: Dict[str, dict],
+    expected_attributes: Dict[str, dict],
+):
+    """Rows parsed by several processes give the same tracks and attributes"""
+    converted, attributes, _, _ = viame.load_csv_as_tracks_and_attributes(input, processes=2)
     assert json.dumps(converted['tracks'], sort_keys=True) == json.dumps(
         expected_tracks, sort_keys=True
     )
@@ -0,0 +1,36 @@
+from typing import List, Tuple
+
+import pytest
+
+from dive_utils import models
+
+features = [
+    {"frame": 0, "bounds": [0, 0, 10, 10], "interpolate": True},
+    {"frame": 4, "bounds": [40, 40, 50, 50], "interpolate": False},
+    {"frame": 6, "bounds": [60, 60, 70, 70], "interpolate": True},
+    {"frame": 8, "bounds": [80, 80, 90, 90]},
+]
+
+test_tuple: List[Tuple[int, int, List[Tuple[int, List[int], bool]]]] = [
+    (0, 0, [(0, [0, 0, 10, 10], False)]),
+    (2, 2, [(2, [20, 20, 30, 30], True)]),
+    (3, 5, [(3, [30, 30, 40, 40], True), (4, [40, 40, 50, 50], False)]),
+    (7, 20, [(7, [70, 70, 80, 80], True), (8, [80, 80, 90, 90], False)]),
+    (9, 20, []),
+]
+
+
+@pytest.mark.parametrize("start,end,expected", test_tuple)
+def test_features_at(start: int, end: int, expected: List[Tuple[int, List[int], bool]]):
+    result = models.features_at(list(reversed(features)), start, end)
+    actual = [(feature.frame, feature.bounds, interpolated) for feature, interpolated in result]
+    assert actual == expected
+
+
+def test_interpolate_matches_features_at():
+    a = models.Feature(**features[0])
+    b = models.Feature(**features[1])
+    interpolated = models.interpolate(a, b)
+    assert [feature.bounds for feature in interpolated] == [
+        feature.bounds for feature, _ in models.features_at(features, 0, 3)
+    ]
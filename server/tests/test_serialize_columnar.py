@@ -0,0 +1,84 @@
+import io
+from typing import List
+
+import pytest
+
+from dive_utils.serializers import columnar
+
+test_tracks: List[List[dict]] = [
+    [],
+    [
+        {
+            "id": 0,
+            "begin": 0,
+            "end": 2,
+            "confidencePairs": [["fish", 0.9]],
+            "attributes": {"color": "red"},
+            "features": [
+                {
+                    "frame": 0,
+                    "bounds": [884, 510, 1219, 737],
+                    "keyframe": True,
+                    "interpolate": True,
+                },
+                {"frame": 1, "bounds": [0, 0, 1, 1], "keyframe": False, "interpolate": True},
+                {
+                    "frame": 2,
+                    "bounds": [10, 20, 30, 40],
+                    "keyframe": True,
+                    "interpolate": False,
+                    "attributes": {"occluded": True},
+                    "head": [1.5, 2.5],
+                },
+            ],
+        },
+        {
+            "id": 1,
+            "begin": 5,
+            "end": 5,
+            "confidencePairs": [],
+            "attributes": {},
+            "features": [],
+        },
+    ],
+    [
+        {
+            "id": 2,
+            "begin": 0,
+            "end": 1,
+            "confidencePairs": [["fish", 0.5]],
+            "attributes": {},
+            "features": [
+                {"frame": 0, "bounds": [0, 0, 1, 1]},
+                {"frame": 1, "bounds": [0, 0, 1, 1], "keyframe": True},
+                {"frame": 2, "bounds": [0, 0, 1, 1], "interpolate": False},
+            ],
+        },
+    ],
+    [
+        # fields=summary tracks have no features, and featureCount is a track field
+        {
+            "id": 3,
+            "begin": 0,
+            "end": 9,
+            "maxConfidence": 0.5,
+            "topLabel": "fish",
+            "featureCount": 10,
+            "hasGeometry": False,
+        },
+    ],
+]
+
+
+@pytest.mark.parametrize("tracks", test_tracks)
+def test_roundtrip(tracks: List[dict]):
+    encoded = b''.join(columnar.encode_tracks(tracks))
+    assert list(columnar.decode_tracks(io.BytesIO(encoded))) == tracks
+
+
+def test_truncated():
+    encoded = b''.join(columnar.encode_tracks(test_tracks[1]))
+    with pytest.raises(ValueError):
+        list(columnar.decode_tracks(io.BytesIO(encoded[:-1])))
+    with pytest.raises(ValueError):
+        list(columnar.decode_tracks(io.BytesIO(b'JSON' + encoded[4:])))
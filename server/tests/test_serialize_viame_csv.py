@@ -2,6 +2,7 @@ from typing import Dict, List, Tuple
 
 import pytest
 
+from dive_utils import models
 from dive_utils.serializers import viame
 
 # Test cases can use this by staying under frame 100
@@ -362,3 +363,22 @@ def test_image_filenames():
                 test['csv'], image_map
             )
             assert len(warnings) > 0
+
+
+@pytest.mark.parametrize("input,expected,typeFilter", test_tuple)
+def test_write_viame_csv_trusted(
+    input: Dict[str, dict], expected: List[str], typeFilter: List[str]
+):
+    """Tracks as stored, with validation skipped, export the same rows"""
+    stored = [
+        {**models.Track(**track).dict(exclude_none=True), 'dataset': 'ds', 'rev_created': 1}
+        for track in input.values()
+    ]
+    for track in stored:
+        assert models.trusted_track(track) == models.Track(**track).dict(exclude_none=True)
+    for i, line in enumerate(
+        viame.export_tracks_as_csv(
+            stored, filenames=filenames, header=False, typeFilter=set(typeFilter), trusted=True
+        )
+    ):
+        assert line.strip(' ').rstrip() == expected[i]